@@ -0,0 +1,219 @@
+import asyncio
+import atexit
+import random
+import threading
+
+import httpx
+import openai
+
+# The one LLM client of a process, shared by every agent type and TypeChat. The requests run on an asyncio loop in a
+# daemon thread over one httpx.AsyncClient, so connections are kept alive and reused across agents and calls. Every
+# backend ("openai", "deepseek", "anthropic", "local", see backend_name) has its own limit of requests in flight and
+# its own timeout, so a slow provider only queues its own requests. Failed requests (connection errors, timeouts,
+# 408, 409, 429 and 5xx) are retried with exponential backoff and full jitter, or after the Retry-After the server
+# asks for.
+#
+# Sync code calls the *_sync methods (or run()), async code awaits the coroutines on the loop of the client.
+
+DEFAULT_POLICY = {
+    "concurrency": 8,       # requests in flight
+    "timeout": 120.0,       # seconds per attempt
+    "connect_timeout": 10.0,
+    "max_attempts": 4,
+    "base_delay": 1.0,      # the backoff before the n-th retry is uniform in [0, min(max_delay, base_delay * 2**n)]
+    "max_delay": 30.0,
+}
+
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMRequestError(Exception):
+    """a request that failed for good, after its retries; the last error is the __cause__"""
+    def __init__(self, message, backend=None, status_code=None):
+        super().__init__(message)
+        self.backend = backend
+        self.status_code = status_code
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=30.0):
+    """the jittered exponential backoff before retry number attempt (0 for the first retry)"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def backend_name(base_url=None, use_ollama=False):
+    """the backend of an endpoint, the key of its policy"""
+    if use_ollama:
+        return "local"
+    if base_url is None or "openai.com" in base_url:
+        return "openai"
+    for name in ("deepseek", "anthropic"):
+        if name in base_url:
+            return name
+    return "local"
+
+
+def _retry_after(headers):
+    try:
+        return max(0.0, float(headers.get("retry-after")))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMClient(object):
+    def __init__(self, policies=None, max_connections=100, max_keepalive_connections=20):
+        self._policies = {}
+        self._limits = httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_keepalive_connections)
+        self._loop = None
+        self._thread = None
+        self._http = None
+        self._semaphores = {}
+        self._openai_clients = {}
+        self._lock = threading.Lock()
+        for backend, policy in (policies or {}).items():
+            self.configure(backend, **policy)
+
+    def configure(self, backend, **policy):
+        """overrides keys of DEFAULT_POLICY for a backend, the concurrency only before its first request"""
+        unknown = set(policy) - set(DEFAULT_POLICY)
+        if unknown:
+            raise ValueError("Unknown LLM client policy keys", sorted(unknown))
+        with self._lock:
+            self._policies[backend] = dict(self._policies.get(backend, {}), **policy)
+
+    def policy(self, backend):
+        return dict(DEFAULT_POLICY, **self._policies.get(backend, {}))
+
+    # the loop
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="llm-client", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def run(self, coro):
+        """runs a coroutine on the loop of the client and waits for its result (from any thread but the loop's)"""
+        loop = self._ensure_loop()
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("run() would block the loop of the LLM client, await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def _semaphore(self, backend):
+        # created on the loop, by the first request of the backend
+        if backend not in self._semaphores:
+            self._semaphores[backend] = asyncio.Semaphore(self.policy(backend)["concurrency"])
+        return self._semaphores[backend]
+
+    def _http_client(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(limits=self._limits, timeout=DEFAULT_POLICY["timeout"])
+        return self._http
+
+    def _openai_client(self, base_url, api_key, organization):
+        key = (base_url, api_key, organization)
+        if key not in self._openai_clients:
+            # the retries are ours, the connections those of the shared http client
+            self._openai_clients[key] = openai.AsyncOpenAI(api_key=api_key or "EMPTY", base_url=base_url,
+                                                           organization=organization, max_retries=0,
+                                                           http_client=self._http_client())
+        return self._openai_clients[key]
+
+    async def _with_retries(self, backend, send, max_attempts=None, max_delay=None):
+        """awaits send(timeout) under the limit of the backend until it succeeds or the attempts run out"""
+        policy = self.policy(backend)
+        max_attempts = max_attempts or policy["max_attempts"]
+        max_delay = policy["max_delay"] if max_delay is None else max_delay
+        timeout = httpx.Timeout(policy["timeout"], connect=policy["connect_timeout"])
+
+        for attempt in range(max_attempts):
+            retry_after = None
+            try:
+                async with self._semaphore(backend):
+                    return await send(timeout)
+            except openai.APIStatusError as error:
+                status_code, retry_after = error.status_code, _retry_after(error.response.headers)
+                if status_code not in RETRY_STATUS:
+                    raise LLMRequestError(str(error), backend, status_code) from error
+                last_error = error
+            except (openai.APIConnectionError, httpx.TransportError) as error:
+                status_code, last_error = None, error
+            except _RetryableStatus as error:
+                status_code, retry_after, last_error = error.status_code, error.retry_after, error
+            print("LLM request to {} failed ({}: {}), attempt {} of {}".format(
+                backend, type(last_error).__name__, last_error, attempt + 1, max_attempts))
+            if attempt + 1 < max_attempts:
+                delay = backoff_delay(attempt, policy["base_delay"], max_delay)
+                await asyncio.sleep(delay if retry_after is None else min(max(delay, retry_after), max_delay))
+        raise LLMRequestError("LLM request to {} failed after {} attempts: {}".format(
+            backend, max_attempts, last_error), backend, status_code) from last_error
+
+    # the requests
+    async def chat_completion(self, backend, base_url=None, api_key=None, organization=None, max_attempts=None,
+                              max_delay=None, **params):
+        """a chat completion of an OpenAI compatible api, params as for chat.completions.create"""
+        client = self._openai_client(base_url, api_key, organization)
+        return await self._with_retries(
+            backend, lambda timeout: client.chat.completions.create(timeout=timeout, **params),
+            max_attempts=max_attempts, max_delay=max_delay)
+
+    async def post_json(self, backend, url, payload, headers=None, max_attempts=None, max_delay=None):
+        """posts payload as json and returns the decoded json of the (2xx) response"""
+        async def send(timeout):
+            response = await self._http_client().post(url, json=payload, headers=headers, timeout=timeout)
+            if response.status_code in RETRY_STATUS:
+                raise _RetryableStatus(response)
+            if response.status_code >= 400:
+                raise LLMRequestError("LLM request to {} failed with status {}: {}".format(
+                    backend, response.status_code, response.text), backend, response.status_code)
+            return response.json()
+        return await self._with_retries(backend, send, max_attempts=max_attempts, max_delay=max_delay)
+
+    def chat_completion_sync(self, backend, **kwargs):
+        return self.run(self.chat_completion(backend, **kwargs))
+
+    def post_json_sync(self, backend, url, payload, **kwargs):
+        return self.run(self.post_json(backend, url, payload, **kwargs))
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._http is not None:
+            asyncio.run_coroutine_threadsafe(self._http.aclose(), self._loop).result(timeout=5)
+            self._http = None
+        self._openai_clients = {}
+        self._semaphores = {}
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop = None
+        self._thread = None
+
+
+class _RetryableStatus(Exception):
+    def __init__(self, response):
+        super().__init__("status {}".format(response.status_code))
+        self.status_code = response.status_code
+        self.retry_after = _retry_after(response.headers)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client():
+    """the LLM client shared by everything in this process, its loop is started by the first request"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LLMClient()
+            atexit.register(_client.close)
+        return _client
+
+
+def configure_llm_client(config):
+    """applies {"backend": {policy keys}} (config["agent"]["llm_client"]) to the shared client"""
+    client = get_llm_client()
+    for backend, policy in (config or {}).items():
+        client.configure(backend, **policy)
+    return client
@@ -0,0 +1,134 @@
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+# Type checks TypeChat responses against schemas that ts_schema.py cannot compile with one long lived node process
+# (validator_daemon.js) instead of writing .ts files and starting tsc for every response. The process keeps the
+# TypeScript program, the lib declarations and every schema it has seen (by schema hash) in memory and answers
+# over its stdin/stdout, so a validation is a round trip over a local pipe.
+
+DAEMON_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "validator_daemon.js")
+
+
+def find_typescript():
+    """the folder of the typescript node module, from $TYPECHAT_TYPESCRIPT or next to the tsc executable"""
+    if os.environ.get("TYPECHAT_TYPESCRIPT"):
+        return os.environ["TYPECHAT_TYPESCRIPT"]
+    tsc = shutil.which("tsc")
+    if tsc is None:
+        return None
+    # tsc is typescript/bin/tsc, usually through a symlink in a bin folder
+    module = os.path.dirname(os.path.dirname(os.path.realpath(tsc)))
+    if os.path.exists(os.path.join(module, "lib", "typescript.js")):
+        return module
+    return None
+
+
+class TypeScriptValidatorDaemon(object):
+    """
+    Client of one validator_daemon.js process, thread safe.
+
+    check() returns (success, output) with output being what tsc prints for the same files and options, or None
+    when the daemon is not available (no node or typescript module, or the process died or did not answer within
+    timeout seconds); the caller then runs tsc. A daemon that timed out is killed and started again by the next check.
+    """
+    def __init__(self, node=None, typescript=None, timeout=30.0):
+        self._node = node or shutil.which("node")
+        self._typescript = typescript or find_typescript()
+        self.timeout = timeout
+        self._process = None
+        self._lines = None
+        self._sent_schemas = set()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def available(self):
+        return self._node is not None and self._typescript is not None
+
+    def _start(self):
+        self._process = subprocess.Popen([self._node, DAEMON_SCRIPT, self._typescript], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, text=True, bufsize=1)
+        self._sent_schemas = set()
+        # the answers are read by a thread, so that waiting for one can time out
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read_lines, args=(self._process.stdout, self._lines), daemon=True).start()
+
+    @staticmethod
+    def _read_lines(stdout, lines):
+        for line in stdout:
+            lines.put(line)
+        lines.put("")  # end of file, the process exited
+
+    def _request(self, request):
+        self._process.stdin.write(json.dumps(request) + "\n")
+        self._process.stdin.flush()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError("The validator daemon did not answer within {} seconds".format(self.timeout))
+            if line == "":
+                raise BrokenPipeError("The validator daemon exited")
+            response = json.loads(line)
+            if response.get("id") == request["id"]:
+                return response
+
+    def check(self, schema_hash, schema, schema_file, lib_file, lib_text, json_file, module_text, args):
+        if not self.available():
+            return None
+        with self._lock:
+            try:
+                if self._process is None or self._process.poll() is not None:
+                    self._start()
+                self._next_id += 1
+                request = {"id": self._next_id, "hash": schema_hash, "schemaFile": os.path.abspath(schema_file),
+                           "libFile": os.path.abspath(lib_file), "libText": lib_text,
+                           "jsonFile": os.path.abspath(json_file), "json": module_text, "args": args}
+                if schema_hash not in self._sent_schemas:
+                    request["schema"] = schema
+                response = self._request(request)
+                if response.get("error") == "unknown schema":
+                    request["schema"] = schema
+                    response = self._request(request)
+                if "error" in response:
+                    return None
+                self._sent_schemas.add(schema_hash)
+                return response["success"], response["output"]
+            except TimeoutError:
+                # a hung daemon would not exit on the closed stdin either
+                self.close(kill=True)
+                return None
+            except (OSError, ValueError):
+                self.close()
+                return None
+
+    def close(self, kill=False):
+        if self._process is not None:
+            try:
+                if kill:
+                    self._process.kill()
+                else:
+                    self._process.stdin.close()
+                self._process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+            self._process = None
+            self._lines = None
+
+
+_daemon = None
+_daemon_lock = threading.Lock()
+
+
+def get_daemon():
+    """the validator daemon shared by all validators of this process, started on its first check"""
+    global _daemon
+    with _daemon_lock:
+        if _daemon is None:
+            _daemon = TypeScriptValidatorDaemon()
+        return _daemon
@@ -0,0 +1,527 @@
+import hashlib
+import json
+import re
+
+# Compiles the TypeScript schemas used with TypeChat (interfaces and type aliases made of primitives, literals,
+# unions, arrays, nested object types and references) into JSON Schema, and the JSON Schema into a Python validator.
+# Validation then runs in-process instead of writing .ts files and running tsc for every response. The diagnostics
+# follow the tsc messages for the same errors, so the repair prompts stay the same; invalid values whose diagnostics
+# are not known to match tsc are left to tsc (see CompiledSchema.validate), ts_schema_check.py compares the two.
+# Schemas that use anything else raise UnsupportedSchemaError, TypeChatJsonValidator then falls back to tsc.
+
+# tsc shortens the types in its messages past this length
+MAX_TYPE_TEXT = 100
+
+
+class UnsupportedSchemaError(Exception):
+    pass
+
+
+class _Inexact(Exception):
+    """a diagnostic that tsc may word or place differently"""
+
+
+_TOKEN = re.compile(r'''
+    (?P<space>\s+|//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_$][\w$]*)
+  | (?P<punct>[{}\[\]()<>|&;:,?=])
+''', re.VERBOSE | re.DOTALL)
+
+_PRIMITIVES = {
+    "string": {"type": "string"},
+    "number": {"type": "number"},
+    "boolean": {"type": "boolean"},
+    "null": {"type": "null"},
+    "any": {},
+    "unknown": {},
+}
+_LITERALS = {"true": True, "false": False}
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise UnsupportedSchemaError("Unexpected character {!r} in the schema".format(text[position]))
+        position = match.end()
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, match.group()))
+    return tokens
+
+
+class _Parser(object):
+    """recursive descent parser for the supported subset of TypeScript declarations"""
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.position = 0
+        self.definitions = {}
+
+    def peek(self, offset=0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset][1]
+        return None
+
+    def next(self):
+        if self.position >= len(self.tokens):
+            raise UnsupportedSchemaError("Unexpected end of the schema")
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def expect(self, value):
+        kind, token = self.next()
+        if token != value:
+            raise UnsupportedSchemaError("Expected {!r} but found {!r}".format(value, token))
+        return token
+
+    def name(self):
+        kind, token = self.next()
+        if kind != "name":
+            raise UnsupportedSchemaError("Expected a name but found {!r}".format(token))
+        return token
+
+    def parse(self):
+        while self.position < len(self.tokens):
+            if self.peek() == ";":
+                self.next()
+                continue
+            if self.peek() == "export":
+                self.next()
+            keyword = self.name()
+            if keyword == "interface":
+                name = self.name()
+                if self.peek() in ("<", "extends"):
+                    raise UnsupportedSchemaError("Generic and extended interfaces are not supported")
+                self.definitions[name] = self.object_type()
+            elif keyword == "type":
+                name = self.name()
+                if self.peek() == "<":
+                    raise UnsupportedSchemaError("Generic type aliases are not supported")
+                self.expect("=")
+                self.definitions[name] = self.type()
+            else:
+                raise UnsupportedSchemaError("Unsupported declaration {!r}".format(keyword))
+        return self.definitions
+
+    def object_type(self):
+        self.expect("{")
+        schema = {"type": "object", "properties": {}, "required": [], "additionalProperties": False}
+        while self.peek() != "}":
+            if self.peek() == "[":
+                # index signature, [key: string]: T
+                self.next()
+                self.name()
+                self.expect(":")
+                if self.name() != "string":
+                    raise UnsupportedSchemaError("Only string index signatures are supported")
+                self.expect("]")
+                self.expect(":")
+                schema["additionalProperties"] = self.type()
+            else:
+                if self.peek() == "readonly" and self.peek(1) not in (":", "?"):
+                    self.next()
+                kind, key = self.next()
+                if kind == "string":
+                    key = json.loads('"' + key[1:-1] + '"') if key[0] == "'" else json.loads(key)
+                elif kind != "name":
+                    raise UnsupportedSchemaError("Unexpected {!r} in an object type".format(key))
+                optional = self.peek() == "?"
+                if optional:
+                    self.next()
+                if self.peek() == "(":
+                    raise UnsupportedSchemaError("Methods are not supported")
+                self.expect(":")
+                schema["properties"][key] = self.type()
+                if not optional:
+                    schema["required"].append(key)
+            if self.peek() in (";", ","):
+                self.next()
+        self.expect("}")
+        return schema
+
+    def type(self):
+        if self.peek() == "|":
+            self.next()
+        members = [self.array_type()]
+        while self.peek() == "|":
+            self.next()
+            members.append(self.array_type())
+        if self.peek() == "&":
+            raise UnsupportedSchemaError("Intersection types are not supported")
+        return members[0] if len(members) == 1 else {"anyOf": members}
+
+    def array_type(self):
+        schema = self.primary_type()
+        while self.peek() == "[" and self.peek(1) == "]":
+            self.next()
+            self.next()
+            schema = {"type": "array", "items": schema}
+        return schema
+
+    def primary_type(self):
+        kind, token = self.next()
+        if token == "(":
+            schema = self.type()
+            self.expect(")")
+            return schema
+        if token == "{":
+            self.position -= 1
+            return self.object_type()
+        if kind == "string":
+            return {"const": json.loads('"' + token[1:-1] + '"') if token[0] == "'" else json.loads(token)}
+        if kind == "number":
+            return {"const": json.loads(token)}
+        if kind != "name":
+            raise UnsupportedSchemaError("Unexpected {!r} in a type".format(token))
+        if token in _PRIMITIVES:
+            return dict(_PRIMITIVES[token])
+        if token in _LITERALS:
+            return {"const": _LITERALS[token]}
+        if token in ("Array", "ReadonlyArray", "Record"):
+            self.expect("<")
+            if token == "Record":
+                if self.name() != "string":
+                    raise UnsupportedSchemaError("Only Record<string, T> is supported")
+                self.expect(",")
+                schema = {"type": "object", "properties": {}, "required": [], "additionalProperties": self.type()}
+            else:
+                schema = {"type": "array", "items": self.type()}
+            self.expect(">")
+            return schema
+        if self.peek() == "<":
+            raise UnsupportedSchemaError("Unsupported generic type {!r}".format(token))
+        return {"$ref": "#/definitions/" + token}
+
+
+def typescript_to_json_schema(schema_text, type_name):
+    """the JSON Schema of the type type_name declared in schema_text, with the other declarations as definitions"""
+    definitions = _Parser(schema_text).parse()
+    if type_name not in definitions:
+        raise UnsupportedSchemaError("The schema does not declare {!r}".format(type_name))
+
+    def check_references(schema):
+        if "$ref" in schema and schema["$ref"].split("/")[-1] not in definitions:
+            raise UnsupportedSchemaError("Unknown type {!r}".format(schema["$ref"].split("/")[-1]))
+        for value in schema.values():
+            if isinstance(value, dict):
+                check_references(value)
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict):
+                        check_references(item)
+
+    for definition in definitions.values():
+        check_references(definition)
+    return {"$ref": "#/definitions/" + type_name, "definitions": definitions}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _dump(value, path=(), locations=None, offset=0):
+    """json.dumps(value) that also records the offset of every object key and array element by its path"""
+    if isinstance(value, dict):
+        parts = ["{"]
+        length = 1
+        for i, (key, item) in enumerate(value.items()):
+            if i > 0:
+                parts.append(", ")
+                length += 2
+            key_text = json.dumps(key)
+            locations[path + (key,)] = offset + length
+            item_text = _dump(item, path + (key,), locations, offset + length + len(key_text) + 2)
+            parts.extend([key_text, ": ", item_text])
+            length += len(key_text) + 2 + len(item_text)
+        parts.append("}")
+        return "".join(parts)
+    if isinstance(value, list):
+        parts = ["["]
+        length = 1
+        for i, item in enumerate(value):
+            if i > 0:
+                parts.append(", ")
+                length += 2
+            locations[path + (i,)] = offset + length
+            item_text = _dump(item, path + (i,), locations, offset + length)
+            parts.append(item_text)
+            length += len(item_text)
+        parts.append("]")
+        return "".join(parts)
+    return json.dumps(value)
+
+
+class CompiledSchema(object):
+    """
+    A JSON Schema compiled into nested Python checks.
+
+    validate(value) returns the tsc diagnostics of `const json: <type name> = <value>;` as tsc prints them to
+    stdout (an empty string when the value is valid). Valid values only run the compiled checks.
+
+    The diagnostics are only produced for the errors whose tsc messages are reproduced exactly: primitive values that
+    do not match a primitive type or a union of string literals, missing and unknown properties of object values,
+    and those errors in the properties and elements of object and array values. For other invalid values (a value
+    of the wrong kind for an object or array type, unions of object or array types, an object with both missing
+    and invalid properties, types long enough for tsc to shorten) validate returns None and the caller asks tsc,
+    unless exact is False.
+    """
+    def __init__(self, json_schema, type_name):
+        self.json_schema = json_schema
+        self.type_name = type_name
+        self._definitions = json_schema.get("definitions", {})
+        self._checks = {}
+        self._check = self._compile(json_schema)
+
+    # compilation
+
+    def _resolve(self, schema):
+        while "$ref" in schema:
+            schema = self._definitions[schema["$ref"].split("/")[-1]]
+        return schema
+
+    def _compile(self, schema):
+        if "$ref" in schema:
+            name = schema["$ref"].split("/")[-1]
+            if name not in self._checks:
+                # compiled lazily through the table, so recursive types terminate
+                self._checks[name] = None
+                self._checks[name] = self._compile(self._definitions[name])
+            checks = self._checks
+            return lambda value: checks[name](value)
+        if "const" in schema:
+            constant = schema["const"]
+            return lambda value: value == constant and type(value) is type(constant)
+        if "anyOf" in schema:
+            members = [self._compile(member) for member in schema["anyOf"]]
+            return lambda value: any(check(value) for check in members)
+        kind = schema.get("type")
+        if kind == "string":
+            return lambda value: isinstance(value, str)
+        if kind == "number":
+            return _is_number
+        if kind == "boolean":
+            return lambda value: isinstance(value, bool)
+        if kind == "null":
+            return lambda value: value is None
+        if kind == "array":
+            item = self._compile(schema["items"])
+            return lambda value: isinstance(value, list) and all(item(v) for v in value)
+        if kind == "object":
+            properties = {key: self._compile(sub) for key, sub in schema["properties"].items()}
+            required = schema["required"]
+            extra = schema["additionalProperties"]
+            extra = self._compile(extra) if extra is not False else None
+
+            def check_object(value):
+                if not isinstance(value, dict):
+                    return False
+                for key in required:
+                    if key not in value:
+                        return False
+                for key, item in value.items():
+                    check = properties.get(key, extra)
+                    if check is None or not check(item):
+                        return False
+                return True
+            return check_object
+        return lambda value: True
+
+    # diagnostics
+
+    def is_valid(self, value):
+        return self._check(value)
+
+    def validate(self, value, file_name="json.ts", exact=True):
+        if self._check(value):
+            return ""
+        locations = {}
+        text = _dump(value, (), locations)
+        # the module is "import { T } from './schema';\nconst json: T = <value>;"
+        start = len("const json: ") + len(self.type_name) + len(" = ") + 1
+        diagnostics = []
+        try:
+            self._diagnose(value, self.json_schema, (), True, diagnostics, exact)
+        except _Inexact:
+            return None
+        lines = []
+        for path, code, message in diagnostics:
+            column = 7 if path is None else start + locations[path]
+            lines.append("{}(2,{}): error TS{}: {}\n".format(file_name, column, code, message))
+        return "".join(lines)
+
+    def _diagnose(self, value, schema, path, top, diagnostics, exact=True):
+        """appends (path of the reported node, code, message) for why value is not assignable to schema.
+        with exact raises _Inexact for the errors tsc may report differently"""
+        location = None if top else path
+        target = self._resolve(schema)
+
+        if target.get("type") == "object" and isinstance(value, dict):
+            properties = target["properties"]
+            extra = target["additionalProperties"]
+            if extra is False:
+                for key in value:
+                    if key not in properties:
+                        name = self._name(schema)
+                        if exact and not self._exact_text(json.dumps(key), name):
+                            raise _Inexact()
+                        diagnostics.append((path + (key,), 2353, "Object literal may only specify known properties, "
+                                            "and '{}' does not exist in type '{}'.".format(json.dumps(key), name)))
+                        return
+            missing = [key for key in target["required"] if key not in value]
+            if missing:
+                if exact and not self._exact_missing(value, target, properties, extra, self._name(schema)):
+                    raise _Inexact()
+                source = self._source(value, target)
+                if len(missing) == 1:
+                    diagnostics.append((location, 2741, "Property '{}' is missing in type '{}' but required in type "
+                                        "'{}'.".format(missing[0], source, self._name(schema))))
+                elif len(missing) <= 4:
+                    diagnostics.append((location, 2739, "Type '{}' is missing the following properties from type "
+                                        "'{}': {}".format(source, self._name(schema), ", ".join(missing))))
+                else:
+                    diagnostics.append((location, 2740, "Type '{}' is missing the following properties from type "
+                                        "'{}': {}, and {} more.".format(source, self._name(schema),
+                                                                        ", ".join(missing[:4]), len(missing) - 4)))
+                return
+            for key, item in value.items():
+                sub = properties.get(key, extra)
+                if not self._compile(sub)(item):
+                    self._diagnose(item, sub, path + (key,), False, diagnostics, exact)
+            return
+
+        if target.get("type") == "array" and isinstance(value, list):
+            item_schema = target["items"]
+            check = self._compile(item_schema)
+            for i, item in enumerate(value):
+                if not check(item):
+                    self._diagnose(item, item_schema, path + (i,), False, diagnostics, exact)
+            return
+
+        source, name = self._source(value, target), self._name(schema)
+        if exact and not (isinstance(value, (str, int, float, bool, type(None))) and self._plain(target) and
+                          self._exact_text(source, name)):
+            raise _Inexact()
+        diagnostics.append((location, 2322, "Type '{}' is not assignable to type '{}'.".format(source, name)))
+
+    def _plain(self, schema):
+        """whether schema is a primitive type or a union of string literals, the targets whose 2322 messages tsc
+        words like _diagnose"""
+        schema = self._resolve(schema)
+        if "anyOf" in schema:
+            return all(isinstance(self._resolve(member).get("const"), str) for member in schema["anyOf"])
+        if "const" in schema:
+            return isinstance(schema["const"], str)
+        return schema.get("type") in ("string", "number", "boolean", "null")
+
+    def _exact_missing(self, value, target, properties, extra, name):
+        """whether tsc reports the missing properties of value like _diagnose: the other properties are valid (tsc
+        then reports those instead) and primitive (so the type tsc shows for value is the one _source builds)"""
+        for key, item in value.items():
+            if isinstance(item, (dict, list)) or not self._compile(properties.get(key, extra))(item):
+                return False
+        return self._exact_text(self._source(value, target), name)
+
+    @staticmethod
+    def _exact_text(*texts):
+        # tsc shortens long types and shows string literals unescaped
+        return all(len(text) <= MAX_TYPE_TEXT and "\\" not in text for text in texts)
+
+    def _literals(self, schema):
+        """the primitive types that schema has literal members of"""
+        schema = self._resolve(schema)
+        if "const" in schema:
+            return {type(schema["const"])}
+        if "anyOf" in schema:
+            return set().union(*(self._literals(member) for member in schema["anyOf"]))
+        return set()
+
+    def _member(self, schema, kind):
+        """the object or array member of a (union) schema"""
+        schema = self._resolve(schema)
+        if schema.get("type") == kind:
+            return schema
+        for member in schema.get("anyOf", []):
+            member = self._member(member, kind)
+            if member is not None:
+                return member
+        return None
+
+    def _source(self, value, target):
+        """how tsc shows the type of the value, literals are kept where the target has literals of that type"""
+        if value is None:
+            return "null"
+        if isinstance(value, bool):
+            return json.dumps(value) if bool in self._literals(target) else "boolean"
+        if _is_number(value):
+            return json.dumps(value) if (int in self._literals(target) or float in self._literals(target)) else "number"
+        if isinstance(value, str):
+            return json.dumps(value) if str in self._literals(target) else "string"
+        if isinstance(value, list):
+            array = self._member(target, "array")
+            items = array["items"] if array is not None else {}
+            members = []
+            for item in value:
+                member = self._source(item, items)
+                if member not in members:
+                    members.append(member)
+            if len(members) == 0:
+                return "never[]"
+            if len(members) == 1 and not members[0].startswith("{"):
+                return members[0] + "[]"
+            return "(" + " | ".join(members) + ")[]"
+        obj = self._member(target, "object")
+        properties = obj["properties"] if obj is not None else {}
+        extra = obj["additionalProperties"] if obj is not None and obj["additionalProperties"] is not False else {}
+        parts = ["{}: {};".format(_property_name(key), self._source(item, properties.get(key, extra)))
+                 for key, item in value.items()]
+        return "{ " + " ".join(parts) + " }" if parts else "{}"
+
+    def _name(self, schema, nested=False):
+        """how tsc shows the target type"""
+        if "$ref" in schema:
+            return schema["$ref"].split("/")[-1]
+        if "const" in schema:
+            return json.dumps(schema["const"])
+        if "anyOf" in schema:
+            name = " | ".join(self._name(member, True) for member in schema["anyOf"])
+            return "(" + name + ")" if nested else name
+        kind = schema.get("type")
+        if kind == "array":
+            return self._name(schema["items"], True) + "[]"
+        if kind == "object":
+            parts = ["{}{}: {};".format(_property_name(key), "" if key in schema["required"] else "?",
+                                        self._name(sub)) for key, sub in schema["properties"].items()]
+            if schema["additionalProperties"] is not False:
+                parts.append("[x: string]: {};".format(self._name(schema["additionalProperties"])))
+            return "{ " + " ".join(parts) + " }" if parts else "{}"
+        return kind if kind is not None else "any"
+
+
+def _property_name(key):
+    return key if re.match(r"^[A-Za-z_$][\w$]*$", key) else json.dumps(key)
+
+
+_compiled_schemas = {}
+
+
+def schema_hash(schema_text, type_name):
+    return hashlib.sha256((type_name + "\0" + schema_text).encode("utf-8")).hexdigest()
+
+
+def compile_schema(schema_text, type_name):
+    """the CompiledSchema of type_name in schema_text, compiled once per schema and cached by its hash.
+    raises UnsupportedSchemaError (also on later calls) when the schema cannot be converted"""
+    key = schema_hash(schema_text, type_name)
+    if key not in _compiled_schemas:
+        try:
+            _compiled_schemas[key] = CompiledSchema(typescript_to_json_schema(schema_text, type_name), type_name)
+        except UnsupportedSchemaError as error:
+            _compiled_schemas[key] = error
+    compiled = _compiled_schemas[key]
+    if isinstance(compiled, UnsupportedSchemaError):
+        raise compiled
+    return compiled
@@ -0,0 +1,137 @@
+"""
+Compares the in-process diagnostics of ts_schema.py with what tsc prints, run from the TypeChat folder:
+
+    python -m typechat.ts_schema_check [schema files or folders]
+
+For every schema (by default those in TSSchemas and typechat_schemas) a set of invalid responses is derived from the
+schema: values of the wrong kind, every property missing, of the wrong type or unknown, wrong array elements. Each
+is validated in-process and with tsc, using the options of TypeChatJsonValidator. A response is
+    exact:    the in-process diagnostics are the ones tsc prints
+    deferred: ts_schema leaves it to tsc (CompiledSchema.validate returned None)
+    MISMATCH: the in-process diagnostics differ from tsc, printed with both outputs
+The exit status is 1 when there is a mismatch, nothing is compared when tsc is not installed.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from .ts_schema import compile_schema, UnsupportedSchemaError
+from .typechat import TypeChatJsonValidator
+
+AGENT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_SCHEMAS = [os.path.join(AGENT_DIR, "TSSchemas"), os.path.join(AGENT_DIR, "typechat_schemas")]
+
+_DECLARATION = re.compile(r"export\s+(?:interface|type)\s+([A-Za-z_$][\w$]*)")
+# values of every kind, the wrong ones for a property or element are those the schema rejects
+_VALUES = ["text", 1, 0.5, True, None, {}, {"x": 1}, [], ["text"], [1]]
+
+
+def schema_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".ts"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def example(compiled, schema):
+    """a valid value of schema"""
+    schema = compiled._resolve(schema)
+    if "const" in schema:
+        return schema["const"]
+    if "anyOf" in schema:
+        return example(compiled, schema["anyOf"][0])
+    kind = schema.get("type")
+    if kind == "array":
+        return [example(compiled, schema["items"])]
+    if kind == "object":
+        return {key: example(compiled, schema["properties"][key]) for key in schema["required"]}
+    return {"string": "text", "number": 1, "boolean": True, "null": None}.get(kind, "text")
+
+
+def invalid_values(compiled):
+    """invalid responses of the schema, derived from a valid one"""
+    valid = example(compiled, compiled.json_schema)
+    values = [value for value in _VALUES if not compiled.is_valid(value)]
+    if isinstance(valid, dict):
+        keys = list(valid)
+        values.append(dict(valid, unexpected=1))
+        values.append({key: valid[key] for key in keys[1:]} if len(keys) > 1 else {})
+        for key in keys:
+            values.append({other: item for other, item in valid.items() if other != key})
+            for wrong in _VALUES:
+                value = dict(valid, **{key: wrong})
+                if not compiled.is_valid(value):
+                    values.append(value)
+                    if len(keys) > 1:
+                        # a wrong property next to a missing one
+                        dropped = keys[-1] if key == keys[0] else keys[0]
+                        values.append({other: item for other, item in value.items() if other != dropped})
+            if isinstance(valid[key], list):
+                for wrong in _VALUES:
+                    value = dict(valid, **{key: valid[key] + [wrong]})
+                    if not compiled.is_valid(value):
+                        values.append(value)
+    unique = {json.dumps(value): value for value in values if not compiled.is_valid(value)}
+    return list(unique.values())
+
+
+def compare(schema_text, type_name, basedir):
+    """yields (value, status, in-process output, tsc output) for the invalid values of the schema"""
+    compiled = compile_schema(schema_text, type_name)
+    validator = TypeChatJsonValidator(schema_text, type_name, basedir)
+    for n, value in enumerate(invalid_values(compiled)):
+        uuid = "check{}".format(n)
+        module = validator.createModuleTextFromJson(value, uuid).data
+        validator._createProgramFromModuleText(module, uuid)
+        expected = validator.getSyntacticDiagnostics(uuid).message
+        output = compiled.validate(value, file_name=f"{basedir}/out/json_{uuid}.ts")
+        if output is None:
+            status = "deferred"
+        elif output == expected:
+            status = "exact"
+        else:
+            status = "MISMATCH"
+        yield value, status, output, expected
+
+
+def main(paths):
+    if shutil.which("tsc") is None:
+        print("tsc is not installed, nothing to compare")
+        return 0
+    counts = {"exact": 0, "deferred": 0, "MISMATCH": 0}
+    with tempfile.TemporaryDirectory() as basedir:
+        os.makedirs(os.path.join(basedir, "out"))
+        for file_path in schema_files(paths):
+            with open(file_path, "r") as fh:
+                schema_text = fh.read()
+            match = _DECLARATION.search(schema_text)
+            if match is None:
+                continue
+            try:
+                results = list(compare(schema_text, match.group(1), basedir))
+            except UnsupportedSchemaError as error:
+                print("{}: not supported in-process ({}), always checked with tsc".format(file_path, error))
+                continue
+            for value, status, output, expected in results:
+                counts[status] += 1
+                if status == "MISMATCH":
+                    print("{}: MISMATCH for {!r}\n  in-process: {!r}\n  tsc:        {!r}".format(
+                        file_path, value, output, expected))
+            print("{}: {} invalid responses, {} exact, {} deferred to tsc".format(
+                file_path, len(results), sum(r[1] == "exact" for r in results), sum(r[1] == "deferred" for r in results)))
+    print(counts)
+    return 1 if counts["MISMATCH"] > 0 else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the in-process TypeChat diagnostics with tsc")
+    parser.add_argument("paths", nargs="*", default=DEFAULT_SCHEMAS, help="schema files or folders of schemas")
+    sys.exit(main(parser.parse_args().paths))
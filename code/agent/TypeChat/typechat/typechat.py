@@ -5,9 +5,15 @@ import os
 import time
 import json
 import subprocess
+import shutil
 import base64
 import requests
 import json
+from .ts_schema import compile_schema, schema_hash, UnsupportedSchemaError
+from .ts_daemon import get_daemon
+from .llm_client import get_llm_client, backend_name, backoff_delay, LLMRequestError
+
+LIB_DECLARATIONS = "interface Array<T> { length: number, [n: number]: T }\ninterface Object { toString(): string }\ninterface Function { prototype: unknown }\ninterface CallableFunction extends Function {}\ninterface NewableFunction extends Function {}\ninterface String { readonly length: number }\ninterface Boolean { valueOf(): boolean }\ninterface Number { valueOf(): number }\ninterface RegExp { test(string: string): boolean }"
 
 class TypeChatResult():
     def __init__(self):
@@ -59,18 +65,11 @@ class TypeChatLanguageModel():
         self._temperature = temperature
         self._context_length = context_length
 
-        self._client = None
-        if api_base:
-            self._client = openai.OpenAI(
-                organization=org_key if org_key else None,
-                api_key=api_key if api_key else "EMPTY",
-                base_url=api_base
-            )
-        else:
-            self._client = openai.OpenAI(
-                organization=org_key if org_key else None,
-                api_key=api_key if api_key else "EMPTY"
-            )
+        # the requests go through the LLM client shared by the process (keep-alive connections, limits, backoff)
+        self._org_key = org_key if org_key else None
+        self._api_key = api_key if api_key else "EMPTY"
+        self._backend = backend_name(api_base, use_ollama)
+        self._client = get_llm_client()
     
     def _remove_think_content(self, text):
         """
@@ -87,15 +86,20 @@ class TypeChatLanguageModel():
         return self._use_chat
     
     def _completeOpenAI(self, msgs):
+        # a request is retried up to retryMaxAttempts times, with a jittered backoff of at most retryPauseSec
+        request = dict(base_url=self._api_base, api_key=self._api_key, organization=self._org_key,
+                       max_attempts=self._retryMaxAttempts, max_delay=self._retryPauseSec)
         if "o1" in self._model_name or "o3" in self._model_name or "o4" in self._model_name:
-            completion = self._client.chat.completions.create(
+            completion = self._client.chat_completion_sync(
+                self._backend, **request,
                 model=self._model_name,
                 messages = msgs,
                 max_completion_tokens=self._context_length,
                 temperature=self._temperature,
             )
         elif self._use_json_mode:
-            completion = self._client.chat.completions.create(
+            completion = self._client.chat_completion_sync(
+                self._backend, **request,
                 model=self._model_name,
                 messages = msgs,
                 max_tokens=self._context_length,
@@ -103,7 +107,8 @@ class TypeChatLanguageModel():
                 response_format={ "type": "json_object" },
             )
         else:
-            completion = self._client.chat.completions.create(
+            completion = self._client.chat_completion_sync(
+                self._backend, **request,
                 model=self._model_name,
                 messages = msgs,
                 max_tokens=self._context_length,
@@ -119,9 +124,8 @@ class TypeChatLanguageModel():
         }
         if self._use_json_mode:
             data["format"] = "json"
-        data_json = json.dumps(data)
-        response = requests.post(self._api_base, data=data_json, headers={'Content-Type': 'application/json'})
-        response_json = json.loads(response.text)
+        response_json = self._client.post_json_sync(self._backend, self._api_base, data,
+                                                    max_attempts=self._retryMaxAttempts, max_delay=self._retryPauseSec)
         response = response_json["message"]["content"]
         return response
 
@@ -177,6 +181,12 @@ class TypeChatLanguageModel():
                     # result.message = ""
                     # # print("LLM:", result.data)
                     # return result
+            except LLMRequestError as error:
+                # the client has retried the request already
+                print("Error:", error)
+                result.success = False
+                result.message = str(error)
+                break
             except Exception as error:
                 print("Error:", error, "Retry count:", self._retryMaxAttempts-i)
                 result.success = False
@@ -184,7 +194,7 @@ class TypeChatLanguageModel():
 
                 # self.save_raw_api_response(msgs, raw_api_response, error)
 
-                time.sleep(self._retryPauseSec)
+                time.sleep(backoff_delay(i, max_delay=self._retryPauseSec))
         return result
     
     # def save_raw_api_response(self, msgs, raw_api_response, error):
@@ -377,6 +387,12 @@ class TypeChatJsonValidator():
         ]
 
         # self._rootProgram = self._createProgramFromModuleText("", "test")
+
+        # schemas in the supported subset of TypeScript are validated in-process, the others with tsc
+        try:
+            self._compiled = compile_schema(schema, name)
+        except UnsupportedSchemaError:
+            self._compiled = None
     
     def getTypeName(self):
         return self._typeName
@@ -386,7 +402,7 @@ class TypeChatJsonValidator():
     
     def _createProgramFromModuleText(self, moduleText, uuid, oldProgram=None):
         with open(f"{self._basedir}/out/lib_{uuid}.d.ts", "w") as fh:
-            fh.write("interface Array<T> { length: number, [n: number]: T }\ninterface Object { toString(): string }\ninterface Function { prototype: unknown }\ninterface CallableFunction extends Function {}\ninterface NewableFunction extends Function {}\ninterface String { readonly length: number }\ninterface Boolean { valueOf(): boolean }\ninterface Number { valueOf(): number }\ninterface RegExp { test(string: string): boolean }")
+            fh.write(LIB_DECLARATIONS)
         
         with open(f"{self._basedir}/out/schema_{uuid}.ts", "w") as fh:
             fh.write(self._schema)
@@ -417,6 +433,21 @@ class TypeChatJsonValidator():
         # generate uuid
         uuid = str(shortuuid.uuid())
 
+        # in-process, unless the value is invalid in a way whose tsc diagnostics ts_schema does not reproduce
+        if self._compiled is not None:
+            message = self._compiled.validate(jsonObject, file_name=f"{self._basedir}/out/json_{uuid}.ts")
+            if message is not None:
+                return self._compiledResult(jsonObject, message)
+
+        result = self._checkWithDaemon(jsonObject, uuid)
+        if result is not None:
+            return result
+
+        if self._compiled is not None and shutil.which("tsc") is None:
+            # no tsc to ask, the in-process diagnostics are close enough for a repair prompt
+            message = self._compiled.validate(jsonObject, file_name=f"{self._basedir}/out/json_{uuid}.ts", exact=False)
+            return self._compiledResult(jsonObject, message)
+
         moduleResult = self.createModuleTextFromJson(jsonObject, uuid)  
 
         if not moduleResult.success:
@@ -431,6 +462,33 @@ class TypeChatJsonValidator():
         result.data = jsonObject
         return result
     
+    def _compiledResult(self, jsonObject, message):
+        result = TypeChatResult()
+        result.message = message
+        result.success = message == ""
+        if result.success:
+            result.data = jsonObject
+        return result
+
+    def _checkWithDaemon(self, jsonObject, uuid):
+        """type checks with the shared validator daemon (see ts_daemon.py), None if it is not available.
+        The schema and lib files are named by the schema hash, the daemon keeps them loaded between calls"""
+        schemaId = schema_hash(self._schema, self._typeName)[:16]
+        moduleResult = self.createModuleTextFromJson(jsonObject, schemaId)
+        checked = get_daemon().check(schemaId, self._schema,
+                                     f"{self._basedir}/out/schema_{schemaId}.ts",
+                                     f"{self._basedir}/out/lib_{schemaId}.d.ts", LIB_DECLARATIONS,
+                                     f"{self._basedir}/out/json_{uuid}.ts", moduleResult.data, self._options)
+        if checked is None:
+            return None
+        result = TypeChatResult()
+        result.success, output = checked
+        if result.success:
+            result.data = jsonObject
+        else:
+            result.message = output
+        return result
+
     def getSyntacticDiagnostics(self, uuid):
         command = ["tsc", f"{self._basedir}/out/json_{uuid}.ts", f"{self._basedir}/out/lib_{uuid}.d.ts", f"{self._basedir}/out/schema_{uuid}.ts"] + self._options
         res = subprocess.run(command, stdout=subprocess.PIPE, text=True)
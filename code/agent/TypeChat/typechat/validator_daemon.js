@@ -0,0 +1,118 @@
+// Long lived TypeScript validator for TypeChat, started by ts_daemon.py:
+//
+//     node validator_daemon.js <path of the typescript module>
+//
+// Reads one JSON request per line on stdin and answers with one JSON line on stdout:
+//     request:  {"id", "hash", "schema" (only needed the first time a hash is sent), "schemaFile", "libFile",
+//                "libText", "jsonFile", "json", "args"}
+//     response: {"id", "success", "output"} where output is what tsc prints for the same files and arguments,
+//               or {"id", "error"} ("unknown schema" asks for the request again with the schema text)
+// The files only exist in memory. The parsed default lib files, the schema and lib declarations (by schema hash)
+// and the last program of every schema are kept between requests, so a request only parses the json module.
+
+const readline = require("readline");
+const ts = require(process.argv[2] || "typescript");
+
+const schemas = new Map();       // schema hash -> {schemaFile, schema, libFile, libText}
+const sourceFiles = new Map();   // file name -> parsed SourceFile of the lib and schema files
+const programs = new Map();      // schema hash -> last Program, reused by the next program of that schema
+const optionsCache = new Map();  // arguments -> parsed compiler options
+
+function parseOptions(args) {
+    const key = JSON.stringify(args);
+    if (!optionsCache.has(key)) {
+        optionsCache.set(key, ts.parseCommandLine(args).options);
+    }
+    return optionsCache.get(key);
+}
+
+function createHost(options, files) {
+    const host = ts.createCompilerHost(options);
+    const readFile = host.readFile;
+    const fileExists = host.fileExists;
+
+    host.fileExists = (fileName) => files.has(ts.normalizePath(fileName)) || fileExists.call(host, fileName);
+    host.readFile = (fileName) => {
+        const name = ts.normalizePath(fileName);
+        return files.has(name) ? files.get(name).text : readFile.call(host, fileName);
+    };
+    host.getSourceFile = (fileName, languageVersion, onError) => {
+        const name = ts.normalizePath(fileName);
+        const file = files.get(name);
+        if (file !== undefined && !file.cache) {
+            return ts.createSourceFile(name, file.text, languageVersion);
+        }
+        const key = name + "\0" + languageVersion;
+        if (!sourceFiles.has(key)) {
+            const text = file !== undefined ? file.text : readFile.call(host, fileName);
+            if (text === undefined) {
+                if (onError) {
+                    onError("File not found: " + fileName);
+                }
+                return undefined;
+            }
+            sourceFiles.set(key, ts.createSourceFile(name, text, languageVersion));
+        }
+        return sourceFiles.get(key);
+    };
+    host.writeFile = () => {};
+    return host;
+}
+
+// the diagnostics tsc reports and the way it prints them without --pretty
+function check(request) {
+    const schema = schemas.get(request.hash);
+    const options = parseOptions(request.args);
+    const files = new Map([
+        [ts.normalizePath(schema.schemaFile), {text: schema.schema, cache: true}],
+        [ts.normalizePath(schema.libFile), {text: schema.libText, cache: true}],
+        [ts.normalizePath(request.jsonFile), {text: request.json, cache: false}],
+    ]);
+    const host = createHost(options, files);
+    const program = ts.createProgram({
+        rootNames: [request.jsonFile, schema.libFile, schema.schemaFile],
+        options: options,
+        host: host,
+        oldProgram: programs.get(request.hash),
+    });
+    programs.set(request.hash, program);
+
+    let diagnostics = program.getConfigFileParsingDiagnostics().slice();
+    diagnostics.push(...program.getOptionsDiagnostics(), ...program.getSyntacticDiagnostics());
+    if (diagnostics.length === 0) {
+        diagnostics.push(...program.getGlobalDiagnostics(), ...program.getSemanticDiagnostics());
+        if (options.declaration) {
+            diagnostics.push(...program.getDeclarationDiagnostics());
+        }
+    }
+    diagnostics = ts.sortAndDeduplicateDiagnostics(diagnostics);
+
+    const formatHost = {
+        getCanonicalFileName: (fileName) => host.getCanonicalFileName(fileName),
+        getCurrentDirectory: () => host.getCurrentDirectory(),
+        getNewLine: () => "\n",
+    };
+    const errors = diagnostics.filter((d) => d.category === ts.DiagnosticCategory.Error);
+    return {success: errors.length === 0, output: ts.formatDiagnostics(diagnostics, formatHost)};
+}
+
+const lines = readline.createInterface({input: process.stdin, terminal: false});
+lines.on("line", (line) => {
+    let response;
+    let request = {};
+    try {
+        request = JSON.parse(line);
+        if (request.schema !== undefined) {
+            schemas.set(request.hash, {schemaFile: request.schemaFile, schema: request.schema,
+                                       libFile: request.libFile, libText: request.libText});
+        }
+        if (!schemas.has(request.hash)) {
+            response = {id: request.id, error: "unknown schema"};
+        } else {
+            response = Object.assign({id: request.id}, check(request));
+        }
+    } catch (error) {
+        response = {id: request.id, error: String(error && error.stack || error)};
+    }
+    process.stdout.write(JSON.stringify(response) + "\n");
+});
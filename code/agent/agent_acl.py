@@ -2,9 +2,9 @@ import json
 from agent_base import BaseAgent, LLM, LLM, ATEAM, AROLE
 from messages import Message, AvalonGameStateUpdate, Task, AvalonGameState
 import random
-from itertools import combinations
 import time
 from our.model_reduced_categories import FactorGraphModelV2
+from our.game_spec import SIX_PLAYER_GAME
 from our.policy_models.heuristic import HeuristicOracle
 import os
 import csv
@@ -14,7 +14,8 @@ from our.prompts import PromptHint
 
 class GameInfo():
     """A class to save and store information about the state of the game"""
-    def __init__(self):
+    def __init__(self, spec=SIX_PLAYER_GAME):
+        self.spec = spec # the number of players, evil players and quest sizes of the game
         self.players_to_index = {}
         self.index_to_players = {}
         self.state = AvalonGameState()
@@ -25,16 +26,14 @@ class GameInfo():
         # votes within the proposals should be in the form of {name:true/false, ...}
         # each proposal entry should be in the form of {'comp': [name1, name2, ...], 'votes': {name1: True, name2: False, ...}}
         # this only contains the parties that have been voted on
-        self.quest_proposals = {
-            1: [], 2: [], 3: [], 4: [], 5: []
-        }
+        self.quest_proposals = {quest: [] for quest in range(1, spec.num_quests + 1)}
         self.quest_results = [] # True for success, False for fail
         self.current_party_rejects = []
     
     def add_party_proposal(self, party_comp, party_votes, quest_number):
         self.quest_proposals[quest_number].append({'comp': [name.lower() for name in party_comp],
                                                    'votes': party_votes})
-        if sum(party_votes.values()) > 3: # the party has been accepted
+        if sum(party_votes.values()) > self.spec.num_players // 2: # the party has been accepted
             self.current_party_rejects = []
             print( f"Party {party_comp} has been accepted for quest {quest_number} with votes: {party_votes}")
         else:
@@ -46,24 +45,19 @@ class GameInfo():
     
     def get_state_vector(self):
         """Turns the game state into a vector to be used by the graphical model"""
-        roles = [0, 0, 0, 0, 0, 0]
+        roles = [0,] * self.spec.num_players
         state_vector = roles
 
-        possible_vote_compositions = [] # this variable is used to find the index of the votes composition
-        for L in range(4, 6 + 1): 
-            for subset in combinations([1,2,3,4,5,6], L):
-                possible_vote_compositions.append(subset)
-
-        for i in range(5):  # add each quest information to the array
+        for i in range(self.spec.num_quests):  # add each quest information to the array
             if i < len(self.quest_results): # this quest has not finished yet.
                 party = self.quest_proposals[i+1][-1]['comp']
                 votes = self.quest_proposals[i+1][-1]['votes']
                 print("+++++++++", party, votes)
-                party_numbers = tuple(sorted([self.players_to_index[name.lower()] for name in party]))
-                vote_numbers = tuple(sorted([self.players_to_index[name.lower()] for name in votes if votes[name.lower()]]))
-                party_index = list(combinations([1,2,3,4,5,6], len(party_numbers))).index(party_numbers)
-                vote_index = possible_vote_compositions.index(vote_numbers)
-                quest_vector = [party_index+1, vote_index+1, int(self.quest_results[i])+1]
+                # players are numbered from 1 in the game and from 0 in the spec
+                party_numbers = [self.players_to_index[name.lower()] - 1 for name in party]
+                vote_numbers = [self.players_to_index[name.lower()] - 1 for name in votes if votes[name.lower()]]
+                quest_vector = [self.spec.party_index(party_numbers, i), self.spec.vote_index(vote_numbers),
+                                int(self.quest_results[i])+1]
             else:
                 quest_vector = [0, 0, 0]
             state_vector.extend(quest_vector)
@@ -100,7 +94,8 @@ class ACLAgent(BaseAgent):
         self._team = (
             ATEAM.EVIL if self._role in [AROLE.MORGANA, AROLE.ASSASSIN] else ATEAM.GOOD # good is 1, evil is 2
         )
-        self.graph_model = FactorGraphModelV2()
+        # with belief_cache_path the beliefs are kept across games in that file, saved at the end of every game
+        self.graph_model = FactorGraphModelV2(cache_path=self._config["agent"].get("belief_cache_path"))
         self.graph_model.construct()
         self.graph_model.load_from_file()
 
@@ -226,6 +221,10 @@ class ACLAgent(BaseAgent):
                     self.game_log.append([pname, actual_msg])
                     self.log(f"{pname}: {actual_msg}\n")
 
+        if self.state_diff.get("winner"):
+            self.debug(f"########### Game over, winner: {self.state_diff['winner']}\n")
+            self.graph_model.belief_cache.save()
+
         return {}
 
     def addPrivateData(self, data):
@@ -255,10 +254,12 @@ class ACLAgent(BaseAgent):
         state_vector = self.game.get_state_vector()
         self.debug(f"-- Updating beliefs with state vector: {state_vector} \n")
         index = self.game.players_to_index[self._name.lower()] - 1
-        probabilities = self.graph_model.predict_probs(game_state=state_vector, self_role=self._team, self_index=index, algorithm="max")
-        self.latest_probabilities = {self.game.index_to_players[i+1]: probabilities[i+1] for i in range(6)}
+        # warm start from the previous beliefs, usually only the newest quest or the priors changed since then
+        probabilities = self.graph_model.predict_probs(game_state=state_vector, self_role=self._team, self_index=index, algorithm="max", warm_start=True)
+        self.latest_probabilities = {self.game.index_to_players[i+1]: probabilities[i+1] for i in range(len(probabilities))}
         self.quest_updated = False
         self.debug(f"       -- BELIEF UPDATED: {self.latest_probabilities}\n")
+        self.debug(f"       -- belief cache: {self.graph_model.belief_cache.stats()}\n")
         if with_llm_prior:
             self.log (f" ***  BELIEFS with Vibes: {self.latest_probabilities}\n")
         else:
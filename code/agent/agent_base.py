@@ -6,11 +6,12 @@ from messages import (
     Task,
     AvalonGameState,
 )
-from openai import OpenAI
 import hashlib
 import json
 from TypeChat.typechat.typechat import TypeChatResult
+from TypeChat.typechat.llm_client import configure_llm_client, backend_name
 from utils import bcolors
+from llm_cache import open_cache
 from enum import Enum
 import os
 
@@ -48,8 +49,9 @@ class BaseAgent(object):
         self._gid = game_id
         self._name = agent_name
         self._config = config
-        # OpenAI Setup, redirected to our local servers...
-        self._llm_local = OpenAI(api_key="EMPTY", base_url="http://ollama:11434/v1")
+        # OpenAI Setup, redirected to our local servers... (the requests go through the LLM client of the process)
+        self._llm = configure_llm_client(self._config["agent"].get("llm_client"))
+        self._llm_local = {"base_url": "http://ollama:11434/v1", "api_key": "EMPTY"}
         self._model_local = self._config["agent"]["local_model"]
         # self._model_local = "gemma2:9b"
 
@@ -57,23 +59,23 @@ class BaseAgent(object):
         if "deepseek" in self._config["agent"]["model"]:
             api_key=os.environ.get("DEEPSEEK_API_KEY", "")
 
-        self._llm_gpt = OpenAI(
-            api_key=api_key,
-            base_url=self._config["agent"]["openai_base_url"],
-        )
+        self._llm_gpt = {
+            "base_url": self._config["agent"]["openai_base_url"],
+            "api_key": api_key,
+        }
         self._model_gpt = self._config["agent"]["model"]  # gpt-4-1106-preview, gpt-3.5-turbo-1106
 
-        self._llm_deepseek = OpenAI(
-            api_key=api_key,
+        self._llm_deepseek = {
+            "api_key": api_key,
             # base_url="http://localhost:11434/api/generate",
-            base_url = 'https://api.deepseek.com',
-        )
+            "base_url": 'https://api.deepseek.com',
+        }
         self._model_deepseek = self._config["agent"]["model"]
 
-        # Cache setup
-        self._cache = {}
-        with open("cache.json", "r") as fh:
-            self._cache = json.load(fh)
+        # Cache setup, only the GPT responses are cached unless config["agent"]["cache"]["llms"] says otherwise
+        cache_config = self._config["agent"].get("cache", {})
+        self._cache = open_cache(cache_config)
+        self._cached_llms = {LLM[name.upper()] for name in cache_config.get("llms", ["gpt"])}
 
         # State tracker
         self.state = AvalonGameState()
@@ -246,35 +248,32 @@ class BaseAgent(object):
         prompt_hash = hashlib.sha256(
             (prompt + f" LLM {self._use_llm}").encode("utf-8")
         ).hexdigest()
-        # Check if the prompt is in the cache
-        if self._cacheExists(prompt_hash):
-            # If it is, load it from the cache, but also print a warning
+        # Check if the prompt is in the cache (a single lookup, the entry is loaded if it is)
+        res = self._loadCache(prompt_hash)
+        if res is not None:
+            # If it is, use the cached result, but also print a warning
             print(bcolors.WARNING + "Using query cache hit" + bcolors.ENDC)
-            return self._loadCache(prompt_hash)
+            return res
         else:
             # Otherwise, run the inference
             response = tns.translate(prompt, image=None, return_query=False)
             # And save it to the cache
-            if llm == LLM.GPT:  # Save cache only for GPT (because it costs money...)
+            if llm in self._cached_llms:  # By default only GPT (because it costs money...)
                 self._saveCache(prompt_hash, response)
             return response
 
-    # This function checks if a prompt is in the cache
-    def _cacheExists(self, prompt_hash):
-        return prompt_hash in self._cache
-
-    # This function loads a prompt from the cache
+    # This function loads a prompt from the cache, None if it is not cached
     def _loadCache(self, prompt_hash):
+        cached = self._cache.get(prompt_hash)
+        if cached is None:
+            return None
         res = TypeChatResult()
-        res.from_dict(self._cache[prompt_hash])
+        res.from_dict(cached)
         return res
 
-    # This function saves a prompt to the cache
+    # This function saves a prompt to the cache (only this entry is written, see llm_cache.py)
     def _saveCache(self, prompt_hash, response):
-        self._cache[prompt_hash] = response.to_dict()
-        # Save the cache to disk
-        with open("cache.json", "w+") as fh:
-            json.dump(self._cache, fh, indent=4)
+        self._cache.put(prompt_hash, response.to_dict())
 
     # Implements a simple OpenAI interface... this may be mostly for testing atm
     def _llm_generate(
@@ -294,7 +293,9 @@ class BaseAgent(object):
         # Run the LLM
         completion = None
         if model == LLM.LOCAL:
-            completion = self._llm_local.chat.completions.create(
+            completion = self._llm.chat_completion_sync(
+                "local",
+                **self._llm_local,
                 model=self._model_local,
                 messages=message,
                 max_tokens=max_tokens,
@@ -303,14 +304,18 @@ class BaseAgent(object):
             )
         elif model == LLM.GPT:
             if self._model_gpt == "deepseek-reasoner":
-                    completion = self._llm_gpt.chat.completions.create(
+                    completion = self._llm.chat_completion_sync(
+                    backend_name(self._llm_gpt["base_url"]),
+                    **self._llm_gpt,
                     model=self._model_gpt,
                     messages=message,
                     max_tokens=max_tokens,
                     temperature=temperature,
                 )
             else:
-                completion = self._llm_gpt.chat.completions.create(
+                completion = self._llm.chat_completion_sync(
+                    backend_name(self._llm_gpt["base_url"]),
+                    **self._llm_gpt,
                     model=self._model_gpt,
                     messages=message,
                     max_tokens=max_tokens,
@@ -319,7 +324,9 @@ class BaseAgent(object):
                 )
         
         elif model == LLM.DEEPSEEK:
-            completion = self._llm_deepseek.chat.completions.create(
+            completion = self._llm.chat_completion_sync(
+                "deepseek",
+                **self._llm_deepseek,
                 model=self._model_deepseek,
                 messages=message,
                 max_tokens=max_tokens,
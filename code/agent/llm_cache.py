@@ -0,0 +1,303 @@
+# Persistent cache of the LLM responses of the agents, keyed by the sha256 hash of the prompt and the LLM
+# (see BaseAgent._cacheOrInference). Several agent processes can share one cache file: every insert only writes its
+# own entry, lookups read one entry instead of loading the whole cache, and the cache is kept under a number of
+# entries and/or bytes by evicting the least recently used entries.
+#
+# Two backends:
+#   "sqlite": one SQLite database in WAL mode (the default), readers never block the writer
+#   "log":    an append only JSON lines file with an in-memory index of the offsets, for file systems where SQLite
+#             locking is not available; it is compacted when it grows past its bounds
+# and "none" to disable caching. The config is config["agent"]["cache"], see open_cache.
+
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# the fraction of the bounds an eviction leaves, so that not every insert past the bound evicts
+EVICT_TO = 0.9
+
+
+class LLMCache(object):
+    def get(self, key):
+        """the cached value (a dict) of the key, or None"""
+        raise NotImplementedError("get must be implemented by all caches")
+
+    def put(self, key, value):
+        """stores the value (a json serializable dict) under the key"""
+        raise NotImplementedError("put must be implemented by all caches")
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def close(self):
+        pass
+
+
+class NoCache(LLMCache):
+    def get(self, key):
+        return None
+
+    def put(self, key, value):
+        pass
+
+
+class SQLiteCache(LLMCache):
+    def __init__(self, path, max_entries=None, max_bytes=None, timeout=30.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # autocommit mode, the transactions are explicit
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                             "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            # the number of entries and their total size, kept up to date by put so that it does not count the table
+            self._db.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                             "entries INTEGER NOT NULL, bytes INTEGER NOT NULL)")
+            self._db.execute("INSERT OR IGNORE INTO totals SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM entries")
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.max_entries is not None or self.max_bytes is not None:
+                # the recency only matters for the eviction
+                self._db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        text = json.dumps(value)
+        size = len(text)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                old = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (key, text, size, time.time()))
+                if old is None:
+                    self._db.execute("UPDATE totals SET entries = entries + 1, bytes = bytes + ?", (size,))
+                else:
+                    self._db.execute("UPDATE totals SET bytes = bytes + ?", (size - old[0],))
+                self._evict()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _evict(self):
+        entries, total = self._db.execute("SELECT entries, bytes FROM totals").fetchone()
+        if not self._over(entries, total):
+            return
+        target_entries = None if self.max_entries is None else int(self.max_entries * EVICT_TO)
+        target_bytes = None if self.max_bytes is None else int(self.max_bytes * EVICT_TO)
+        removed, removed_bytes = [], 0
+        for key, size in self._db.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if ((target_entries is None or entries - len(removed) <= target_entries) and
+                    (target_bytes is None or total - removed_bytes <= target_bytes)):
+                break
+            removed.append((key,))
+            removed_bytes += size
+        self._db.executemany("DELETE FROM entries WHERE key = ?", removed)
+        self._db.execute("UPDATE totals SET entries = entries - ?, bytes = bytes - ?", (len(removed), removed_bytes))
+
+    def _over(self, entries, total):
+        return ((self.max_entries is not None and entries > self.max_entries) or
+                (self.max_bytes is not None and total > self.max_bytes))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT entries FROM totals").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class AppendLogCache(LLMCache):
+    """
+    One {"key", "value"} json line per insert, appended under an exclusive lock of the file. The index maps the keys
+    to the offset and length of their newest line; it is built once when the cache is opened and catches up with the
+    lines other processes appended when a key is missing. Past the bounds, the newest entries are rewritten to a new
+    file that replaces the log (the recency of a log entry is the time it was written).
+    """
+    def __init__(self, path, max_entries=None, max_bytes=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = {}
+        self._read_to = 0
+        self._inode = None
+        self._fh = None
+        with self._lock:
+            self._open()
+
+    def _open(self):
+        if self._fh is not None:
+            self._fh.close()
+        self._fh = open(self.path, "a+b")
+        self._inode = os.fstat(self._fh.fileno()).st_ino
+        self._index = {}
+        self._read_to = 0
+
+    def _catch_up(self):
+        """indexes the lines appended since the last call, reopens the log when it was compacted"""
+        try:
+            if os.stat(self.path).st_ino != self._inode:
+                self._open()
+        except FileNotFoundError:
+            self._open()
+        self._fh.seek(self._read_to)
+        offset = self._read_to
+        for line in self._fh:
+            if not line.endswith(b"\n"):
+                break  # a line that is still being written
+            try:
+                key = json.loads(line)["key"]
+            except (ValueError, KeyError):
+                key = None
+            if key is not None:
+                self._index[key] = (offset, len(line))
+            offset += len(line)
+        self._read_to = offset
+
+    def _read(self, key):
+        offset, length = self._index[key]
+        self._fh.seek(offset)
+        entry = json.loads(self._fh.read(length))
+        if entry["key"] != key:
+            raise KeyError(key)
+        return entry["value"]
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._index:
+                self._catch_up()
+                if key not in self._index:
+                    return None
+            try:
+                return self._read(key)
+            except (ValueError, KeyError):
+                # compacted by another process since the index was built
+                self._catch_up()
+                return self._read(key) if key in self._index else None
+
+    def put(self, key, value):
+        line = (json.dumps({"key": key, "value": value}) + "\n").encode("utf-8")
+        with self._lock:
+            # lock the file the path names, another process may have replaced it while we waited for the lock
+            while True:
+                fh = self._fh
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+                if os.stat(self.path).st_ino == self._inode:
+                    break
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+                self._open()
+            try:
+                self._catch_up()
+                fh.seek(0, os.SEEK_END)
+                fh.write(line)
+                fh.flush()
+                self._catch_up()
+                if self._over(len(self._index), self._read_to):
+                    self._compact()
+            finally:
+                # still the lock of the replaced file after a compaction, the processes waiting on it retry
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+                if fh is not self._fh:
+                    fh.close()
+
+    def _over(self, entries, total):
+        return ((self.max_entries is not None and entries > self.max_entries) or
+                (self.max_bytes is not None and total > self.max_bytes))
+
+    def _compact(self):
+        # the newest entries that fit in the bounds
+        entries = sorted(self._index.values(), reverse=True)
+        kept, size = [], 0
+        for offset, length in entries:
+            if ((self.max_entries is not None and len(kept) + 1 > self.max_entries * EVICT_TO) or
+                    (self.max_bytes is not None and size + length > self.max_bytes * EVICT_TO)):
+                break
+            kept.append((offset, length))
+            size += length
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as out:
+            for offset, length in reversed(kept):
+                self._fh.seek(offset)
+                out.write(self._fh.read(length))
+        os.replace(tmp_path, self.path)
+        # the caller closes the replaced file once it released its lock
+        self._fh = open(self.path, "a+b")
+        self._inode = os.fstat(self._fh.fileno()).st_ino
+        self._index = {}
+        self._read_to = 0
+        self._catch_up()
+
+    def __len__(self):
+        with self._lock:
+            self._catch_up()
+            return len(self._index)
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+
+def import_json_cache(cache, json_path):
+    """adds the entries of a cache.json written by the previous BaseAgent cache that the cache does not have"""
+    if not os.path.exists(json_path):
+        return 0
+    try:
+        with open(json_path, "r") as fh:
+            entries = json.load(fh)
+    except ValueError:
+        return 0
+    added = 0
+    for key, value in entries.items():
+        if cache.get(key) is None:
+            cache.put(key, value)
+            added += 1
+    return added
+
+
+def open_cache(config=None):
+    """
+    The cache described by config (config["agent"]["cache"]), with the keys
+        backend:     "sqlite" (default), "log" or "none"
+        path:        the cache file, "cache.db" (sqlite) or "cache.jsonl" (log) in the working folder by default
+        max_entries: the number of entries kept, unbounded by default
+        max_bytes:   the total size of the cached values kept, unbounded by default
+        import_json: a cache.json of the previous cache to import when the cache is created, "cache.json" by default
+    """
+    config = config or {}
+    backend = config.get("backend", "sqlite")
+    if backend == "none":
+        return NoCache()
+    if backend == "sqlite":
+        path = config.get("path", "cache.db")
+        created = not os.path.exists(path)
+        cache = SQLiteCache(path, config.get("max_entries"), config.get("max_bytes"))
+    elif backend == "log":
+        path = config.get("path", "cache.jsonl")
+        created = not os.path.exists(path)
+        cache = AppendLogCache(path, config.get("max_entries"), config.get("max_bytes"))
+    else:
+        raise ValueError("Unknown cache backend", backend)
+    if created and config.get("import_json", "cache.json"):
+        import_json_cache(cache, config.get("import_json", "cache.json"))
+    return cache
@@ -54,6 +54,14 @@ class BaselModel(object):
 
         raise NotImplementedError("Must be implemented in subclass")
     
+    def predict_probs_batch(self, states, roles, indices, algorithm="max"):
+        """
+        Batched version of predict_probs, the i-th state is seen by the player with roles[i] and indices[i]
+        returns a list of dictionaries in the same format as predict_probs
+        """
+
+        raise NotImplementedError("Must be implemented in subclass")
+    
     
     def update_priors(self, priors):
         """Update the priors of the model"""
@@ -0,0 +1,87 @@
+import atexit
+import json
+import os
+from collections import OrderedDict
+
+
+class BeliefCache(object):
+    """A bounded LRU cache of belief propagation results, optionally backed by a json file on disk.
+
+    Keys are built with make_key from everything the result depends on: the canonical masked state,
+    the role and index of the player, the prior table, the algorithm and the fingerprint of the model weights.
+    Values are the per-player results in the format of predict_probs: {1: {'good': 0.5, 'evil': 0.5}, ...}
+    With a path the cache is saved when the process exits, or earlier by calling save().
+    """
+    def __init__(self, max_size=4096, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+        if self.path is not None:
+            for key, value in self._read():
+                self.put(key, value)
+            atexit.register(self.save)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r") as fh:
+            return [(tuple(key), {int(k): v for k, v in value.items()}) for key, value in json.load(fh)]
+
+    @staticmethod
+    def make_key(game_state, self_index, self_role, priors, algorithm, num_players=6, weights=None):
+        """builds the key of a state. the role of other players is unknown, so only the own role is kept.
+        weights is the fingerprint of the model weights the result was computed with"""
+        canonical = tuple(int(v) if i >= num_players or i == self_index else 0 for i, v in enumerate(game_state))
+        return canonical + (self_index, self_role.value, algorithm) + tuple(round(p, 6) for p in priors) + (weights,)
+
+    def get(self, key):
+        """returns a copy of the cached result, or None if the key is not in the cache"""
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return {k: dict(v) for k, v in self._entries[key].items()}
+
+    def put(self, key, result):
+        if self.max_size <= 0:
+            return
+
+        self._entries[key] = {k: dict(v) for k, v in result.items()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        """writes the cache to its file, replacing the old file in one step so readers never see a partial file.
+        the entries another cache saved to the file in the meantime are kept, as the least recently used"""
+        if self.path is None:
+            return
+
+        entries = OrderedDict((key, value) for key, value in self._read() if key not in self._entries)
+        entries.update(self._entries)
+        entries = list(entries.items())[-self.max_size:] if self.max_size > 0 else []
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump([[list(key), value] for key, value in entries], fh)
+        os.replace(tmp_path, self.path)
+
+    def clear(self, weights=None):
+        """drops every result, or with weights only those computed with other model weights (see make_key)"""
+        if weights is None:
+            self._entries.clear()
+        else:
+            for key in [key for key in self._entries if key[-1] != weights]:
+                del self._entries[key]
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,32 @@
+"""Exports the ego centric belief network to TorchScript next to its weights, run from the code/agent folder:
+
+    python -m our.export_model --folder v2/ [--quantize] [--uncalibrated]
+
+EgoNeuralDistribution.load_from_file (and so FactorGraph.load_from_file) then uses the export for inference as long as
+the weights in the folder are the exported ones, a stale export is ignored. Redo it whenever the weights change.
+"""
+import argparse
+import os
+
+from .model_reduced_categories import FactorGraphModelV2
+from .pomegranate.distributions import EgoNeuralDistribution
+from .pomegranate.distributions.egocentric_neuralnet import MODELS_DIR
+
+
+def export(folder_path="v2/", calibrated=True, quantize=False):
+    graph_model = FactorGraphModelV2()
+    graph_model.construct()
+
+    if not EgoNeuralDistribution.load_weights(folder_path, calibrated=calibrated):
+        raise FileNotFoundError("No weights to export in {}".format(os.path.join(MODELS_DIR, folder_path)))
+    return EgoNeuralDistribution.export(folder_path, calibrated=calibrated, quantize=quantize)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the belief network to TorchScript for inference")
+    parser.add_argument("--folder", type=str, default="v2/", help="the folder in our/models with the weights")
+    parser.add_argument("--quantize", action="store_true", help="dynamically quantize the linear layers to int8")
+    parser.add_argument("--uncalibrated", action="store_true", help="export the model without temperature scaling")
+    args = parser.parse_args()
+
+    print(export(args.folder, calibrated=not args.uncalibrated, quantize=args.quantize))
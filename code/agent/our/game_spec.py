@@ -0,0 +1,135 @@
+from math import comb
+
+
+def combination_rank(subset, n):
+    """the index of the subset in combinations(range(n), len(subset)), computed without enumerating the combinations"""
+    rank = 0
+    previous = -1
+    size = len(subset)
+    for i, element in enumerate(sorted(subset)):
+        # count the combinations that have a smaller element in this position
+        for skipped in range(previous + 1, element):
+            rank += comb(n - skipped - 1, size - i - 1)
+        previous = element
+    return rank
+
+
+def combination_unrank(rank, n, size):
+    """the inverse of combination_rank, returns the rank-th tuple of combinations(range(n), size)"""
+    subset = []
+    element = 0
+    for i in range(size):
+        while rank >= comb(n - element - 1, size - i - 1):
+            rank -= comb(n - element - 1, size - i - 1)
+            element += 1
+        subset.append(element)
+        element += 1
+    return tuple(subset)
+
+
+class GameSpec(object):
+    """Describes the variables of the belief model for a game size.
+
+    Players are indexed from 0 here. The state vector of a game has one role per player followed by
+    (party, vote, outcome) for every quest, where 0 always means unknown:
+        party: 1 + the rank of the party among the parties of that quest's size
+        vote: 1 + the index of the players that approved the party, among all possible majorities
+        outcome: 1 for a failed quest, 2 for a successful one
+    """
+    # evil players and quest sizes of the standard rules for every number of players
+    STANDARD_RULES = {
+        5: (2, (2, 3, 2, 3, 3)),
+        6: (2, (2, 3, 4, 3, 4)),
+        7: (3, (2, 3, 3, 4, 4)),
+        8: (3, (3, 4, 4, 5, 5)),
+        9: (3, (3, 4, 4, 5, 5)),
+        10: (4, (3, 4, 4, 5, 5)),
+    }
+
+    def __init__(self, num_players=6, num_evil=2, quest_sizes=(2, 3, 4, 3, 4)):
+        if not 0 < num_evil < num_players:
+            raise ValueError("The number of evil players must be between 1 and the number of players - 1")
+        if any(size < 1 or size > num_players for size in quest_sizes):
+            raise ValueError("Quest sizes must be between 1 and the number of players")
+
+        self.num_players = num_players
+        self.num_evil = num_evil
+        self.quest_sizes = tuple(quest_sizes)
+        self.num_quests = len(self.quest_sizes)
+
+        # a party is accepted when a strict majority approves it, so only those vote compositions are stored
+        self.vote_sizes = range(num_players // 2 + 1, num_players + 1)
+        self._vote_offsets = {}
+        offset = 0
+        for size in self.vote_sizes:
+            self._vote_offsets[size] = offset
+            offset += comb(num_players, size)
+        self.num_vote_compositions = offset
+
+        self._permutations = {}
+
+    @classmethod
+    def for_players(cls, num_players):
+        """the spec of the standard rules for 5 to 10 players"""
+        if num_players not in cls.STANDARD_RULES:
+            raise ValueError("There are no standard rules for {} players".format(num_players))
+        num_evil, quest_sizes = cls.STANDARD_RULES[num_players]
+        return cls(num_players, num_evil, quest_sizes)
+
+    def num_categories_list(self):
+        """the number of categories of the role followed by those of every quest variable, as used by the neural factors"""
+        categories = [2]
+        for size in self.quest_sizes:
+            categories.extend([comb(self.num_players, size) + 1, self.num_vote_compositions + 1, 3])
+        return categories
+
+    def embedding_dim_list(self, party_dim=4, vote_dim=4, outcome_dim=1):
+        return [party_dim, vote_dim, outcome_dim] * self.num_quests
+
+    def party_index(self, party, quest):
+        """the state vector value of a party (0-indexed players) sent on the quest (0-indexed)"""
+        if len(party) != self.quest_sizes[quest]:
+            raise ValueError("Quest {} needs a party of {} players".format(quest + 1, self.quest_sizes[quest]))
+        return combination_rank(party, self.num_players) + 1
+
+    def party_from_index(self, index, quest):
+        return combination_unrank(index - 1, self.num_players, self.quest_sizes[quest])
+
+    def vote_index(self, approvals):
+        """the state vector value of the players (0-indexed) that approved an accepted party"""
+        size = len(approvals)
+        if size not in self._vote_offsets:
+            raise ValueError("An accepted party needs at least {} approvals".format(self.vote_sizes[0]))
+        return self._vote_offsets[size] + combination_rank(approvals, self.num_players) + 1
+
+    def vote_from_index(self, index):
+        index -= 1
+        for size in self.vote_sizes:
+            count = comb(self.num_players, size)
+            if index < count:
+                return combination_unrank(index, self.num_players, size)
+            index -= count
+        raise ValueError("Vote index out of range")
+
+    def quest_permutations(self, seat):
+        """maps every value of every quest variable to its value in the ego centric order of the player in the seat,
+        where that player becomes player 0 and the others keep their cyclic order.
+        returns one list per quest variable, the list maps the old value to the new one"""
+        if seat not in self._permutations:
+            n = self.num_players
+
+            def rotate(players):
+                return [(player - seat) % n for player in players]
+
+            votes = [0] + [self.vote_index(rotate(self.vote_from_index(index)))
+                           for index in range(1, self.num_vote_compositions + 1)]
+            tables = []
+            for quest, size in enumerate(self.quest_sizes):
+                parties = [0] + [self.party_index(rotate(self.party_from_index(index, quest)), quest)
+                                 for index in range(1, comb(n, size) + 1)]
+                tables.extend([parties, votes, [0, 1, 2]])
+            self._permutations[seat] = tables
+        return self._permutations[seat]
+
+
+SIX_PLAYER_GAME = GameSpec(6, 2, (2, 3, 4, 3, 4))
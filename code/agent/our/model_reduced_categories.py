@@ -7,8 +7,10 @@ from tqdm import tqdm
 
 from .pomegranate.distributions import Categorical
 from .pomegranate.distributions import JointCategorical
+from .pomegranate.distributions import ExactlyKOfN
 from .pomegranate.distributions import NeuralDistribution
 from .pomegranate.distributions import EgoNeuralDistribution
+from .pomegranate.distributions.egocentric_neuralnet import weights_fingerprint
 from .pomegranate.factor_graph import FactorGraph
 
 from agent_base import ATEAM
@@ -17,9 +19,12 @@ import sys
 import argparse
 import time
 import json
+import hashlib
 import pandas as pd
 
 from .base_model import BaselModel
+from .belief_cache import BeliefCache
+from .game_spec import SIX_PLAYER_GAME
 
 def array_filler_evil(number_of_players=6):
     """this function is used to create the array for the evil constraint"""
@@ -35,42 +40,32 @@ def array_filler_evil(number_of_players=6):
     return array
 
 class FactorGraphModelV2(BaselModel):
-    def __init__(self, egocentric=True):
+    def __init__(self, egocentric=True, cache_size=4096, cache_path=None):
+        """cache_size bounds the number of belief results kept in memory (0 disables the cache),
+        with cache_path the cache is also loaded from and saved to that json file (see BeliefCache).
+        The results are keyed by the fingerprint of the model weights, so loading other weights never reuses them."""
         super().__init__(egocentric=egocentric)
+        # only recompute the messages whose inputs changed, most factors are fed observed quests and settle after one pass
+        self.model.residual_tol = 0.0
+        self.belief_cache = BeliefCache(max_size=cache_size, path=cache_path)
+        self.spec = SIX_PLAYER_GAME # replaced by the spec given to construct
     
-    def construct(self, hidden_dim=16, num_categories_list=[2, 16, 23, 3, 21, 23, 3, 16, 23, 3, 21, 23, 3, 16, 23, 3],
-                     embedding_dim_list=[4, 4, 1, 4, 4, 1, 4, 4, 1, 4, 4, 1, 4, 4, 1]):
-        # role variables
-        r1 = Categorical([[0.5, 0.5]])
-        r2 = Categorical([[0.5, 0.5]])
-        r3 = Categorical([[0.5, 0.5]])
-        r4 = Categorical([[0.5, 0.5]])
-        r5 = Categorical([[0.5, 0.5]])
-        r6 = Categorical([[0.5, 0.5]])
-        # party 1 will have 15 possible configurations
-        p1 = Categorical([[1/16,]*16])
-        # party 2 will have 20 possible configurations
-        p2 = Categorical([[1/21,]*21])
-        # party 3 will have 15 possible configurations
-        p3 = Categorical([[1/16,]*16])
-        # party 4 will have 20 possible configurations
-        p4 = Categorical([[1/21,]*21])
-        # party 5 will have 15 possible configurations
-        p5 = Categorical([[1/16,]*16])
-
-        # each vote will have 2**6 possible configurations
-        v1 = Categorical([[1/23,]*23])
-        v2 = Categorical([[1/23,]*23])
-        v3 = Categorical([[1/23,]*23])
-        v4 = Categorical([[1/23,]*23])
-        v5 = Categorical([[1/23,]*23])
+    def construct(self, hidden_dim=16, num_categories_list=None, embedding_dim_list=None, spec=SIX_PLAYER_GAME):
+        """builds the factor graph of the game described by spec (number of players, evil players and quest sizes).
+        the category spaces of the parties and votes are derived from the spec unless they are given,
+        the defaults of the six player game are [2, 16, 23, 3, 21, 23, 3, 16, 23, 3, 21, 23, 3, 16, 23, 3] and [4, 4, 1] per quest"""
+        self.spec = spec
+        if num_categories_list is None:
+            num_categories_list = spec.num_categories_list()
+        if embedding_dim_list is None:
+            embedding_dim_list = spec.embedding_dim_list()
+        assert len(num_categories_list) == 1 + 3 * spec.num_quests, "there must be one role and three variables per quest"
 
-        # outcomes can be either success (2) or fail (1) or unknown (0)
-        o1 = Categorical([[1/3,]*3])
-        o2 = Categorical([[1/3,]*3])
-        o3 = Categorical([[1/3,]*3])
-        o4 = Categorical([[1/3,]*3])
-        o5 = Categorical([[1/3,]*3])
+        # role variables
+        roles = [Categorical([[0.5, 0.5]]) for _ in range(spec.num_players)]
+        # every quest has a party, a vote and an outcome. parties and votes have one category per composition
+        # plus unknown (0), outcomes can be either success (2) or fail (1) or unknown (0)
+        quest_variables = [Categorical([[1/n,]*n]) for n in num_categories_list[1:]]
 
         # num_categories_list = [2, 16, 65, 3, 21, 65, 3, 16, 65, 3, 21, 65, 3, 16, 65, 3]
         # embedding_dim_list = [4, 8, 2, 5, 8, 2, 4, 8, 2, 5, 8, 2, 4, 8, 2]  # Specify embedding dimensions for each variable
@@ -82,180 +77,37 @@ class FactorGraphModelV2(BaselModel):
 
         # DONE: change the from_file configuration to be from the train function
         if self.egocentric: 
-            EgoNeuralDistribution.initialize(num_categories_list, embedding_dim_list, hidden_dim, output_dim)
-            f1 = EgoNeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=0, graph=True)
-            f2 = EgoNeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=1, graph=True)
-            f3 = EgoNeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=2, graph=True)
-            f4 = EgoNeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=3, graph=True)
-            f5 = EgoNeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=4, graph=True)
-            f6 = EgoNeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=5, graph=True)
-            
+            EgoNeuralDistribution.initialize(num_categories_list, embedding_dim_list, hidden_dim, output_dim, spec=spec)
+            factors = [EgoNeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=i, graph=True)
+                       for i in range(spec.num_players)]
         else:
+            factors = [NeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=f"f{i+1}", from_file=True, graph=True)
+                       for i in range(spec.num_players)]
 
-            f1 = NeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name="f1", from_file=True, graph=True)
-            f2 = NeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name="f2", from_file=True, graph=True)
-            f3 = NeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name="f3", from_file=True, graph=True)
-            f4 = NeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name="f4", from_file=True, graph=True)
-            f5 = NeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name="f5", from_file=True, graph=True)
-            f6 = NeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name="f6", from_file=True, graph=True)
+        # exactly num_evil of the players are evil, same as JointCategorical(array_filler_evil(6)) without the 2**n table
+        f_evil_constraint = ExactlyKOfN(spec.num_players, spec.num_evil)
 
-        evil_array = array_filler_evil(6)
-        f_evil_constraint = JointCategorical(evil_array/np.sum(evil_array), frozen=True)
-
-        # add the nodes to the model
-        self.model.add_factor(f1)
-        self.model.add_factor(f2)
-        self.model.add_factor(f3)
-        self.model.add_factor(f4)
-        self.model.add_factor(f5)
-        self.model.add_factor(f6)
+        # add the nodes to the model, the role marginals have to come first (see update_priors)
+        for factor in factors:
+            self.model.add_factor(factor)
         self.model.add_factor(f_evil_constraint)
 
-        self.model.add_marginal(r1)
-        self.model.add_marginal(r2)
-        self.model.add_marginal(r3)
-        self.model.add_marginal(r4)
-        self.model.add_marginal(r5)
-        self.model.add_marginal(r6)
-
-        self.model.add_marginal(p1)
-        self.model.add_marginal(v1)
-        self.model.add_marginal(o1)
-
-        self.model.add_marginal(p2)
-        self.model.add_marginal(v2)
-        self.model.add_marginal(o2)
-
-        self.model.add_marginal(p3)
-        self.model.add_marginal(v3)
-        self.model.add_marginal(o3)
-
-        self.model.add_marginal(p4)
-        self.model.add_marginal(v4)
-        self.model.add_marginal(o4)
-
-        self.model.add_marginal(p5)
-        self.model.add_marginal(v5)
-        self.model.add_marginal(o5)
-
-        # add edges for factor 1:
-        self.model.add_edge(r1, f1)
-        self.model.add_edge(p1, f1)
-        self.model.add_edge(v1, f1)
-        self.model.add_edge(o1, f1)
-        self.model.add_edge(p2, f1)
-        self.model.add_edge(v2, f1)
-        self.model.add_edge(o2, f1)
-        self.model.add_edge(p3, f1)
-        self.model.add_edge(v3, f1)
-        self.model.add_edge(o3, f1)
-        self.model.add_edge(p4, f1)
-        self.model.add_edge(v4, f1)
-        self.model.add_edge(o4, f1)
-        self.model.add_edge(p5, f1)
-        self.model.add_edge(v5, f1)
-        self.model.add_edge(o5, f1)
-
-        # add edges for factor 2:
-        self.model.add_edge(r2, f2)
-        self.model.add_edge(p1, f2)
-        self.model.add_edge(v1, f2)
-        self.model.add_edge(o1, f2)
-        self.model.add_edge(p2, f2)
-        self.model.add_edge(v2, f2)
-        self.model.add_edge(o2, f2)
-        self.model.add_edge(p3, f2)
-        self.model.add_edge(v3, f2)
-        self.model.add_edge(o3, f2)
-        self.model.add_edge(p4, f2)
-        self.model.add_edge(v4, f2)
-        self.model.add_edge(o4, f2)
-        self.model.add_edge(p5, f2)
-        self.model.add_edge(v5, f2)
-        self.model.add_edge(o5, f2)
-
-        # add edges for factor 3:
-        self.model.add_edge(r3, f3)
-        self.model.add_edge(p1, f3)
-        self.model.add_edge(v1, f3)
-        self.model.add_edge(o1, f3)
-        self.model.add_edge(p2, f3)
-        self.model.add_edge(v2, f3)
-        self.model.add_edge(o2, f3)
-        self.model.add_edge(p3, f3)
-        self.model.add_edge(v3, f3)
-        self.model.add_edge(o3, f3)
-        self.model.add_edge(p4, f3)
-        self.model.add_edge(v4, f3)
-        self.model.add_edge(o4, f3)
-        self.model.add_edge(p5, f3)
-        self.model.add_edge(v5, f3)
-        self.model.add_edge(o5, f3)
+        for marginal in roles + quest_variables:
+            self.model.add_marginal(marginal)
 
-        # add edges for factor 4:
-        self.model.add_edge(r4, f4)
-        self.model.add_edge(p1, f4)
-        self.model.add_edge(v1, f4)
-        self.model.add_edge(o1, f4)
-        self.model.add_edge(p2, f4)
-        self.model.add_edge(v2, f4)
-        self.model.add_edge(o2, f4)
-        self.model.add_edge(p3, f4)
-        self.model.add_edge(v3, f4)
-        self.model.add_edge(o3, f4)
-        self.model.add_edge(p4, f4)
-        self.model.add_edge(v4, f4)
-        self.model.add_edge(o4, f4)
-        self.model.add_edge(p5, f4)
-        self.model.add_edge(v5, f4)
-        self.model.add_edge(o5, f4)
+        # every player's factor sees its own role and the whole game history
+        for role, factor in zip(roles, factors):
+            self.model.add_edge(role, factor)
+            for marginal in quest_variables:
+                self.model.add_edge(marginal, factor)
 
-        # add edges for factor 5:
-        self.model.add_edge(r5, f5)
-        self.model.add_edge(p1, f5)
-        self.model.add_edge(v1, f5)
-        self.model.add_edge(o1, f5)
-        self.model.add_edge(p2, f5)
-        self.model.add_edge(v2, f5)
-        self.model.add_edge(o2, f5)
-        self.model.add_edge(p3, f5)
-        self.model.add_edge(v3, f5)
-        self.model.add_edge(o3, f5)
-        self.model.add_edge(p4, f5)
-        self.model.add_edge(v4, f5)
-        self.model.add_edge(o4, f5)
-        self.model.add_edge(p5, f5)
-        self.model.add_edge(v5, f5)
-        self.model.add_edge(o5, f5)
-
-        # add edges for factor 6:
-        self.model.add_edge(r6, f6)
-        self.model.add_edge(p1, f6)
-        self.model.add_edge(v1, f6)
-        self.model.add_edge(o1, f6)
-        self.model.add_edge(p2, f6)
-        self.model.add_edge(v2, f6)
-        self.model.add_edge(o2, f6)
-        self.model.add_edge(p3, f6)
-        self.model.add_edge(v3, f6)
-        self.model.add_edge(o3, f6)
-        self.model.add_edge(p4, f6)
-        self.model.add_edge(v4, f6)
-        self.model.add_edge(o4, f6)
-        self.model.add_edge(p5, f6)
-        self.model.add_edge(v5, f6)
-        self.model.add_edge(o5, f6)
-
-        self.model.add_edge(r1, f_evil_constraint)
-        self.model.add_edge(r2, f_evil_constraint)
-        self.model.add_edge(r3, f_evil_constraint)
-        self.model.add_edge(r4, f_evil_constraint)
-        self.model.add_edge(r5, f_evil_constraint)
-        self.model.add_edge(r6, f_evil_constraint)
+        for role in roles:
+            self.model.add_edge(role, f_evil_constraint)
     
     def train(self, history_vector, history_valid, save_directory="v1/"):
         """Train the model on the history vector, save models into a specific directory once they are finished"""
         super().train(history_vector, history_valid, save_directory=save_directory)
+        self.belief_cache.clear(weights=self.weights_fingerprint())
         # history_vector = torch.tensor(history_vector, dtype=torch.int32)
         # self.model.fit(history_vector, X_valid=history_valid, from_file=save_directory)
         # raise NotImplementedError("Must be implemented in subclass")
@@ -264,50 +116,98 @@ class FactorGraphModelV2(BaselModel):
     def load_from_file(self, folder_path="v2/"):
         """All model files should be stored in a specific folder"""
         super().load_from_file(folder_path)
+        # the results of the previous weights are of no use anymore, those saved for these weights are kept
+        self.belief_cache.clear(weights=self.weights_fingerprint())
+
+    def weights_fingerprint(self):
+        """the fingerprint of the weights of the neural factors, the beliefs are cached per fingerprint"""
+        if self.egocentric:
+            return EgoNeuralDistribution.fingerprint()
+        digest = hashlib.sha256()
+        for factor in self.model.factors:
+            if isinstance(factor, NeuralDistribution):
+                digest.update(weights_fingerprint(factor.model).encode("utf-8"))
+        return digest.hexdigest()[:16]
     
-    def predict_probs(self, game_state, self_role, self_index, algorithm="sum"):
+    def predict_probs(self, game_state, self_role, self_index, algorithm="sum", warm_start=False):
         """
         Game state is given as a vector
-        the algorithm can be either "max" or "sum" for max-product or sum-product
+        the algorithm can be either "max" or "sum" for max-product or sum-product, or "exact" for exact marginals by enumeration
+        with warm_start the belief propagation starts from the messages of the previous call, which is much cheaper
+        when only the newest quest or the priors changed
         returns a dictionary of probabilities for each player
         The format of the results is {'player_1': {'good': 0.5, 'evil': 0.5}, ...}
         """
-        assert algorithm in ["max", "sum"]
-
-        # algorithm = "sum"
-
-        if self_role == ATEAM.GOOD:
-            game_state[self_index] = 0
-        elif self_role == ATEAM.EVIL:
-            game_state[self_index] = 1
-        else:
-            raise ValueError("Role must be either good or evil")
-        X_torch = torch.tensor(game_state, dtype=torch.int32)
-
-        mask_array = ([False,]*6) + ([True,]*15)  # mask the game state vector for the values we want to predict
-        mask_array[self_index] = True # we know the role of ourslef
-        # mask_array[5] = True
-        # print(self.model.marginals[5].probs)
-        mask = torch.tensor([mask_array])
-        X_masked = torch.masked.MaskedTensor(X_torch.unsqueeze(0), mask=mask)
-
-
         start_time = time.time()
-        predicted_prob = self.model.predict_proba(X_masked, alg=algorithm)
+        results = self.predict_probs_batch([game_state], [self_role], [self_index], algorithm=algorithm,
+                                           warm_start=warm_start)[0]
         end_time = time.time()
         print(f"Time taken to run predict_proba: {end_time - start_time} seconds")
 
-        results = {}
-        for i in range(6):
-            results[i+1] = {'good': predicted_prob[i][0][0].item(),
-                                        'evil': predicted_prob[i][0][1].item()}
+        return results
+
+    def predict_probs_batch(self, states, roles, indices, algorithm="sum", warm_start=False):
+        """
+        Runs belief propagation for many game states at once, e.g. the six agents of a game or replayed states.
+        states is a list of game state vectors, roles and indices hold the role and index of the player each state is seen by
+        returns a list with one dictionary of probabilities per state, in the same format as predict_probs
+        states that are found in the belief cache are not run through belief propagation again
+        """
+        assert algorithm in ["max", "sum", "exact"]
+        assert len(states) == len(roles) == len(indices), "states, roles and indices must have the same length"
+
+        num_players = self.spec.num_players
+        priors = [p.item() for marginal in self.model.marginals[:num_players] for p in marginal.probs[0]]
+        weights = self.weights_fingerprint()
+
+        results = [None] * len(states)
+        keys = []
+        game_states = []
+        mask_array = []
+        for n, (game_state, self_role, self_index) in enumerate(zip(states, roles, indices)):
+            game_state = list(game_state)
+            if self_role == ATEAM.GOOD:
+                game_state[self_index] = 0
+            elif self_role == ATEAM.EVIL:
+                game_state[self_index] = 1
+            else:
+                raise ValueError("Role must be either good or evil")
+
+            keys.append(BeliefCache.make_key(game_state, self_index, self_role, priors, algorithm, num_players=num_players,
+                                             weights=weights))
+            results[n] = self.belief_cache.get(keys[n])
+            if results[n] is not None:
+                continue
+            game_states.append(game_state)
+
+            mask_row = ([False,]*num_players) + ([True,]*(3 * self.spec.num_quests))  # mask the game state vector for the values we want to predict
+            mask_row[self_index] = True # we know the role of ourslef
+            mask_array.append(mask_row)
+
+        if len(game_states) == 0:
+            return results
+
+        X_torch = torch.tensor(game_states, dtype=torch.int32)
+        mask = torch.tensor(mask_array)
+        X_masked = torch.masked.MaskedTensor(X_torch, mask=mask)
+
+        predicted_prob = self.model.predict_proba(X_masked, alg=algorithm, warm_start=warm_start)
+
+        missing = [n for n, result in enumerate(results) if result is None]
+        for j, n in enumerate(missing):
+            result = {}
+            for i in range(num_players):
+                result[i+1] = {'good': predicted_prob[i][j][0].item(),
+                                            'evil': predicted_prob[i][j][1].item()}
+            self.belief_cache.put(keys[n], result)
+            results[n] = result
         return results
 
     def update_priors(self, priors):
         """Update the priors of the model
             priors should be in the form of {1: {"evil": 0.5, "good":0.5}, 2: ...}
         """
-        # Since the role marginals are always the first marginals added to the factor graph structure, we have to update the marginal probs of the first 6 nodes.
+        # Since the role marginals are always the first marginals added to the factor graph structure, we have to update the marginal probs of the first num_players nodes.
         for index, probs in priors.items():
             self.model.marginals[index-1].update_probs([[probs['good'], probs['evil']]])
 
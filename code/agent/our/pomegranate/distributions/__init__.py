@@ -2,5 +2,6 @@ from .categorical import Categorical
 from .conditional_categorical import ConditionalCategorical
 from .independent_components import IndependentComponents
 from .joint_categorical import JointCategorical
+from .exactly_k_of_n import ExactlyKOfN
 from .neuralnet import NeuralDistribution
 from .egocentric_neuralnet import EgoNeuralDistribution
\ No newline at end of file
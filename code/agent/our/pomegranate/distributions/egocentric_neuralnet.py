@@ -13,37 +13,21 @@ from .._utils import _reshape_weights
 
 from ._distribution import Distribution
 import os
-
-from itertools import combinations
+import copy
+import json
+import hashlib
 
 from .temperature_scaling import ModelWithTemperature
+from .fused_embedding import FusedEmbedding
+from .trainer import TensorBatches
+from .trainer import train_model
+try:
+    from ...game_spec import SIX_PLAYER_GAME
+except ImportError:  # pomegranate is imported as a top-level package with our/ on the path, e.g. by the training scripts
+    from game_spec import SIX_PLAYER_GAME
 
-
-class EarlyStopping:
-    def __init__(self, patience=10, delta=0):
-        self.patience = patience
-        self.delta = delta
-        self.best_score = None
-        self.early_stop = False
-        self.counter = 0
-        self.best_model_state = None
-
-    def __call__(self, val_loss, model):
-        score = -val_loss
-        if self.best_score is None:
-            self.best_score = score
-            self.best_model_state = model.state_dict()
-        elif score < self.best_score + self.delta:
-            self.counter += 1
-            if self.counter >= self.patience:
-                self.early_stop = True
-        else:
-            self.best_score = score
-            self.best_model_state = model.state_dict()
-            self.counter = 0
-
-    def load_best_model(self, model):
-        model.load_state_dict(self.best_model_state)
+# the saved weights and exports, our/models, independent of the working folder
+MODELS_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "models"))
 
 
 class CategoricalNN(nn.Module):
@@ -62,11 +46,8 @@ class CategoricalNN(nn.Module):
         """
         super(CategoricalNN, self).__init__()
 
-        # Embedding layers for each categorical variable
-        self.embeddings = nn.ModuleList([
-            nn.Embedding(num_categories, embedding_dim)
-            for num_categories, embedding_dim in zip(num_categories_list, embedding_dim_list)
-        ])
+        # Embedding layers for each categorical variable, fused into one table. 0 input (missing) embeds to zeros
+        self.embeddings = FusedEmbedding(num_categories_list, embedding_dim_list, mask_missing=True)
 
         # FC layers
         total_embedding_dim = sum(embedding_dim_list)
@@ -79,23 +60,8 @@ class CategoricalNN(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        # This change was made to ensure that 0 input does not affect the gradients
-        embedded = []
-        for i, embedding in enumerate(self.embeddings):
-            missing_idx = 0
-            
-            e_i = embedding(x[:, i])               # [batch_size, embedding_dim]
-            
-            # Create a mask: 1 if not missing, 0 if missing
-            mask_i = (x[:, i] != missing_idx).float()  # [batch_size]
-            mask_i = mask_i.unsqueeze(-1)              # [batch_size, 1]
-            
-            # Multiply out if missing
-            e_i = e_i * mask_i
-            
-            embedded.append(e_i)
-
-        x = torch.cat(embedded, dim=1)
+        # This change was made to ensure that 0 input does not affect the gradients (the missing values are masked)
+        x = self.embeddings(x)                     # [batch_size, total_embedding_dim]
 
         # FC layers
         x = self.relu(self.fc1(x))
@@ -105,6 +71,108 @@ class CategoricalNN(nn.Module):
         return x
 
 
+class CompiledCategoricalNN(object):
+    """Lookup-table form of a trained CategoricalNN, used for inference only.
+
+    fc1 is linear in the concatenated embeddings, so its pre-activation is a sum of one row per variable
+    taken from a table of (embedding of the value) @ (the slice of fc1 for that variable).
+    The tables are evaluated once for every value of every variable, after which the first layer is a
+    single gather and sum. The missing value 0 contributes nothing, as in CategoricalNN.forward.
+    An optional temperature (from ModelWithTemperature) divides the output logits.
+    """
+    def __init__(self, model, temperature=None):
+        with torch.no_grad():
+            tables = []
+            start = 0
+            for i, dim in enumerate(model.embeddings.embedding_dim_list):
+                weight = model.embeddings.variable_weight(i).clone()
+                weight[0] = 0
+                tables.append(weight @ model.fc1.weight[:, start:start + dim].T)
+                start += dim
+
+            sizes = model.embeddings.num_categories_list
+            self.table = torch.cat(tables)
+            self.offsets = torch.tensor([0] + sizes[:-1]).cumsum(0)
+            self.fc1_bias = model.fc1.bias.clone()
+            self.fc_between = (model.fc_between.weight.clone(), model.fc_between.bias.clone())
+            self.fc2 = (model.fc2.weight.clone(), model.fc2.bias.clone())
+            self.temperature = None if temperature is None else temperature.clone()
+
+    def __call__(self, x):
+        with torch.no_grad():
+            x = self.table[x + self.offsets].sum(dim=1) + self.fc1_bias
+            x = F.relu(x)
+            x = F.relu(F.linear(x, *self.fc_between))
+            x = F.linear(x, *self.fc2)
+            if self.temperature is not None:
+                x = x / self.temperature
+        return x
+
+
+def _model_config(model):
+    """what an exported model has to match to be used in place of the model"""
+    return {"num_categories_list": model.embeddings.num_categories_list,
+            "embedding_dim_list": model.embeddings.embedding_dim_list,
+            "hidden_dim": model.fc1.out_features,
+            "output_dim": model.fc2.out_features}
+
+
+def weights_fingerprint(model, temperature=None):
+    """a digest of the weights of a CategoricalNN and its temperature, which tells apart models of the same
+    configuration"""
+    digest = hashlib.sha256()
+    tensors = sorted(model.state_dict().items())
+    if temperature is not None:
+        tensors.append(("temperature", temperature))
+    for name, tensor in tensors:
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def export_categorical_nn(model, file_path, temperature=None, quantize=False):
+    """Saves a TorchScript version of a CategoricalNN for inference.
+    The temperature (from ModelWithTemperature) is folded into the last layer, so the exported module returns the
+    calibrated logits. With quantize the linear layers are dynamically quantized to int8.
+    The configuration and the weights fingerprint of the model are stored next to it, see ExportedCategoricalNN"""
+    fingerprint = weights_fingerprint(model, temperature)
+    model = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        if temperature is not None:
+            model.fc2.weight /= temperature
+            model.fc2.bias /= temperature
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    example = torch.zeros(2, len(model.embeddings), dtype=torch.int64)
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, example)
+
+    meta = dict(_model_config(model), calibrated=temperature is not None, quantized=quantize, weights=fingerprint)
+    torch.jit.save(scripted, file_path, _extra_files={"meta.json": json.dumps(meta)})
+    return meta
+
+
+class ExportedCategoricalNN(object):
+    """A CategoricalNN exported with export_categorical_nn, loaded without building the eager model"""
+    def __init__(self, file_path):
+        extra_files = {"meta.json": ""}
+        self.module = torch.jit.load(file_path, _extra_files=extra_files)
+        self.module.eval()
+        self.meta = json.loads(extra_files["meta.json"])
+        self.calibrated = self.meta["calibrated"]
+
+    def matches(self, model, fingerprint=None):
+        """whether the export has the configuration of the model, and was made from the weights of the fingerprint"""
+        if fingerprint is not None and self.meta.get("weights") != fingerprint:
+            return False
+        return all(self.meta[key] == value for key, value in _model_config(model).items())
+
+    def __call__(self, x):
+        with torch.no_grad():
+            return self.module(x)
+
+
 class EgoNeuralDistribution(Distribution):
     """A base distribution object.
 
@@ -117,13 +185,28 @@ class EgoNeuralDistribution(Distribution):
     # these values will be shared among all instances of the factor function
     model = None
     trained = False
+    # whether the model holds trained weights (loaded or fit), the eager model is only used with them
+    weights_loaded = False
+    # the game the factors belong to, it defines the players and the ego centric permutation of the game history
+    spec = SIX_PLAYER_GAME
+
+    # lookup-table version of the model and the probabilities it already produced, see compile()
+    compiled = None
+    lookup = {}
+    max_lookup_size = 100000
+    # TorchScript version of the model attached by load_from_file when one has been exported, see export()
+    exported = None
+    export_files = {True: "ego_model_2_calibrated.ts.pt", False: "ego_centric_model.ts.pt"}
+    weights_files = {True: "ego_model_2_calibrated.pth", False: "ego_centric_model.pth"}
     
     @classmethod
     def initialize(cls, num_categories_list,
                     embedding_dim_list,
                     hidden_dim,
-                    output_dim):
+                    output_dim,
+                    spec=SIX_PLAYER_GAME):
         # cls.static_var = custom_value
+        cls.spec = spec
         num_categories_list = num_categories_list[1:]
         categories = num_categories_list
         embedding_dim_list = embedding_dim_list
@@ -137,6 +220,52 @@ class EgoNeuralDistribution(Distribution):
                 hidden_dim,
                 output_dim)
         cls.calibrated_model = ModelWithTemperature(cls.model)
+        cls.invalidate()
+        cls.weights_loaded = False
+
+    @classmethod
+    def compile(cls, calibrated=True):
+        """Builds the lookup-table version of the (calibrated) model used for inference.
+        Has to be called again whenever the weights change, which load_from_file does."""
+        temperature = cls.calibrated_model.temperature if calibrated else None
+        cls.compiled = CompiledCategoricalNN(cls.model, temperature)
+        cls.compiled.calibrated = calibrated
+        cls.lookup = {}
+
+    @classmethod
+    def invalidate(cls):
+        """Drops the compiled and exported models and the looked up probabilities, e.g. because the weights changed"""
+        cls.compiled = None
+        cls.exported = None
+        cls.lookup = {}
+
+    @classmethod
+    def fingerprint(cls, calibrated=True):
+        """the weights fingerprint of the (calibrated) model, see weights_fingerprint"""
+        return weights_fingerprint(cls.model, cls.calibrated_model.temperature if calibrated else None)
+
+    @classmethod
+    def load_weights(cls, folder_path, calibrated=True):
+        """Loads the weights saved in our/models/folder_path into the (calibrated) model.
+        Returns False when the folder has no weights for the calibration setting."""
+        file_path = os.path.join(MODELS_DIR, folder_path, cls.weights_files[calibrated])
+        if not os.path.exists(file_path):
+            return False
+        model = cls.calibrated_model if calibrated else cls.model
+        model.load_state_dict(torch.load(file_path, weights_only=True))
+        cls.invalidate()
+        cls.weights_loaded = True
+        return True
+
+    @classmethod
+    def export(cls, folder_path, calibrated=True, quantize=False):
+        """Exports the current (calibrated) model next to its weights in our/models/folder_path, load_from_file then
+        uses the export for inference as long as the weights it loads are the exported ones."""
+        if not cls.weights_loaded:
+            raise ValueError("The model has no trained weights to export, load or fit it first")
+        file_path = os.path.join(MODELS_DIR, folder_path, cls.export_files[calibrated])
+        temperature = cls.calibrated_model.temperature.detach() if calibrated else None
+        return export_categorical_nn(cls.model, file_path, temperature=temperature, quantize=quantize)
 
     def __init__(
             self,
@@ -166,7 +295,7 @@ class EgoNeuralDistribution(Distribution):
         # self.from_file = from_file
         self.name = name
         assert self.name is not None, "Name of the factor function is not provided"
-        assert self.name in [0,1,2,3,4,5], "the name of the factor function should be its corresponding index in the order of the players"
+        assert self.name in range(EgoNeuralDistribution.spec.num_players), "the name of the factor function should be its corresponding index in the order of the players"
         self.graph = graph
 
         if (num_categories_list[0] != 2) or (output_dim != 1): # this can be changed to multiple categories if we change the network to be use softmax instead of sigmoid
@@ -224,33 +353,62 @@ class EgoNeuralDistribution(Distribution):
             self.output_dim)
         
         EgoNeuralDistribution.calibrated_model = ModelWithTemperature(EgoNeuralDistribution.model)
+        EgoNeuralDistribution.invalidate()
+        EgoNeuralDistribution.weights_loaded = False
 
 
     def probability(self, X):
         """returns the probability fo X happening.
         X is the array of all variables connected to the factor, including the 0 index
         """
+        return self.batch_probability([X])[0].item()
 
+    def batch_probability(self, X):
+        """returns the probability of each row of X happening.
+        X is an (n, d) integer tensor of assignments to all variables connected to the factor, including the 0 index
+        The probability of every game history is looked up once it has been computed, new histories go through
+        the compiled model (or the torch model if it has not been compiled) in a single forward pass.
+        """
+        X = torch.as_tensor(X, dtype=torch.int64)
+
+        # the network only sees the game history, so every distinct history is evaluated once
+        history, inverse = torch.unique(X[:, 1:], dim=0, return_inverse=True)
+        keys = [(int(self.name), self.calibrated) + tuple(h) for h in history.tolist()]
+        missing = [n for n, key in enumerate(keys) if key not in EgoNeuralDistribution.lookup]
+
+        if len(missing) > 0:
+            model_input = torch.tensor([[0] + list(keys[n][2:]) for n in missing])
+            model_input = permutate_vectors_for_player_order(model_input, int(self.name),
+                                                             spec=EgoNeuralDistribution.spec)[:, 1:]
+            output = torch.sigmoid(self._logits(model_input)).reshape(-1).tolist()
+
+            if len(EgoNeuralDistribution.lookup) + len(missing) > EgoNeuralDistribution.max_lookup_size:
+                EgoNeuralDistribution.lookup = {}
+            for n, p in zip(missing, output):
+                EgoNeuralDistribution.lookup[keys[n]] = p
+
+        output = torch.tensor([EgoNeuralDistribution.lookup[key] for key in keys])[inverse]
+        return torch.where(X[:, 0] == 1, output, 1 - output)
+
+    def _logits(self, model_input):
+        compiled = EgoNeuralDistribution.compiled
+        if compiled is not None and compiled.calibrated == self.calibrated:
+            return compiled(model_input)
+
+        exported = EgoNeuralDistribution.exported
+        if exported is not None and exported.calibrated == self.calibrated:
+            return exported(model_input)
+
+        if not EgoNeuralDistribution.weights_loaded:
+            raise RuntimeError("The belief network has no trained weights, load_from_file or fit it first")
         if self.calibrated:
-            EgoNeuralDistribution.calibrated_model.eval()
+            model = EgoNeuralDistribution.calibrated_model
         else:
-            EgoNeuralDistribution.model.eval()
+            model = EgoNeuralDistribution.model
+        model.eval()
 
         with torch.no_grad():
-            model_input = torch.tensor([permutate_vector_for_player_order(X, int(self.name))[1:]])
-            expected_output = torch.tensor(X[0])
-
-            if self.calibrated:
-                output = EgoNeuralDistribution.calibrated_model(model_input)
-            else:
-                output = EgoNeuralDistribution.model(model_input)
-            output = torch.sigmoid(output).item()
-
-        if expected_output == 1:
-            return output
-        else:
-            return 1 - output
-
+            return model(model_input)
 
     # This funciton can be just the log of probability function. left unimplemented for now because it is not used
     def log_probability(self, X):
@@ -263,46 +421,32 @@ class EgoNeuralDistribution(Distribution):
     
     def load_from_file(self, folder_path):
         print("Calibration status: ", self.calibrated)
-        script_dir = "our/models/"
-        if not self.calibrated:
-            file_path = os.path.join(script_dir, folder_path, "ego_centric_model.pth" )
-        else:
-            file_path = os.path.join(script_dir, folder_path, "ego_model_2_calibrated.pth" )
-
-
-        # file_path = folder_path + "ego_centric_model" + ".pth"
-        if os.path.exists(file_path):
-            if not self.calibrated:
-                self.model.load_state_dict(torch.load(file_path, weights_only=True))
-            else:
-                self.calibrated_model.load_state_dict(torch.load(file_path, weights_only=True))
-            return
-        else:
+        if not EgoNeuralDistribution.load_weights(folder_path, self.calibrated):
             raise ValueError("File not found for factor ", self.name)
 
-
-    def summarize(self, X, X_valid=None, sample_weight=None, from_file=None, num_epochs=500, i=0):
-        """Instead of extracting the sufficient statistics, we will train the model on the data."""
+        # an export of exactly these weights is used for inference in place of the compiled model
+        export_path = os.path.join(MODELS_DIR, folder_path, EgoNeuralDistribution.export_files[self.calibrated])
+        if os.path.exists(export_path):
+            exported = ExportedCategoricalNN(export_path)
+            if (exported.calibrated == self.calibrated and
+                    exported.matches(EgoNeuralDistribution.model, EgoNeuralDistribution.fingerprint(self.calibrated))):
+                EgoNeuralDistribution.exported = exported
+                return
+            print("Exported model ", export_path, " does not match the loaded weights, compiling the weights")
+        EgoNeuralDistribution.compile(self.calibrated)
+
+
+    def summarize(self, X, X_valid=None, sample_weight=None, from_file=None, num_epochs=500, i=0,
+                  batch_size=2048, num_threads=None, compile=False, checkpoint_path=None):
+        """Instead of extracting the sufficient statistics, we will train the model on the data.
+        The model is trained in mini-batches of batch_size (None trains on the full batch every epoch),
+        see trainer.train_model for num_threads, compile and checkpoint_path."""
         if from_file:
-            script_dir = "our/models/"
-            if self.calibrated:
-                file_path = os.path.join(script_dir, from_file, "ego_model_2_calibrated.pth" )
-
-                if os.path.exists(file_path):
-                    EgoNeuralDistribution.calibrated_model.load_state_dict(torch.load(file_path, weights_only=True))
-                    return
-                else:
-                    
-                    print("File not found for factor ", file_path, " Training the model from scratch")
-            else:
-                file_path = os.path.join(script_dir, from_file, "ego_centric_model.pth" )
-
-                if os.path.exists(file_path):
-                    EgoNeuralDistribution.model.load_state_dict(torch.load(file_path, weights_only=True))
-                    return
-                else:
-                    
-                    print("File not found for factor ", file_path, " Training the model from scratch")
+            if EgoNeuralDistribution.load_weights(from_file, self.calibrated):
+                EgoNeuralDistribution.compile(self.calibrated)
+                return
+            file_path = os.path.join(MODELS_DIR, from_file, EgoNeuralDistribution.weights_files[self.calibrated])
+            print("File not found for factor ", file_path, " Training the model from scratch")
 
         if EgoNeuralDistribution.trained:
             print("Egocentric model already trained")
@@ -345,89 +489,18 @@ class EgoNeuralDistribution(Distribution):
 
         print("set the weights for the classes: ", weight_for_class_0, weight_for_class_1)
 
-        train_losses = []
-        val_losses = []
-        train_accuracies = []
-        val_accuracies = []
-        train_f1_scores = []
-        val_f1_scores = []
-
-        # early_stopping = EarlyStopping(patience=20, delta=0.01)
-        early_stopping = EarlyStopping(patience=20, delta=0.001)
-
-
-        for epoch in range(num_epochs):
-            # Forward pass
-            outputs = EgoNeuralDistribution.model(X_train)
-            loss = criterion(outputs.squeeze(), Y_train.float())
-
-            # Backward pass and optimization
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            train_losses.append(loss.item())
-
-            outputs = torch.sigmoid(outputs)
-
-            predicted_train = (outputs.squeeze() > 0.5).float()
-            train_accuracy = (predicted_train == Y_train.float()).sum().item() / Y_train.size(0)
-            train_accuracies.append(train_accuracy)
-
-
-            tp = ((predicted_train == 1) & (Y_train == 1)).sum().item()
-            fp = ((predicted_train == 1) & (Y_train == 0)).sum().item()
-            fn = ((predicted_train == 0) & (Y_train == 1)).sum().item()
-            tn = ((predicted_train == 0) & (Y_train == 0)).sum().item()
-            print_train = ('tp:', tp, 'fp:', fp, 'fn:', fn, 'tn:', tn)
-
-            if tp == 0:
-                f1 = 0
-            else:
-                precision = tp / (tp + fp)
-                recall = tp / (tp + fn)
-                f1 = 2 * (precision * recall) / (precision + recall)
-            train_f1_scores.append(f1)
-
-            with torch.no_grad():
-                val_outputs = EgoNeuralDistribution.model(X_val)
-                val_loss = criterion(val_outputs.squeeze(), Y_val.float())
-                val_losses.append(val_loss.item())
-                val_outputs = torch.sigmoid(val_outputs)
-                predicted = (val_outputs.squeeze() > 0.5).float()
-                accuracy = (predicted == Y_val.float()
-                            ).sum().item() / Y_val.size(0)
-                val_accuracies.append(accuracy)
-
-                tp = ((predicted == 1) & (Y_val == 1)).sum().item()
-                fp = ((predicted == 1) & (Y_val == 0)).sum().item()
-                fn = ((predicted == 0) & (Y_val == 1)).sum().item()
-                tn = ((predicted == 0) & (Y_val == 0)).sum().item()
-                print_valid = ('tp:', tp, 'fp:', fp, 'fn:', fn, 'tn:', tn)
-                if tp == 0:
-                    f1 = 0
-                else:
-                    precision = tp / (tp + fp)
-                    recall = tp / (tp + fn)
-                    f1 = 2 * (precision * recall) / (precision + recall)
-                val_f1_scores.append(f1)
-
-            if (epoch + 1) % 10 == 0:
-                print(
-                    f'Epoch [{epoch+1}/{num_epochs}], Loss: {loss.item():.4f}')
-
-                print(f'Validation Accuracy: {accuracy:.4f}')
-
-                print(f'Validation Loss: {val_loss.item():.4f}')
-                print("train state: ", print_train)
-                print("valid state: ", print_valid)
-            early_stopping(val_loss, EgoNeuralDistribution.model)
-            if early_stopping.early_stop:
-                print("Early stopping at epoch ", epoch)
-                break
-        early_stopping.load_best_model(EgoNeuralDistribution.model)
-        print("final train state: ", print_train)
-        print("final valid state: ", print_valid)
+        history = train_model(EgoNeuralDistribution.model,
+                              TensorBatches(X_train, Y_train, batch_size=batch_size),
+                              TensorBatches(X_val, Y_val, batch_size=batch_size, shuffle=False),
+                              criterion, optimizer, num_epochs=num_epochs, patience=20, delta=0.001,
+                              num_threads=num_threads, compile=compile, checkpoint_path=checkpoint_path)
+        EgoNeuralDistribution.invalidate()
+        EgoNeuralDistribution.weights_loaded = True
+        train_losses, val_losses = history["train_losses"], history["val_losses"]
+        train_accuracies, val_accuracies = history["train_accuracies"], history["val_accuracies"]
+        train_f1_scores, val_f1_scores = history["train_f1_scores"], history["val_f1_scores"]
+        print("final train state: ", history["train_confusion"])
+        print("final valid state: ", history["val_confusion"])
 
         if self.graph:
             draw_graphs(train_losses, val_losses, train_accuracies, val_accuracies, train_f1_scores, val_f1_scores, self.name, i)
@@ -487,112 +560,39 @@ def cyclic_perm(a):
     b = [[a[i - j] for i in range(n)] for j in range(n)]
     return b
 
-def permutate_vector_for_player_order(vector, player_order):
+# QUEST_PERMUTATIONS[player][i][value] is the ego centric value of quest variable i in the six player game
+QUEST_PERMUTATIONS = [SIX_PLAYER_GAME.quest_permutations(player_order) for player_order in range(6)]
+
+# the same tables flattened for gathering with the offset of each variable, built once per game spec and player
+_FLAT_QUEST_PERMUTATIONS = {}
+
+
+def _flat_quest_permutations(spec, player_order):
+    if (spec, player_order) not in _FLAT_QUEST_PERMUTATIONS:
+        tables = spec.quest_permutations(player_order)
+        offsets = torch.tensor([0] + [len(table) for table in tables[:-1]]).cumsum(0)
+        flat = torch.tensor([v for table in tables for v in table])
+        _FLAT_QUEST_PERMUTATIONS[(spec, player_order)] = (flat, offsets)
+    return _FLAT_QUEST_PERMUTATIONS[(spec, player_order)]
+
+
+def permutate_vector_for_player_order(vector, player_order, spec=SIX_PLAYER_GAME):
     """changes the ordering of the game vector to become 'ego centric' for the player in order"""
     # the vector only has the player in index 0, the rest are game history
     # in this code I have considered that a zero number means "unknown" for the partials
     if player_order == 0:
         return vector
-    
-    new_vector = [vector[0]] + [0, 0, 0] * 5
-    
-    first_quest = [vector[1], vector[2], vector[3]]
-    second_quest = [vector[4], vector[5], vector[6]]
-    third_quest = [vector[7], vector[8], vector[9]]
-    fourth_quest = [vector[10], vector[11], vector[12]]
-    fifth_quest = [vector[13], vector[14], vector[15]]
-
-    quests = [first_quest, second_quest, third_quest, fourth_quest, fifth_quest]
-
-    #replace the quest outcomes
-    for i in range(len(quests)):
-        new_vector[3 + (i*3)] = quests[i][2]
-
-    players = [0,1,2,3,4,5]
-    player_permutations = cyclic_perm(players)
-    ego_permutation = player_permutations[-1 * player_order]
-
-    # replace the votes for the new composition
-    old_vote_compositions = []
-    new_vote_compositions = []
-    for L in range(4, 6 + 1):
-        for subset in combinations(players, L):
-            old_vote_compositions.append(set(subset))
-        for new_subset in combinations(ego_permutation, L):
-            new_vote_compositions.append(set(new_subset))
-    
-    new_votes = []
-    for i in range(len(quests)):
-        quest = quests[i]
-        if quest[1] != 0:
-            old_vots = old_vote_compositions[quest[1] - 1]
 
-            new_vote = new_vote_compositions.index(old_vots) + 1
-        else:
-            new_vote = 0
-        new_vector[2 + (i*3)] = new_vote
+    tables = spec.quest_permutations(player_order)
+    return [vector[0]] + [tables[i][value] for i, value in enumerate(vector[1:len(tables) + 1])]
 
-    
-    # replace the party for the 2p party
-    old_2p_compositions = []
-    new_2p_compositions = []
-    # for L in range(6 + 1):
-    for subset in combinations(players, 2):
-        old_2p_compositions.append(set(subset))
-    for new_subset in combinations(ego_permutation, 2):
-        new_2p_compositions.append(set(new_subset))
-
-    if quests[0][0] != 0:
-        old_comp = old_2p_compositions[quests[0][0] - 1]
-        new_vector[1] = new_2p_compositions.index(old_comp) + 1
-    else:
-        new_vector[1] = 0
-
-
-    # replace the party for the 3-player parties (quest 2 and 4)
-    old_3p_compositions = []
-    new_3p_compositions = []
-    for subset in combinations(players, 3):
-        old_3p_compositions.append(set(subset))
-    for new_subset in combinations(ego_permutation, 3):
-        new_3p_compositions.append(set(new_subset))
-    
-    #quest 2:
-    if quests[1][0] != 0:
-        old_comp = old_3p_compositions[quests[1][0] - 1]
-        new_vector[4] = new_3p_compositions.index(old_comp) + 1
-    else:
-        new_vector[4] = 0
-
-    #quest 4:
-    if quests[3][0] != 0:
-        old_comp = old_3p_compositions[quests[3][0] - 1]
-        new_vector[10] = new_3p_compositions.index(old_comp) + 1
-    else:
-        new_vector[10] = 0
-    
 
-    # replace the party for the 4-player parties (quest 3 and 5)
-    old_4p_compositions = []
-    new_4p_compositions = []
-    for subset in combinations(players, 4):
-        old_4p_compositions.append(set(subset))
-    for new_subset in combinations(ego_permutation, 4):
-        new_4p_compositions.append(set(new_subset))
-    
-    #quest 3:
-    if quests[2][0] != 0:
-        old_comp = old_4p_compositions[quests[2][0] - 1]
-        new_vector[7] = new_4p_compositions.index(old_comp) + 1
-    else:
-        new_vector[7] = 0
-
-    #quest 5:
-    if quests[4][0] != 0:
-        old_comp = old_4p_compositions[quests[4][0] - 1]
-        new_vector[13] = new_4p_compositions.index(old_comp) + 1
-    else:
-        new_vector[13] = 0
-    
-    # print(vector)
-    return new_vector
\ No newline at end of file
+def permutate_vectors_for_player_order(X, player_order, spec=SIX_PLAYER_GAME):
+    """vectorized permutate_vector_for_player_order for an (n, 1 + quest variables) integer tensor of game vectors"""
+    X = torch.as_tensor(X, dtype=torch.int64)
+    if player_order == 0:
+        return X
+
+    flat, offsets = _flat_quest_permutations(spec, player_order)
+    permuted = flat[X[:, 1:len(offsets) + 1] + offsets]
+    return torch.cat([X[:, :1], permuted], dim=1)
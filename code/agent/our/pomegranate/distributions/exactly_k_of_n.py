@@ -0,0 +1,151 @@
+# exactly_k_of_n.py
+
+import math
+import torch
+
+from .._utils import _cast_as_tensor
+from .._utils import _check_parameter
+
+from ._distribution import Distribution
+
+
+class ExactlyKOfN(Distribution):
+	"""A constraint that exactly k of n binary variables take the value 1.
+
+	This is the distribution a JointCategorical over n binary variables would
+	represent if every assignment with exactly k ones had probability
+	1 / (n choose k) and every other assignment had probability zero, e.g.
+	"exactly two of the six players are evil". Unlike the JointCategorical,
+	the 2^n table is never materialized. Log probabilities are computed
+	from the count of ones, and the messages used in belief propagation are
+	computed in closed form with a dynamic program over the number of ones,
+	which takes O(n * k) per message.
+
+	The parameters are fixed, so this distribution is always frozen and
+	cannot be fit to data.
+
+
+	Parameters
+	----------
+	n: int
+		The number of binary variables.
+
+	k: int
+		The number of variables that must take the value 1.
+
+	check_data: bool, optional
+		Whether to check properties of the data and potentially recast it to
+		torch.tensors. This does not prevent checking of parameters but can
+		slightly speed up computation when you know that your inputs are valid.
+		Setting this to False is also necessary for compiling.
+	"""
+
+	def __init__(self, n, k, check_data=True):
+		super().__init__(inertia=0.0, frozen=True, check_data=check_data)
+		self.name = "ExactlyKOfN"
+
+		self.n = _check_parameter(n, "n", min_value=1, dtypes=(int,))
+		self.k = _check_parameter(k, "k", min_value=0, max_value=n,
+			dtypes=(int,))
+
+		self.d = self.n
+		self.n_categories = tuple(2 for i in range(self.n))
+		self._initialized = True
+
+		self._reset_cache()
+
+	def _reset_cache(self):
+		self._log_prob = -math.log(math.comb(self.n, self.k))
+
+	def log_probability(self, X):
+		"""Calculate the log probability of each example.
+
+		Assignments with exactly k ones have log probability
+		-log(n choose k), every other assignment has log probability -inf.
+
+
+		Parameters
+		----------
+		X: list, tuple, numpy.ndarray, torch.Tensor, shape=(-1, self.d)
+			A set of examples to evaluate.
+
+
+		Returns
+		-------
+		logp: torch.Tensor, shape=(-1,)
+			The log probability of each example.
+		"""
+
+		X = _check_parameter(_cast_as_tensor(X), "X", value_set=(0, 1),
+			ndim=2, shape=(-1, self.d), check_parameter=self.check_data)
+
+		logps = torch.full((len(X),), self._log_prob)
+		logps[X.sum(dim=1) != self.k] = float("-inf")
+		return logps
+
+	def messages(self, incoming, alg="sum", targets=None):
+		"""Calculate the messages from this factor to its variables.
+
+		The message to variable i for value v is the sum (or max) over the
+		assignments of the other variables with exactly k - v ones of the
+		product of their incoming messages. It is computed with a dynamic
+		program whose state is the number of ones among the variables seen
+		so far, capped at k. The constant 1 / (n choose k) is left out
+		because messages are normalized.
+
+
+		Parameters
+		----------
+		incoming: list of torch.Tensor, shape=(-1, 2)
+			The message from each variable into the factor.
+
+		alg: str, optional
+			Either "sum" or "max" for sum-product or max-product. Default is
+			"sum".
+
+		targets: list or None, optional
+			The variables to calculate messages for. Default is all of them.
+
+
+		Returns
+		-------
+		messages: dict of torch.Tensor, shape=(-1, 2)
+			The unnormalized message to each target variable.
+		"""
+
+		if targets is None:
+			targets = range(self.n)
+
+		batch_size = incoming[0].shape[0]
+		messages = {}
+		for i in targets:
+			counts = torch.zeros(batch_size, self.k + 1, dtype=incoming[0].dtype)
+			counts[:, 0] = 1
+
+			for l in range(self.n):
+				if l == i:
+					continue
+
+				zero = counts * incoming[l][:, 0:1]
+				one = torch.zeros_like(counts)
+				one[:, 1:] = counts[:, :-1] * incoming[l][:, 1:2]
+
+				if alg == "sum":
+					counts = zero + one
+				elif alg == "max":
+					counts = torch.maximum(zero, one)
+
+			message = torch.zeros(batch_size, 2, dtype=counts.dtype)
+			message[:, 0] = counts[:, self.k]
+			if self.k > 0:
+				message[:, 1] = counts[:, self.k - 1]
+
+			messages[i] = message
+
+		return messages
+
+	def summarize(self, X, sample_weight=None):
+		return
+
+	def from_summaries(self):
+		return
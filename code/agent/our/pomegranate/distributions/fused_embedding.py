@@ -0,0 +1,63 @@
+import torch
+import torch.nn as nn
+
+
+class FusedEmbedding(nn.Module):
+    """The embeddings of several categorical variables in a single table.
+
+    Equivalent to one nn.Embedding per variable followed by torch.cat of the embeddings, but looked up with one
+    gather. Variable i owns the rows offsets[i] to offsets[i] + num_categories_list[i] of the table and its first
+    embedding_dim_list[i] columns. The table is as wide as the widest embedding; the unused columns are never
+    selected, so they do not affect the output or receive gradients.
+
+    With mask_missing the value 0 (unknown) embeds to zeros.
+
+    State dicts of the nn.ModuleList of nn.Embedding it replaces ("<prefix>.0.weight", "<prefix>.1.weight", ...)
+    are converted when they are loaded.
+    """
+    def __init__(self, num_categories_list, embedding_dim_list, mask_missing=False):
+        super(FusedEmbedding, self).__init__()
+        self.num_categories_list = list(num_categories_list)
+        self.embedding_dim_list = list(embedding_dim_list)
+        self.mask_missing = mask_missing
+
+        max_dim = max(self.embedding_dim_list)
+        # initialized like nn.Embedding
+        self.weight = nn.Parameter(torch.randn(sum(self.num_categories_list), max_dim))
+
+        self.register_buffer("offsets", torch.tensor([0] + self.num_categories_list[:-1]).cumsum(0), persistent=False)
+        columns = [i * max_dim + j for i, dim in enumerate(self.embedding_dim_list) for j in range(dim)]
+        self.register_buffer("columns", torch.tensor(columns), persistent=False)
+
+        self._register_load_state_dict_pre_hook(self._load_module_list)
+
+    def __len__(self):
+        return len(self.num_categories_list)
+
+    def variable_weight(self, i):
+        """the embedding table of variable i, the same as the weight of its nn.Embedding"""
+        start = int(self.offsets[i])
+        return self.weight[start:start + self.num_categories_list[i], :self.embedding_dim_list[i]]
+
+    def forward(self, x):
+        e = self.weight[x + self.offsets]                       # [batch_size, variables, max_dim]
+        if self.mask_missing:
+            e = e * (x != 0).unsqueeze(-1).to(e.dtype)
+        return e.flatten(1).index_select(1, self.columns)   # [batch_size, sum of the embedding dims]
+
+    def _load_module_list(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        keys = [prefix + "{}.weight".format(i) for i in range(len(self))]
+        if prefix + "weight" in state_dict or not all(key in state_dict for key in keys):
+            return
+
+        weight = torch.zeros_like(self.weight)
+        for i, key in enumerate(keys):
+            value = state_dict.pop(key)
+            shape = (self.num_categories_list[i], self.embedding_dim_list[i])
+            if tuple(value.shape) != shape:
+                error_msgs.append("size mismatch for {}: copying a param with shape {} from checkpoint, "
+                                  "the shape in current model is {}.".format(key, tuple(value.shape), shape))
+                continue
+            start = int(self.offsets[i])
+            weight[start:start + shape[0], :shape[1]] = value
+        state_dict[prefix + "weight"] = weight
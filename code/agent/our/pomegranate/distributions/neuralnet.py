@@ -12,6 +12,7 @@ from .._utils import _check_parameter
 from .._utils import _reshape_weights
 
 from ._distribution import Distribution
+from .fused_embedding import FusedEmbedding
 import os
 
 # from data_manager import permutate_vector_for_player_order
@@ -38,11 +39,8 @@ class CategoricalNN(nn.Module):
         """
         super(CategoricalNN, self).__init__()
 
-        # Embedding layers for each categorical variable
-        self.embeddings = nn.ModuleList([
-            nn.Embedding(num_categories, embedding_dim)
-            for num_categories, embedding_dim in zip(num_categories_list, embedding_dim_list)
-        ])
+        # Embedding layers for each categorical variable, fused into one table
+        self.embeddings = FusedEmbedding(num_categories_list, embedding_dim_list)
 
         # FC layers
         total_embedding_dim = sum(embedding_dim_list)
@@ -54,12 +52,8 @@ class CategoricalNN(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        # Split input into separate categorical variables
-        embedded = [self.embeddings[i](x[:, i])
-                    for i in range(len(self.embeddings))]
-
-        # concatenate embeddings
-        x = torch.cat(embedded, dim=1)
+        # embed every categorical variable, concatenated
+        x = self.embeddings(x)
 
         # FC layers
         x = self.relu(self.fc1(x))
@@ -181,6 +175,17 @@ class NeuralDistribution(Distribution):
             return 1 - output
 
 
+    def batch_probability(self, X):
+        """returns the probability of each row of X happening, using a single forward pass.
+        X is an (n, d) integer tensor of assignments to all variables connected to the factor, including the 0 index
+        """
+        X = torch.as_tensor(X, dtype=torch.int64)
+
+        with torch.no_grad():
+            output = self.model(X[:, 1:]).reshape(-1)
+
+        return torch.where(X[:, 0] == 1, output, 1 - output)
+
     # TODO - This funciton can be just the log of probability function. left unimplemented for now because it is not used
     def log_probability(self, X):
         raise NotImplementedError
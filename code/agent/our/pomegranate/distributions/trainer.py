@@ -0,0 +1,183 @@
+import os
+import copy
+
+import torch
+import torch.nn.functional as F
+
+
+class WeightedBCEWithLogitsLoss(torch.nn.BCEWithLogitsLoss):
+    """BCEWithLogitsLoss that also takes a weight per sample, e.g. the counts of a DeduplicatedGameDataset.
+    The loss is then the weighted mean, the same as the mean loss over the rows with every row repeated weight times"""
+    def forward(self, input, target, sample_weight=None):
+        if sample_weight is None:
+            return super(WeightedBCEWithLogitsLoss, self).forward(input, target)
+        loss = F.binary_cross_entropy_with_logits(input, target, weight=self.weight, pos_weight=self.pos_weight,
+                                                  reduction="none")
+        return (loss * sample_weight).sum() / sample_weight.sum()
+
+
+class TensorBatches(object):
+    """Iterates over (features, labels) mini-batches of two tensors, reshuffled on every pass.
+    batch_size=None gives a single full batch"""
+    def __init__(self, X, Y, batch_size=2048, shuffle=True):
+        self.X = X
+        self.Y = Y
+        self.batch_size = batch_size if batch_size is not None else max(len(X), 1)
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.X) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.X))
+        for start in range(0, len(self.X), self.batch_size):
+            if self.shuffle:
+                index = order[start:start + self.batch_size]
+                yield self.X[index], self.Y[index]
+            else:
+                yield self.X[start:start + self.batch_size], self.Y[start:start + self.batch_size]
+
+
+def _f1(tp, fp, fn):
+    if tp == 0:
+        return 0.0
+    precision = tp / (tp + fp)
+    recall = tp / (tp + fn)
+    return 2 * (precision * recall) / (precision + recall)
+
+
+def _run_epoch(model, loader, criterion, optimizer=None):
+    """one pass over the loader, trains when an optimizer is given.
+    batches of (features, labels, weights) count every sample weight times, the criterion then gets the weights too.
+    the loss and the confusion counts are accumulated on a tensor, so there is a single sync at the end of the epoch.
+    returns the mean loss, the accuracy, the f1 score and the confusion counts (tp, fp, fn, tn)"""
+    # [loss * samples, samples, tp, fp, fn, tn]
+    stats = torch.zeros(6, dtype=torch.float64)
+    for batch in loader:
+        features, labels = batch[0], batch[1].float().reshape(-1)
+        outputs = model(features).reshape(-1)
+        if len(batch) > 2:
+            weights = batch[2].double().reshape(-1)
+            loss = criterion(outputs, labels, batch[2].float().reshape(-1))
+        else:
+            weights = torch.ones(len(labels), dtype=torch.float64)
+            loss = criterion(outputs, labels)
+
+        if optimizer is not None:
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        with torch.no_grad():
+            predicted = outputs > 0  # same as sigmoid(outputs) > 0.5
+            positive = labels == 1
+            stats += torch.stack([
+                loss.detach().double() * weights.sum(),
+                weights.sum(),
+                weights[predicted & positive].sum(),
+                weights[predicted & ~positive].sum(),
+                weights[~predicted & positive].sum(),
+                weights[~predicted & ~positive].sum(),
+            ])
+
+    loss_sum, total, tp, fp, fn, tn = stats.tolist()
+    total = max(total, 1)
+    return loss_sum / total, (tp + tn) / total, _f1(tp, fp, fn), (int(tp), int(fp), int(fn), int(tn))
+
+
+def train_model(model, train_loader, val_loader, criterion, optimizer, num_epochs=500, patience=20, delta=0.001,
+                num_threads=None, compile=False, checkpoint_path=None, resume=False, run_identity=None, log_every=10):
+    """Trains a binary classifier that outputs logits, with early stopping on the validation loss.
+
+    train_loader and val_loader yield (features, labels) batches, e.g. DataLoaders or TensorBatches, or
+    (features, labels, sample weights) batches with a criterion that takes the weights (WeightedBCEWithLogitsLoss).
+    num_threads sets torch.set_num_threads for the training, compile trains through torch.compile(model).
+    With checkpoint_path the model, optimizer, early stopping state and history are saved after every epoch, and the
+    file is deleted once the training finishes. resume=True continues from that file if it exists (otherwise an old
+    checkpoint is overwritten); run_identity (e.g. the manifest of the dataset cache and the hyperparameters) is stored
+    in the checkpoint and resuming a checkpoint of a different identity raises a ValueError.
+    At the end the weights with the best validation loss are loaded into model.
+    returns the history: losses, accuracies and f1 scores for train and validation per epoch,
+    and the last confusion counts (tp, fp, fn, tn) of both
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    forward_model = model
+    if compile:
+        if hasattr(torch, "compile"):
+            forward_model = torch.compile(model)
+        else:
+            print("torch.compile is not available in this version of torch, training the eager model")
+
+    history = {"train_losses": [], "val_losses": [], "train_accuracies": [], "val_accuracies": [],
+               "train_f1_scores": [], "val_f1_scores": [], "train_confusion": None, "val_confusion": None}
+    best_loss = None
+    best_state = copy.deepcopy(model.state_dict())
+    counter = 0
+    start_epoch = 0
+
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, weights_only=False)
+        if checkpoint.get("run_identity") != run_identity:
+            raise ValueError("The checkpoint {} was written for another dataset or configuration, delete it or train "
+                             "without resuming".format(checkpoint_path))
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        history = checkpoint["history"]
+        best_loss = checkpoint["best_loss"]
+        best_state = checkpoint["best_state"]
+        counter = checkpoint["counter"]
+        start_epoch = checkpoint["epoch"] + 1
+        print("Resuming training from epoch ", start_epoch)
+
+    for epoch in range(start_epoch, num_epochs):
+        if counter >= patience:
+            break
+
+        model.train()
+        train_loss, train_accuracy, train_f1, train_confusion = _run_epoch(forward_model, train_loader, criterion, optimizer)
+
+        model.eval()
+        with torch.no_grad():
+            val_loss, val_accuracy, val_f1, val_confusion = _run_epoch(forward_model, val_loader, criterion)
+
+        for key, value in zip(["train_losses", "val_losses", "train_accuracies", "val_accuracies",
+                               "train_f1_scores", "val_f1_scores"],
+                              [train_loss, val_loss, train_accuracy, val_accuracy, train_f1, val_f1]):
+            history[key].append(value)
+        history["train_confusion"] = train_confusion
+        history["val_confusion"] = val_confusion
+
+        # early stopping, the best weights are copied because state_dict only references the live tensors
+        if best_loss is None or val_loss < best_loss - delta:
+            best_loss = val_loss
+            best_state = copy.deepcopy(model.state_dict())
+            counter = 0
+        else:
+            counter += 1
+
+        if log_every and ((epoch + 1) % log_every == 0 or counter >= patience):
+            print(f"Epoch [{epoch+1}/{num_epochs}], "
+                  f"Train Loss: {train_loss:.4f}, Val Loss: {val_loss:.4f}, "
+                  f"Train Acc: {train_accuracy:.4f}, Val Acc: {val_accuracy:.4f}")
+            print("train state: ", ('tp:', train_confusion[0], 'fp:', train_confusion[1], 'fn:', train_confusion[2], 'tn:', train_confusion[3]))
+            print("valid state: ", ('tp:', val_confusion[0], 'fp:', val_confusion[1], 'fn:', val_confusion[2], 'tn:', val_confusion[3]))
+        if counter >= patience:
+            print("Early stopping at epoch ", epoch)
+
+        if checkpoint_path is not None:
+            tmp_path = checkpoint_path + ".tmp"
+            torch.save({"model": model.state_dict(), "optimizer": optimizer.state_dict(), "history": history,
+                        "best_loss": best_loss, "best_state": best_state, "counter": counter, "epoch": epoch,
+                        "run_identity": run_identity},
+                       tmp_path)
+            os.replace(tmp_path, checkpoint_path)
+
+    # the run is complete, a checkpoint left behind would end the next run before its first epoch
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    model.load_state_dict(best_state)
+    return history
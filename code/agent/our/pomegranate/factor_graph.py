@@ -4,11 +4,8 @@
 import time
 import torch
 import itertools
-from tqdm import tqdm
 import numpy as np
 
-from itertools import product
-
 from ._utils import _cast_as_tensor
 from ._utils import _update_parameter
 from ._utils import _check_parameter
@@ -21,6 +18,7 @@ from .distributions import NeuralDistribution
 from .distributions import EgoNeuralDistribution
 from .distributions import Categorical
 from .distributions import JointCategorical
+from .distributions import ExactlyKOfN
 
 
 class FactorGraph(Distribution):
@@ -62,8 +60,8 @@ class FactorGraph(Distribution):
 	----------
 	factors: tuple or list or None
 		A set of distribution objects. These do not need to be initialized,
-		i.e. can be "Categorical()". Currently, they must be either Categorical
-		or JointCategorical distributions. Default is None.
+		i.e. can be "Categorical()". Currently, they must be Categorical,
+		JointCategorical, ExactlyKOfN or neural distributions. Default is None.
 
 	marginals: tuple or list or None
 		A set of distribution objects. These must be initialized and be
@@ -82,9 +80,24 @@ class FactorGraph(Distribution):
 		The number of iterations to do in the inference step as distributions
 		are converging. Default is 10.
 
+	max_exact: int, optional
+		The largest number of joint assignments of the unobserved variables
+		of one example that exact inference (alg="exact") will enumerate.
+		Default is 65536.
+
 	tol: float, optional
-		The threshold at which to stop during fitting when the improvement
-		goes under. Default is 1e-6.
+		The threshold at which to stop during inference when the largest
+		change in any marginal estimate between two iterations goes under.
+		Default is 1e-6.
+
+	residual_tol: float or None, optional
+		The message schedule used during inference. When None, every factor
+		recomputes all of its outgoing messages on every iteration (flooding).
+		Otherwise, a factor only recomputes the messages whose incoming
+		messages have moved more than this threshold since they were last
+		computed. A value of 0.0 only skips messages whose inputs did not
+		change at all, which gives the same result as flooding. Default is
+		None.
 
 	inertia: float, [0, 1], optional
 		Indicates the proportion of the update to apply to the parameters
@@ -110,7 +123,8 @@ class FactorGraph(Distribution):
 	"""
 
 	def __init__(self, factors=None, marginals=None, edges=None, max_iter=20, 
-		tol=1e-6, inertia=0.0, frozen=False, check_data=True, verbose=False):
+		tol=1e-6, residual_tol=None, max_exact=65536, inertia=0.0, frozen=False, 
+		check_data=True, verbose=False):
 		super().__init__(inertia=inertia, frozen=frozen, check_data=check_data)
 		self.name = "FactorGraph"
 
@@ -126,6 +140,9 @@ class FactorGraph(Distribution):
 		self.max_iter = _check_parameter(max_iter, "max_iter", min_value=1, 
 			dtypes=[int, torch.int16, torch.int32, torch.int64])
 		self.tol = _check_parameter(tol, "tol", min_value=0)
+		self.residual_tol = _check_parameter(residual_tol, "residual_tol", 
+			min_value=0)
+		self.max_exact = _check_parameter(max_exact, "max_exact", min_value=1)
 		self.verbose = verbose
 
 		self.d = 0
@@ -152,6 +169,7 @@ class FactorGraph(Distribution):
 		self._initialized = not factors
 
 		self.trained = False
+		self._warm_state = None
 
 	def _initialize(self, d):
 		self._initialized = True
@@ -170,10 +188,11 @@ class FactorGraph(Distribution):
 			A distribution object to include as a node.
 		"""
 
-		if not isinstance(distribution, (Categorical, JointCategorical, NeuralDistribution, EgoNeuralDistribution)):
-			raise ValueError("Must be a Categorical or a JointCategorical or NeuralDistribution"
+		if not isinstance(distribution, (Categorical, JointCategorical, ExactlyKOfN, NeuralDistribution, EgoNeuralDistribution)):
+			raise ValueError("Must be a Categorical or a JointCategorical or ExactlyKOfN or NeuralDistribution"
 				" distribution.")
 
+		self._warm_state = None
 		self.factors.append(distribution)
 		self._factor_edges.append([])
 		self._factor_idxs[distribution] = len(self.factors) - 1
@@ -195,6 +214,7 @@ class FactorGraph(Distribution):
 		if not isinstance(distribution, Categorical):
 			raise ValueError("Must be a Categorical distribution.")
 		
+		self._warm_state = None
 		self.marginals.append(distribution)
 		self._marginal_edges.append([])
 		self._marginal_idxs[distribution] = len(self.marginals) - 1
@@ -233,6 +253,7 @@ class FactorGraph(Distribution):
 			if number_of_categories != marginal.n_keys:
 				raise ValueError("The number of categories in the factor and the marginal do not match.")
 
+		self._warm_state = None
 		self._factor_edges[f_idx].append(m_idx)
 		self._marginal_edges[m_idx].append(f_idx)
 
@@ -301,7 +322,242 @@ class FactorGraph(Distribution):
 		y = [t.argmax(dim=1) for t in self.predict_proba(X)]
 		return torch.vstack(y).T.contiguous()
 
-	def predict_proba(self, X, alg="max"):
+	def _marginal_messages(self, marginals, in_messages, out_messages):
+		"""Update the messages leaving each marginal towards its factors.
+
+		Each message is the marginal times the messages coming in from every
+		other factor connected to it, normalized. `out_messages` is updated in
+		place.
+		"""
+
+		for i, m in enumerate(marginals):
+			ni_edges = len(self._marginal_edges[i])
+
+			for k in range(ni_edges):
+				message = torch.clone(m)
+
+				for l in range(ni_edges):
+					if k == l:
+						continue
+
+					message *= in_messages[i][l]
+
+				j = self._marginal_edges[i][k]
+				for ik, parent in enumerate(self._factor_edges[j]):
+					if parent == i:
+						dims = tuple(range(1, len(message.shape)))
+						out_messages[j][ik] = message / message.sum(
+							dim=dims, keepdims=True)
+						break
+
+	def _mark_stale(self, inputs, references, stale):
+		"""Mark the outgoing messages of a factor that must be recomputed.
+
+		Under the flooding schedule every message is marked. Under the
+		residual schedule, when the incoming message on an edge has moved more
+		than `residual_tol` away from the one the factor last accounted for,
+		the messages on all of the other edges are marked and the reference
+		is moved forward. Because the reference only moves when an edge is
+		marked, small changes accumulate until they cross the threshold.
+
+
+		Parameters
+		----------
+		inputs: list of torch.Tensor
+			The current messages from each connected marginal into the factor.
+
+		references: list of torch.Tensor
+			The incoming messages last accounted for. Updated in place.
+
+		stale: set
+			The edges whose outgoing message must be recomputed. Updated in
+			place.
+		"""
+
+		d = len(inputs)
+		if self.residual_tol is None:
+			stale.update(range(d))
+			return
+
+		for v in range(d):
+			if inputs[v] is references[v]:
+				continue
+
+			residual = torch.max(torch.abs(inputs[v] - references[v])).item()
+			if residual > self.residual_tol:
+				references[v] = inputs[v]
+				stale.update(k for k in range(d) if k != v)
+
+	def _neural_messages(self, f, incoming, alg, skip=()):
+		"""Calculate the messages going out of a neural factor in one pass.
+
+		Rather than querying the factor one assignment at a time, every
+		assignment that carries weight (the target variable takes each of its
+		values and every other variable takes a value with a nonzero incoming
+		message) is enumerated into a single index tensor for every example
+		in the batch. The factor is evaluated on all of them with one batched
+		call and the messages are reduced with scatter operations.
+
+
+		Parameters
+		----------
+		f: NeuralDistribution or EgoNeuralDistribution
+			The factor sending the messages.
+
+		incoming: list of torch.Tensor, shape=(n, n_categories)
+			The message from each connected marginal into the factor, in the
+			order of the edges of the factor.
+
+		alg: str
+			Either "sum" or "max" for sum-product or max-product.
+
+		skip: list or tuple, optional
+			The edges for which no outgoing message is needed. Default is ().
+
+
+		Returns
+		-------
+		messages: dict of torch.Tensor, shape=(n, n_categories)
+			The unnormalized message for every edge that is not skipped.
+		"""
+
+		d = len(incoming)
+		n = incoming[0].shape[0]
+		targets = [k for k in range(d) if k not in skip]
+		if len(targets) == 0:
+			return {}
+
+		sizes = [f.categories[k] for k in targets]
+		offsets = np.cumsum([0] + sizes[:-1])
+		width = sum(sizes)
+
+		assignments, rows, columns, slots = [], [], [], []
+		for j in range(n):
+			supports = [torch.nonzero(m[j] > 0).flatten() for m in incoming]
+
+			for k, offset in zip(targets, offsets):
+				axes = [torch.arange(f.categories[k]) if v == k else supports[v] 
+					for v in range(d)]
+				grid = torch.cartesian_prod(*axes).reshape(-1, d)
+
+				assignments.append(grid)
+				rows.append(torch.full((grid.shape[0],), j))
+				columns.append(torch.full((grid.shape[0],), k))
+				slots.append(grid[:, k] + j * width + int(offset))
+
+		assignments = torch.cat(assignments)
+		rows = torch.cat(rows)
+		columns = torch.cat(columns)
+		slots = torch.cat(slots)
+
+		# weight each assignment by the incoming messages of all variables
+		# except the one the message is being sent to
+		weights = torch.stack([incoming[v][rows, assignments[:, v]] 
+			for v in range(d)], dim=1)
+		weights[torch.arange(len(assignments)), columns] = 1
+		weights = f.batch_probability(assignments) * weights.prod(dim=1)
+
+		reduced = torch.zeros(n * width, dtype=weights.dtype)
+		if alg == "sum":
+			reduced.index_add_(0, slots, weights)
+		elif alg == "max":
+			reduced.scatter_reduce_(0, slots, weights, reduce="amax")
+
+		reduced = torch.split(reduced.reshape(n, width), sizes, dim=1)
+		return dict(zip(targets, reduced))
+
+	def _exact_marginals(self, X, marginals):
+		"""Calculate the exact marginal of every variable by enumeration.
+
+		For each example, every joint assignment of the unobserved variables
+		is enumerated, with the observed variables fixed to their evidence.
+		Each assignment is scored by the product of the marginal (prior)
+		distributions and all factors. The table factors are scored first so
+		that assignments they rule out, e.g. because of a constraint, are
+		dropped before the neural factors are evaluated. The neural factors
+		are then evaluated on all remaining assignments of all examples in a
+		single batched call each. The marginals are the normalized sums of
+		the scores.
+
+		This is feasible whenever the unobserved variables have a small
+		joint space, which is the case for the role variables of the Avalon
+		graph when the quests are given.
+
+
+		Parameters
+		----------
+		X: torch.masked.MaskedTensor, shape=(n, d)
+			The evidence, see `predict_proba`.
+
+		marginals: list of torch.Tensor, shape=(n, n_categories)
+			The distribution of each marginal with the evidence clamped.
+
+
+		Returns
+		-------
+		marginals: list of torch.Tensor, shape=(n, n_categories)
+			The exact marginal distribution of each variable.
+		"""
+
+		n, d = X.shape
+		n_keys = [m.shape[-1] for m in marginals]
+
+		assignments, rows = [], []
+		for j in range(n):
+			axes = []
+			for i in range(d):
+				if X._masked_mask[j, i]:
+					axes.append(X._masked_data[j, i:i+1].long())
+				else:
+					axes.append(torch.arange(n_keys[i]))
+
+			size = np.prod([len(axis) for axis in axes])
+			if size > self.max_exact:
+				raise ValueError("Exact inference would enumerate {} assignments "
+					"for example {}, more than max_exact={}.".format(size, j, 
+					self.max_exact))
+
+			grid = torch.cartesian_prod(*axes).reshape(-1, d)
+			assignments.append(grid)
+			rows.append(torch.full((grid.shape[0],), j))
+
+		assignments = torch.cat(assignments)
+		rows = torch.cat(rows)
+
+		weights = torch.ones(len(assignments))
+		for i, m in enumerate(marginals):
+			weights = weights * m[rows, assignments[:, i]]
+
+		neural = []
+		for i, f in enumerate(self.factors):
+			values = assignments[:, self._factor_edges[i]]
+			if isinstance(f, (NeuralDistribution, EgoNeuralDistribution)):
+				neural.append(i)
+			elif isinstance(f, Categorical):
+				weights = weights * f.probs[0][values[:, 0]].detach()
+			elif isinstance(f, ExactlyKOfN):
+				weights = weights * torch.exp(f.log_probability(values))
+			else:
+				weights = weights * f.probs[tuple(values.T)].detach()
+
+		keep = weights > 0
+		assignments, rows, weights = assignments[keep], rows[keep], weights[keep]
+
+		for i in neural:
+			f = self.factors[i]
+			weights = weights * f.batch_probability(
+				assignments[:, self._factor_edges[i]])
+
+		current_marginals = []
+		for i in range(d):
+			p = torch.zeros(n * n_keys[i], dtype=weights.dtype)
+			p.index_add_(0, rows * n_keys[i] + assignments[:, i], weights)
+			p = p.reshape(n, n_keys[i])
+			current_marginals.append(p / p.sum(dim=1, keepdims=True))
+
+		return current_marginals
+
+	def predict_proba(self, X, alg="max", warm_start=False):
 		"""Predict the probability of each variable given some evidence.
 
 		Given some evidence about the value that each variable takes, infer
@@ -322,6 +578,20 @@ class FactorGraph(Distribution):
 			observed values and the mask is False for missing values. It does
 			not matter what the underlying value in the tensor is for the 
 			missing values.
+
+		alg: str, optional
+			Either "max" or "sum" for max-product or sum-product loopy belief
+			propagation, or "exact" for the exact marginals computed by
+			enumerating the joint assignments of the unobserved variables,
+			see `_exact_marginals`. Default is "max".
+
+		warm_start: bool, optional
+			Whether to start from the messages the previous call converged
+			to instead of from the marginals. Only the messages affected by
+			evidence or priors that changed since then are recomputed, and
+			messages into marginals whose evidence changed are reset. Falls
+			back to a cold start when the previous call used a different
+			algorithm or batch size. Default is False.
 		"""
 
 		nm = len(self.marginals)
@@ -341,17 +611,19 @@ class FactorGraph(Distribution):
 			p = p.repeat((X.shape[0],) + tuple(1 for _ in p.shape))
 
 			# Use the evidence in the data to set marginal distributions
-			for j in range(X.shape[0]):
-				if X._masked_mask[j, i] == True:
-					value = X._masked_data[j, i]
-
-					p[j] = 0
-					p[j, value] = 1.0
+			observed = X._masked_mask[:, i]
+			if observed.any():
+				values = X._masked_data[observed, i].long()
+				p[observed] = torch.nn.functional.one_hot(values, 
+					p.shape[-1]).type(p.dtype)
 
 			marginals.append(p)
 			prior_marginals.append(torch.clone(p))
 			current_marginals.append(torch.clone(p))
 
+		if alg == "exact":
+			return self._exact_marginals(X, marginals)
+
 		# this part of the code is copying the factors of the model based on the number of inputs that we have.
 		# since in NN there will be only one input, I am ignoring this (kinda)
 		for i, f in enumerate(self.factors):
@@ -361,6 +633,9 @@ class FactorGraph(Distribution):
 				# non_masked_data = data[mask]
 				# factors.append(f.model(torch.stack([non_masked_data])).item())
 				factors.append(f.model)
+			elif isinstance(f, ExactlyKOfN):
+				# messages are computed in closed form, there is no table to copy
+				factors.append(f)
 			elif not isinstance(f, Categorical):
 				p = torch.clone(f.probs)
 				# print(p)
@@ -401,16 +676,63 @@ class FactorGraph(Distribution):
 		# out_messages each entry is the messages sending out from a factor
 		# each out message is ordered by the variables connected to the factor
 		# out messages is ordered by the factors in the model
+
+		# the incoming messages each factor last accounted for, and the edges
+		# whose outgoing message has to be recomputed, for the message schedule
+		references = [list(out_messages[i]) for i in range(nf)]
+		stale = [set(range(len(self._factor_edges[i]))) for i in range(nf)]
+
+		state = self._warm_state
+		warm = (warm_start and state is not None and state["alg"] == alg and
+			state["mask"].shape == X._masked_mask.shape)
+
+		if warm:
+			mask, data = X._masked_mask, X._masked_data
+			changed = (state["mask"] != mask) | (mask & (state["data"] != data))
+			changed = changed.any(dim=0)
+
+			for i, m in enumerate(marginals):
+				if not changed[i]:
+					in_messages[i] = list(state["in_messages"][i])
+
+			self._marginal_messages(marginals, in_messages, out_messages)
+			references = [list(r) for r in state["references"]]
+			stale = [set(k for k, j in enumerate(self._factor_edges[i]) 
+				if changed[j]) for i in range(nf)]
+			prior_marginals = [torch.clone(d) for d in state["marginals"]]
+
 		# Begin iterations
 		iteration = 0
 		while iteration < self.max_iter:
 			# Update the messages going into the nodes.
 			for i in range(len(self.factors)):
+				if iteration > 0 or warm:
+					self._mark_stale(out_messages[i], references[i], stale[i])
+
+				if len(stale[i]) == 0:
+					continue
+
 				f = self.factors[i]
-				if not (isinstance(f, NeuralDistribution) or isinstance(f, EgoNeuralDistribution)):
+				if isinstance(f, ExactlyKOfN):
+					messages = f.messages(out_messages[i], alg, 
+						targets=sorted(stale[i]))
+
+					for k, m2 in messages.items():
+						j = self._factor_edges[i][k]
+
+						for ik, parent in enumerate(self._marginal_edges[j]):
+							if parent == i:
+								in_messages[j][ik] = m2 / m2.sum(		# normalizing
+									dim=1, keepdims=True)
+								break
+
+				elif not (isinstance(f, NeuralDistribution) or isinstance(f, EgoNeuralDistribution)):
 					f = factors[i]
 					ni_edges = len(self._factor_edges[i])
 					for k in range(ni_edges):
+						if k not in stale[i]:
+							continue
+
 						# lets see what message does here :))
 						message = torch.clone(f)
 						shape = torch.ones(len(message.shape), dtype=torch.int32)
@@ -448,49 +770,17 @@ class FactorGraph(Distribution):
 	
 				else:
 					ni_edges = len(self._factor_edges[i])
-					# for every edge connected to the factor
-					for k in range(ni_edges):
-						 # Iterate over each possible value of the target variable
-						message = {}
-						for x_i_val in range(f.categories[k]):
-							sum_over_values = 0
-							max_over_values = 0  # this is for max-product algorithms
-							# Iterate over all combinations of values for other variables in the factor
-							other_vars = [var for var in range(ni_edges) if var != k]
-							relevant_values = {
-								var: [val for val, prob in enumerate(out_messages[i][var][0]) if prob > 0]
-								for var in other_vars
-							}
-							# Generate only the combinations of non-zero incoming messages
-							relevant_combinations = product(*[relevant_values[var] for var in other_vars])
-							combs = [ i for i in relevant_combinations]
-							iteration_helper = combs
-							if self.verbose:
-								iteration_helper = tqdm(combs)
-							for other_vals in iteration_helper:
-								# Construct a full variable assignment for the factor
-								var_values = {k: x_i_val}
-								var_values.update({var: val for var, val in zip(other_vars, other_vals)})
-
-								# Evaluate the joint probability and add to the sum
-								
-								joint_prob = f.probability([var_values[var] for var in range(ni_edges)])
-
-								# Multiply by the incoming messages from each of the other variables
-								product_of_messages = joint_prob
-								for var, val in var_values.items():
-									if var != k:
-										product_of_messages *= out_messages[i][var][0][var_values[var]]
-								sum_over_values += product_of_messages
-								max_over_values = max(max_over_values, product_of_messages)
-
-							# Store the sum in the message for the current value of the target variable
-							if alg == "sum":
-								message[x_i_val] = sum_over_values
-							elif alg == "max":
-								message[x_i_val] = max_over_values
-						m2 = torch.tensor([[message[i] for i in message.keys()]])
+					incoming = [out_messages[i][k] for k in range(ni_edges)]
+
+					# marginals clamped to evidence keep their one-hot estimate whatever
+					# this factor says, so there is no need to compute messages for them
+					observed = [k for k, j in enumerate(self._factor_edges[i]) 
+						if X._masked_mask[:, j].all()]
+					fresh = [k for k in range(ni_edges) if k not in stale[i]]
 
+					messages = self._neural_messages(f, incoming, alg, 
+						skip=observed + fresh)
+					for k, m2 in messages.items():
 						j = self._factor_edges[i][k]
 
 						for ik, parent in enumerate(self._marginal_edges[j]):
@@ -502,8 +792,10 @@ class FactorGraph(Distribution):
 								break
 
 
+				stale[i].clear()
+
 			# Calculate the current estimates of the marginals
-			loss = 0
+			delta = 0
 			for i, m in enumerate(marginals):
 				current_marginals[i] = torch.clone(m)
 
@@ -516,48 +808,34 @@ class FactorGraph(Distribution):
 				current_marginals[i] /= current_marginals[i].sum(dim=dims, 
 					keepdims=True)
 
-				loss += torch.nn.KLDivLoss(reduction="batchmean")(torch.log(
-					current_marginals[i] + 1e-8), prior_marginals[i])
+				delta = max(delta, torch.max(torch.abs(current_marginals[i] - 
+					prior_marginals[i])).item())
 				
 
 			if self.verbose:
-				print(iteration, loss.item())
-
-			if loss < self.tol:
-				# print("CONVERGED")
-				# if self.verbose:
-				# 	print("c", out_messages)
-				# 	print("x", in_messages)
-				# 	print("breaking at ", iteration)
+				print(iteration, delta)
+
+			# converged once no marginal of any example moves more than tol
+			if delta < self.tol:
 				break
 
 
 			# Update the messages leaving based on the new marginals
-			for i, m in enumerate(marginals):
-				ni_edges = len(self._marginal_edges[i])
-
-				for k in range(ni_edges):
-					message = torch.clone(m)
-
-					for l in range(ni_edges):
-						if k == l:
-							continue
-
-						message *= in_messages[i][l]
-
-					j = self._marginal_edges[i][k]
-					for ik, parent in enumerate(self._factor_edges[j]):
-						if parent == i:
-							dims = tuple(range(1, len(message.shape)))
-							out_messages[j][ik] = message / message.sum(
-								dim=dims, keepdims=True)
-							break
+			self._marginal_messages(marginals, in_messages, out_messages)
 
 			prior_marginals = [torch.clone(d) for d in current_marginals]
 			iteration += 1
 
 			# print(current_marginals[:6])
 
+		self._warm_state = {
+			"alg": alg,
+			"mask": torch.clone(X._masked_mask),
+			"data": torch.clone(X._masked_data),
+			"in_messages": in_messages,
+			"references": references,
+			"marginals": current_marginals
+		}
 
 		return current_marginals
 
@@ -639,6 +917,7 @@ class FactorGraph(Distribution):
 		self.summarize(X, X_valid=X_valid, sample_weight=sample_weight, from_file=None)
 		self.from_summaries()
 		self.trained = True
+		self._warm_state = None
 		return self
 
 	def summarize(self, X, X_valid=None, sample_weight=None, from_file=None):
@@ -691,6 +970,15 @@ class FactorGraph(Distribution):
 		if self.frozen:
 			return
 
+		self._warm_state = None
+		# the ego centric factors share one model (or its TorchScript export,
+		# which EgoNeuralDistribution.load_from_file prefers), so it is
+		# loaded once per calibration setting
+		loaded = set()
 		for factor in self.factors:
-			if isinstance(factor, NeuralDistribution) or isinstance(factor, EgoNeuralDistribution):
+			if isinstance(factor, EgoNeuralDistribution):
+				if factor.calibrated not in loaded:
+					factor.load_from_file(folder_path)
+					loaded.add(factor.calibrated)
+			elif isinstance(factor, NeuralDistribution):
 				factor.load_from_file(folder_path)
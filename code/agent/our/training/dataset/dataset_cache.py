@@ -0,0 +1,166 @@
+"""
+Vectorizing the game logs parses every json file again, which takes minutes for the combined datasets.
+This module runs the vectorization once and writes every split as a uint8 .npy file that can be memory mapped,
+next to a manifest.json that records what the files were built from.
+The files hold one row per game, the augmentation listed in the manifest is applied by MyGameDataset when it is read:
+
+    cache_dir/
+        manifest.json       source paths and hashes, augmentation flags, train percentage, rows per split
+        train.npy           (games, 21) uint8, the roles followed by (party, vote, outcome) for every quest
+        validation.npy
+        test.npy
+
+A cache is only used when its manifest matches the current sources and settings, otherwise it is rebuilt.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .generate_dataset_1 import AVALONLOGS_6P_FOLDER
+from .generate_dataset_2 import FILE as PROAVALON_FILE
+from .vectorize_parallel import AUGMENTATION
+from .vectorize_parallel import SPLITS
+from .vectorize_parallel import vectorize_train_validation_test_sets as vectorize_data_parallel
+
+
+MANIFEST_FILE = "manifest.json"
+CACHE_VERSION = 2
+
+
+def hash_source(path):
+    """sha256 of a file, or of every file in a folder (in sorted order, including the file names)"""
+    sha = hashlib.sha256()
+    if os.path.isdir(path):
+        files = sorted(f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)))
+    else:
+        files = [None]
+
+    for file_name in files:
+        file_path = path if file_name is None else os.path.join(path, file_name)
+        if file_name is not None:
+            sha.update(file_name.encode())
+        with open(file_path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _sources(dataset_number, avalonlogs_folder, proavalon_file):
+    sources = {}
+    if dataset_number in [1, 12]:
+        sources["avalonlogs"] = avalonlogs_folder
+    if dataset_number in [2, 12]:
+        sources["proavalon"] = proavalon_file
+    if len(sources) == 0:
+        raise ValueError("Unknown dataset number {}".format(dataset_number))
+    return sources
+
+
+def _expected_manifest(dataset_number, train_percentage, sources):
+    return {
+        "version": CACHE_VERSION,
+        "dataset_number": dataset_number,
+        "train_percentage": train_percentage,
+        "augmentation": AUGMENTATION,
+        "sources": {name: {"path": os.path.abspath(path), "sha256": hash_source(path)} for name, path in sources.items()},
+    }
+
+
+def read_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+
+def is_cache_valid(cache_dir, dataset_number=12, train_percentage=0.8,
+                   avalonlogs_folder=AVALONLOGS_6P_FOLDER, proavalon_file=PROAVALON_FILE):
+    """checks that the cache was built from the current sources with the same settings"""
+    manifest = read_manifest(cache_dir)
+    if manifest is None:
+        return False
+
+    expected = _expected_manifest(dataset_number, train_percentage,
+                                  _sources(dataset_number, avalonlogs_folder, proavalon_file))
+    if any(manifest.get(key) != value for key, value in expected.items()):
+        return False
+    return all(os.path.exists(os.path.join(cache_dir, manifest["splits"][split]["file"])) for split in SPLITS)
+
+
+def build_cache(cache_dir, dataset_number=12, train_percentage=0.8,
+                avalonlogs_folder=AVALONLOGS_6P_FOLDER, proavalon_file=PROAVALON_FILE, processes=None):
+    """vectorizes the datasets like create_dataloaders does and writes the splits and the manifest into cache_dir.
+    the games are vectorized on a pool of processes, all cores by default"""
+    sources = _sources(dataset_number, avalonlogs_folder, proavalon_file)
+    manifest = _expected_manifest(dataset_number, train_percentage, sources)
+
+    splits = vectorize_data_parallel(dataset_number, train_percentage=train_percentage,
+                                     avalonlogs_folder=avalonlogs_folder, proavalon_file=proavalon_file,
+                                     processes=processes, augment=False)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest["splits"] = {}
+    for split, array in zip(SPLITS, splits):
+        file_name = split + ".npy"
+        # write next to the final file and rename, so a crashed build never leaves a truncated split behind
+        tmp_path = os.path.join(cache_dir, split + ".tmp.npy")
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(cache_dir, file_name))
+        manifest["splits"][split] = {"file": file_name, "rows": int(array.shape[0]), "columns": int(array.shape[1]),
+                                     "dtype": "uint8"}
+
+    # the manifest is written last, it marks the cache as complete
+    tmp_path = os.path.join(cache_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w") as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(tmp_path, os.path.join(cache_dir, MANIFEST_FILE))
+    return manifest
+
+
+def load_cache(cache_dir, mmap=True):
+    """returns the train, validation and test arrays of a cache. with mmap the files are memory mapped instead of read"""
+    manifest = read_manifest(cache_dir)
+    if manifest is None:
+        raise FileNotFoundError("No dataset cache in {}".format(cache_dir))
+
+    arrays = []
+    for split in SPLITS:
+        info = manifest["splits"][split]
+        array = np.load(os.path.join(cache_dir, info["file"]), mmap_mode="r" if mmap else None)
+        if array.shape != (info["rows"], info["columns"]):
+            raise ValueError("The {} split of the cache in {} does not match its manifest".format(split, cache_dir))
+        arrays.append(array)
+    return tuple(arrays)
+
+
+def load_or_build_cache(cache_dir, dataset_number=12, train_percentage=0.8, mmap=True,
+                        avalonlogs_folder=AVALONLOGS_6P_FOLDER, proavalon_file=PROAVALON_FILE, processes=None):
+    if not is_cache_valid(cache_dir, dataset_number, train_percentage, avalonlogs_folder, proavalon_file):
+        build_cache(cache_dir, dataset_number, train_percentage, avalonlogs_folder, proavalon_file, processes)
+    return load_cache(cache_dir, mmap=mmap)
+
+
+if __name__ == "__main__":
+    # e.g. python -m dataset.dataset_cache --cache_dir dataset_cache from the training folder
+    parser = argparse.ArgumentParser(description="Vectorize the game logs once into a memory mappable cache")
+    parser.add_argument("--cache_dir", type=str, required=True)
+    parser.add_argument("--dataset_number", type=int, default=12)
+    parser.add_argument("--train_percentage", type=float, default=0.8)
+    parser.add_argument("--avalonlogs_folder", type=str, default=AVALONLOGS_6P_FOLDER)
+    parser.add_argument("--proavalon_file", type=str, default=PROAVALON_FILE)
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes, all cores by default")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the cache is up to date")
+    args = parser.parse_args()
+
+    if args.force or not is_cache_valid(args.cache_dir, args.dataset_number, args.train_percentage,
+                                        args.avalonlogs_folder, args.proavalon_file):
+        manifest = build_cache(args.cache_dir, args.dataset_number, args.train_percentage,
+                               args.avalonlogs_folder, args.proavalon_file, args.processes)
+    else:
+        manifest = read_manifest(args.cache_dir)
+    print({split: info["rows"] for split, info in manifest["splits"].items()})
@@ -1,6 +1,7 @@
-import json
 import os
 
+from game_corpus import players_in_header
+
 # This file moves the logs with 6 players to a new folder
 
 def main():
@@ -11,13 +12,11 @@ def main():
     print(len(json_file_paths))
     for file_name in json_file_paths:
         # print(file_name)
-        with open(file_name, 'r') as file:
-            data = json.load(file)
-            player_size = len([player['name'] for player in data['players']])
-            player_sizes.append(player_size)
-            # plyer_names = [player['name'] for player in data['players']]
-            if player_size == 6:
-                file_names.append(file_name)
+        # only the players list at the start of the file is decoded
+        player_size = players_in_header(file_name)
+        player_sizes.append(player_size)
+        if player_size == 6:
+            file_names.append(file_name)
     
     
     new_folder = "6_player"
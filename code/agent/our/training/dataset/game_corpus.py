@@ -0,0 +1,239 @@
+"""
+Ingests the game logs into a partitioned JSON lines corpus with an offset index, so later stages can read the games
+they need without loading the sources:
+
+    corpus_dir/
+        manifest.json           source, player filter, partition files and number of games
+        games-00000.jsonl       one game per line, games_per_partition games per file
+        games-00001.jsonl
+        index.npy               per game: partition, byte offset, byte length, number of players
+
+The ProAvalon json array is read in chunks and decoded one game at a time, so only a chunk and one game are in
+memory. The avalonlogs files are filtered on the players list at the start of the file without decoding the rest,
+and copied as they are. python -m dataset.game_corpus from the training folder runs the ingestion.
+"""
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+
+MANIFEST_FILE = "manifest.json"
+INDEX_FILE = "index.npy"
+INDEX_DTYPE = np.dtype([("partition", "<u4"), ("offset", "<u8"), ("length", "<u4"), ("num_players", "u1")])
+
+_PLAYERS_KEY = re.compile(r'"players"\s*:\s*')
+# what may follow an element of a json array
+_ELEMENT_END = re.compile(r"[ \t\r\n,\]]")
+
+
+def players_in_header(file_path, header_size=1 << 16):
+    """the number of players of an avalonlogs game, decoded from the players list at the start of the file.
+    falls back to decoding the whole file when the list is not in the first header_size bytes"""
+    with open(file_path, "rb") as fh:
+        header = fh.read(header_size).decode("utf-8", errors="ignore")
+    match = _PLAYERS_KEY.search(header)
+    if match is not None:
+        try:
+            return len(json.JSONDecoder().raw_decode(header, match.end())[0])
+        except ValueError:
+            pass
+    with open(file_path, "r") as fh:
+        return len(json.load(fh)["players"])
+
+
+def iter_json_array(fh, chunk_size=1 << 20):
+    """yields the elements of a json array file one by one, reading chunk_size characters at a time.
+    an element is only decoded once the input after it is known, so that a number split by the end of a chunk
+    ("1.5" of "1.5e3") is not taken for the whole number"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+
+    while True:
+        # skip the separators between the elements
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if not started and position < len(buffer):
+            if buffer[position] != "[":
+                raise ValueError("The file does not hold a json array")
+            started = True
+            position += 1
+            continue
+        if started and position < len(buffer) and buffer[position] == "]":
+            return
+
+        try:
+            if position >= len(buffer):
+                raise ValueError
+            element, end = decoder.raw_decode(buffer, position)
+            following = _ELEMENT_END.search(buffer, end)
+            if following is None and not eof:
+                raise ValueError  # the element, or what follows it, may go on in the next chunk
+        except ValueError:
+            # the element continues in the next chunk
+            if eof:
+                if position >= len(buffer) and not started:
+                    return
+                raise ValueError("The json array ends in the middle of an element")
+            chunk = fh.read(chunk_size)
+            eof = chunk == ""
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        if (len(buffer) if following is None else following.start()) != end:
+            raise ValueError("The json array holds an invalid element at {!r}".format(buffer[position:end + 20]))
+        position = end
+        yield element
+
+
+class CorpusWriter(object):
+    """appends games (one line of json each) to the partitions of corpus_dir and records their offsets"""
+    def __init__(self, corpus_dir, games_per_partition=50000):
+        self.corpus_dir = corpus_dir
+        self.games_per_partition = games_per_partition
+        self.partitions = []
+        self.index = []
+        self._file = None
+        self._offset = 0
+        os.makedirs(corpus_dir, exist_ok=True)
+
+    def add(self, line, num_players):
+        """line is the game as json (bytes) without newlines"""
+        if self._file is None or len(self.index) % self.games_per_partition == 0:
+            self._next_partition()
+        self._file.write(line)
+        self._file.write(b"\n")
+        self.index.append((len(self.partitions) - 1, self._offset, len(line), num_players))
+        self._offset += len(line) + 1
+
+    def _next_partition(self):
+        if self._file is not None:
+            self._file.close()
+        file_name = "games-{:05d}.jsonl".format(len(self.partitions))
+        self.partitions.append(file_name)
+        self._file = open(os.path.join(self.corpus_dir, file_name), "wb")
+        self._offset = 0
+
+    def close(self, **manifest):
+        """writes the index and the manifest, the manifest is written last and marks the corpus as complete"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        tmp_path = os.path.join(self.corpus_dir, "index.tmp.npy")
+        np.save(tmp_path, np.array(self.index, dtype=INDEX_DTYPE))
+        os.replace(tmp_path, os.path.join(self.corpus_dir, INDEX_FILE))
+
+        manifest = dict(manifest, partitions=self.partitions, games=len(self.index))
+        tmp_path = os.path.join(self.corpus_dir, MANIFEST_FILE + ".tmp")
+        with open(tmp_path, "w") as fh:
+            json.dump(manifest, fh, indent=2)
+        os.replace(tmp_path, os.path.join(self.corpus_dir, MANIFEST_FILE))
+        return manifest
+
+
+def _keep(count, num_players):
+    return num_players is None or count in num_players
+
+
+def ingest_proavalon(file_path, corpus_dir, num_players=(6,), games_per_partition=50000):
+    """writes the games of the ProAvalon json file with numberOfPlayers in num_players (all with None) to a corpus"""
+    writer = CorpusWriter(corpus_dir, games_per_partition)
+    with open(file_path, "r") as fh:
+        for game in iter_json_array(fh):
+            count = game.get("numberOfPlayers", 0)
+            if _keep(count, num_players):
+                writer.add(json.dumps(game, separators=(",", ":")).encode(), count)
+    return writer.close(source=os.path.abspath(file_path), format="proavalon",
+                        num_players=None if num_players is None else list(num_players))
+
+
+def ingest_avalonlogs(folder_path, corpus_dir, num_players=(6,), games_per_partition=50000):
+    """writes the avalonlogs games of the folder with a number of players in num_players (all with None) to a corpus,
+    in the order of os.listdir like split_game_files"""
+    writer = CorpusWriter(corpus_dir, games_per_partition)
+    for file_name in os.listdir(folder_path):
+        file_path = os.path.join(folder_path, file_name)
+        if not os.path.isfile(file_path):
+            continue
+        count = players_in_header(file_path)
+        if _keep(count, num_players):
+            with open(file_path, "rb") as fh:
+                # json strings never hold a raw line break, so the game fits on one line once they are replaced
+                writer.add(fh.read().replace(b"\r", b" ").replace(b"\n", b" "), count)
+    return writer.close(source=os.path.abspath(folder_path), format="avalonlogs",
+                        num_players=None if num_players is None else list(num_players))
+
+
+class GameCorpus(object):
+    """
+    Reads the games of a corpus written by ingest_proavalon or ingest_avalonlogs.
+
+    corpus[i] decodes the i-th game only, seeking to it through the index; iterating reads the partitions in order.
+    """
+    def __init__(self, corpus_dir):
+        self.corpus_dir = corpus_dir
+        with open(os.path.join(corpus_dir, MANIFEST_FILE), "r") as fh:
+            self.manifest = json.load(fh)
+        self.index = np.load(os.path.join(corpus_dir, INDEX_FILE), mmap_mode="r")
+        self._files = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def raw(self, i):
+        """the json line of the i-th game"""
+        partition, offset, length, _ = self.index[i]
+        if partition not in self._files:
+            self._files[partition] = open(os.path.join(self.corpus_dir, self.manifest["partitions"][partition]), "rb")
+        fh = self._files[partition]
+        fh.seek(int(offset))
+        return fh.read(int(length))
+
+    def __getitem__(self, i):
+        return json.loads(self.raw(i))
+
+    def __iter__(self):
+        for file_name in self.manifest["partitions"]:
+            with open(os.path.join(self.corpus_dir, file_name), "rb") as fh:
+                for line in fh:
+                    yield json.loads(line)
+
+    def num_players(self):
+        """the number of players of every game"""
+        return np.asarray(self.index["num_players"])
+
+    def close(self):
+        for fh in self._files.values():
+            fh.close()
+        self._files = {}
+
+
+def is_corpus(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream the game logs into a partitioned json lines corpus")
+    parser.add_argument("--proavalon_file", type=str, default=None, help="the ProAvalon json file")
+    parser.add_argument("--avalonlogs_folder", type=str, default=None, help="the folder of avalonlogs game files")
+    parser.add_argument("--corpus_dir", type=str, required=True)
+    parser.add_argument("--players", type=int, nargs="*", default=[6], help="numbers of players to keep, none keeps all")
+    parser.add_argument("--games_per_partition", type=int, default=50000)
+    args = parser.parse_args()
+
+    num_players = args.players if args.players else None
+    if (args.proavalon_file is None) == (args.avalonlogs_folder is None):
+        parser.error("give exactly one of --proavalon_file and --avalonlogs_folder")
+    if args.proavalon_file is not None:
+        manifest = ingest_proavalon(args.proavalon_file, args.corpus_dir, num_players, args.games_per_partition)
+    else:
+        manifest = ingest_avalonlogs(args.avalonlogs_folder, args.corpus_dir, num_players, args.games_per_partition)
+    print("{} games in {} partitions".format(manifest["games"], len(manifest["partitions"])))
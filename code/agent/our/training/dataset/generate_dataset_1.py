@@ -1,4 +1,3 @@
-from itertools import combinations
 import os
 import json
 from itertools import permutations
@@ -6,8 +5,15 @@ import torch
 import csv
 from tqdm import tqdm
 
+try:
+    from ...game_spec import SIX_PLAYER_GAME, combination_rank
+except ImportError:  # dataset is imported as a top-level package with our/ on the path, e.g. by train_main.py
+    from game_spec import SIX_PLAYER_GAME, combination_rank
+
 
 AVALONLOGS_6P_FOLDER = "6_player"
+# the split of this dataset is fixed, the train_percentage given to vectorize_train_validation_test_sets is ignored
+AVALONLOGS_TRAIN_PERCENTAGE = 0.7
 def cyclic_perm(a):
     n = len(a)
     b = [[a[i - j] for i in range(n)] for j in range(n)]
@@ -41,13 +47,8 @@ def vectorize_game_history(json_data, circular=True, partial=False, extra=1):
 
         player_roles = {player['name']: 0 for player in json_data['players']}
 
-        vote_compositions = []
-        for L in range(4, 6 + 1):
-            for subset in combinations(player_names, L):
-                vote_compositions.append(subset)
-        
-        # turn it to set to make sure we can find things in it
-        vote_compositions = [set(vote_comp) for vote_comp in vote_compositions]
+        # parties and votes are indexed by the rank of the players' positions in this order
+        player_positions = {name: i for i, name in enumerate(player_names)}
 
         # this sets the player roles as either 0 or 1
         for role in json_data['outcome']['roles']:
@@ -69,11 +70,8 @@ def vectorize_game_history(json_data, circular=True, partial=False, extra=1):
             # proposer = final_proposals['proposer']
             # proposer = player_names.index(proposer)
 
-            party_compositions = list(combinations(player_names, team_size))
-            party_compositions = [set(party_comp) for party_comp in party_compositions]
-
-            team_comp_number = party_compositions.index(set(team))
-            vote_comp_number = vote_compositions.index(set(final_proposals['votes']))
+            team_comp_number = combination_rank([player_positions[name] for name in set(team)], len(player_names))
+            vote_comp_number = SIX_PLAYER_GAME.vote_index([player_positions[name] for name in set(final_proposals['votes'])]) - 1
 
             vector[6 + (i*3)] = team_comp_number + extra
             vector[6 + (i*3) + 1] = vote_comp_number + extra
@@ -143,14 +141,20 @@ def get_game_result(json_data):
 
 
 
-def vectorize_train_validation_test_sets(folder_path=AVALONLOGS_6P_FOLDER, train_percentage=0.7):
-    train_percentage = 0.7
-    train_vectors = []
+def split_game_files(folder_path=AVALONLOGS_6P_FOLDER, train_percentage=AVALONLOGS_TRAIN_PERCENTAGE):
+    """splits the game files of the folder into train, validation and test files"""
     files_list = os.listdir(folder_path)
     number_of_files = len(files_list)
     train_files = files_list[:int(number_of_files * train_percentage)]
     validation_files = files_list[int(number_of_files * train_percentage) : int(number_of_files * train_percentage) + int(number_of_files * (1 - train_percentage) / 2)]
     test_files = files_list[int(number_of_files * train_percentage) + int(number_of_files * (1 - train_percentage) / 2):]  
+    return train_files, validation_files, test_files
+
+
+def vectorize_train_validation_test_sets(folder_path=AVALONLOGS_6P_FOLDER, train_percentage=0.7):
+    train_percentage = AVALONLOGS_TRAIN_PERCENTAGE
+    train_vectors = []
+    train_files, validation_files, test_files = split_game_files(folder_path, train_percentage)
     for file_name in train_files:
         file_path = os.path.join(folder_path, file_name)
         if os.path.isfile(file_path):
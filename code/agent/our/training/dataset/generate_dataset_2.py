@@ -1,7 +1,11 @@
 import json
-from itertools import combinations
 from tqdm import tqdm
 
+try:
+    from ...game_spec import SIX_PLAYER_GAME, combination_rank
+except ImportError:  # dataset is imported as a top-level package with our/ on the path, e.g. by train_main.py
+    from game_spec import SIX_PLAYER_GAME, combination_rank
+
 # Read the JSON file
 FILE = 'Enter the direcotry path to the json file from the ProAvalon dataset here'
 
@@ -83,14 +87,6 @@ def vectorize_game(data, player_order):
     # print(name_2_index)
     name_2_index = {player_order[i]: i for i in range(len(player_order))}
     # print(name_2_index)
-    vote_compositions = []
-    for L in range(4, 6 + 1):
-        for subset in combinations(player_order, L):
-            vote_compositions.append(subset)
-    
-    # turn it to set to make sure we can find things in it
-    vote_compositions = [set(vote_comp) for vote_comp in vote_compositions]
-
     role_vector = [0] * len(player_order)
     for spy in spy_players:
         role_vector[name_2_index[spy]] = 1
@@ -119,11 +115,9 @@ def vectorize_game(data, player_order):
                 approving_players.append(player)
         
         mission_result = data['missionHistory'][mission_index]
-        party_compositions = list(combinations(player_order, len(picked_players)))
-        party_compositions = [set(party_comp) for party_comp in party_compositions]
-
-        team_comp_number = party_compositions.index(set(picked_players))
-        vote_comp_number = vote_compositions.index(set(approving_players))
+        # parties and votes are indexed by the rank of the players' positions in player_order
+        team_comp_number = combination_rank([name_2_index[p] for p in picked_players], len(player_order))
+        vote_comp_number = SIX_PLAYER_GAME.vote_index([name_2_index[p] for p in approving_players]) - 1
         mission_result_number = 1 if mission_result == "succeeded" else 0
         
 
@@ -177,6 +171,15 @@ def extract_all_data_from_game(game, circular=True, partial=True):
     return all_vectors_from_game
 
 
+def game_split(index, six_player_games, train_percentage):
+    """the split of the index-th six player game of the file, 0 for train, 1 for validation and 2 for test"""
+    if index < int(six_player_games * train_percentage):
+        return 0
+    elif index < int(six_player_games * train_percentage) + int(six_player_games * (1 - train_percentage) / 2):
+        return 1
+    return 2
+
+
 def vectorize_train_validation_test_sets(file_path=FILE, train_percentage=0.7):
     # train_percentage = 0.7
     with open(file_path, 'r') as file:
@@ -190,10 +193,11 @@ def vectorize_train_validation_test_sets(file_path=FILE, train_percentage=0.7):
     for game in tqdm(data):
         # print(game.get("roles"))
         if game.get("numberOfPlayers") == 6:
-            if index < int(six_player_games * train_percentage):
+            split = game_split(index, six_player_games, train_percentage)
+            if split == 0:
                 all_data = extract_all_data_from_game(game, circular=True, partial=True)
                 train_set += all_data
-            elif index < int(six_player_games * train_percentage) + int(six_player_games * (1 - train_percentage) / 2):
+            elif split == 1:
                 all_data = extract_all_data_from_game(game, circular=False, partial=True)
                 validation_set += all_data
             else:
@@ -1,11 +1,19 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import torch
 import json
+import warnings
+import numpy as np
 
 from .generate_dataset_1 import vectorize_train_validation_test_sets as vectorize_data_1
 from .generate_dataset_2 import vectorize_train_validation_test_sets as vectorize_data_2
+from .dataset_cache import load_cache, load_or_build_cache, read_manifest
 import random
 
+try:
+    from ...game_spec import SIX_PLAYER_GAME
+except ImportError:  # dataset is imported as a top-level package with our/ on the path, e.g. by train_main.py
+    from game_spec import SIX_PLAYER_GAME
+
 
 class MyGameDataset(Dataset):
     """
@@ -13,42 +21,171 @@ class MyGameDataset(Dataset):
       [label, discard1, discard2, discard3, discard4, discard5,
        input1, input2, ..., input15]
     and we want to return (features, label).
+
+    The rows are stored in a single uint8 tensor. Indexing with a list (or tensor) of indices returns the whole
+    batch at once, which is what the loaders of create_dataloaders do through a BatchSampler.
+
+    With circular and partial the augmentation of the vectorize functions is applied when the rows are read,
+    so data_list only has to hold one row per game:
+      circular: every cyclic order of the players, in the order of cyclic_perm
+      partial: the game truncated after each of its finished quests, longest first
+    The dataset then has one item per (game, order, truncation), in the order the vectorize functions produce them.
     """
-    def __init__(self, data_list):
+    def __init__(self, data_list, circular=False, partial=False, spec=SIX_PLAYER_GAME):
         super().__init__()
-        self.data_list = data_list
+        self.spec = spec
+        self.circular = circular
+        self.partial = partial
+        num_players = spec.num_players
+        num_columns = num_players + 3 * spec.num_quests
+        # a uint8 array of the right shape, e.g. the memory mapped cache, is used as is: worker processes that map
+        # the same cache files then share its pages instead of holding a copy each. lists are copied once
+        array = np.asarray(data_list, dtype=np.uint8)
+        if array.ndim != 2 or array.shape[1] != num_columns:
+            array = array.reshape(-1, num_columns)
+        with warnings.catch_warnings():
+            # the read only mapping of the cache, the rows are never written
+            warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+            self.data = torch.from_numpy(array)
+
+        # the number of finished quests and the end of the items of every game, the only per game index kept
+        # (the number of items of a game follows from its finished quests, see _counts)
+        self._finished = (self.data[:, num_players::3] != 0).sum(dim=1, dtype=torch.uint8)
+        self._ends = self._counts(torch.arange(len(self.data)))[1].cumsum(dim=0)
+
+        if circular:
+            # rotating the players by j moves the player in position k to position (k + j) % n, which is the ego
+            # centric order of the player in seat (n - j) % n
+            tables = [spec.quest_permutations((num_players - j) % num_players) for j in range(num_players)]
+            self._rotations = torch.tensor([[v for table in rotation for v in table] for rotation in tables])
+            self._offsets = torch.tensor([0] + [len(table) for table in tables[0][:-1]]).cumsum(dim=0)
+
+    def _counts(self, game):
+        """the number of truncations and the number of items of the games"""
+        if self.partial:
+            variants = self._finished[game].long().clamp(min=1)
+        else:
+            variants = torch.ones(len(game), dtype=torch.int64)
+        return variants, variants * (self.spec.num_players if self.circular else 1)
 
     def __len__(self):
-        return len(self.data_list)
+        return int(self._ends[-1]) if len(self._ends) > 0 else 0
 
     def __getitem__(self, idx):
-        row = self.data_list[idx]
-        # First element is the label
-        label = row[0]
-        # Remaining elements are the features
-        features = row[6:]
-        
-        # Convert to PyTorch tensors
-        label = torch.tensor(label, dtype=torch.float)     # or torch.long if classification
-        features = torch.tensor(features, dtype=torch.long)
-        
+        index = torch.as_tensor(idx, dtype=torch.int64)
+        single = index.dim() == 0
+        index = index.reshape(-1)
+
+        num_players = self.spec.num_players
+        game = torch.searchsorted(self._ends, index, right=True)
+        variants, counts = self._counts(game)
+        local = index - (self._ends[game] - counts)
+        rows = self.data[game].long()
+
+        if self.circular:
+            rotation = local // variants
+            players = (torch.arange(num_players).unsqueeze(0) - rotation.unsqueeze(1)) % num_players
+            roles = torch.gather(rows[:, :num_players], 1, players)
+            quests = self._rotations[rotation.unsqueeze(1), rows[:, num_players:] + self._offsets]
+            rows = torch.cat([roles, quests], dim=1)
+
+        if self.partial:
+            kept = self._finished[game].long() - local % variants
+            quest = torch.arange(self.spec.num_quests).repeat_interleave(3)
+            rows[:, num_players:] *= (quest.unsqueeze(0) < kept.unsqueeze(1))
+
+        # First element is the label, the game history after the roles are the features
+        label = rows[:, 0].float()     # or torch.long if classification
+        features = rows[:, num_players:]
+
+        if single:
+            return features[0], label[0]
         return features, label
 
 
+class DeduplicatedGameDataset(Dataset):
+    """
+    The distinct (features, label) items of a dataset, e.g. a MyGameDataset, with the number of times each occurs.
+
+    The augmentation repeats many items (every early game prefix appears once per game and player order), so
+    training on the distinct items with their counts as sample weights gives the same loss in far fewer rows,
+    see WeightedBCEWithLogitsLoss. Items are (features, label, count), indexing with a batch of indices works
+    like in MyGameDataset.
+
+    The items are read chunk_size at a time, every (label, features) row is packed into one int64 key in the
+    mixed radix of spec.num_categories_list() (rows only compared as a whole when the keys would not fit).
+    """
+    def __init__(self, dataset, chunk_size=1 << 20, spec=SIX_PLAYER_GAME):
+        super().__init__()
+        radix = torch.tensor(spec.num_categories_list(), dtype=torch.float64)
+        self._packed = bool(radix.prod() < 2 ** 62)
+        if self._packed:
+            self._radix = torch.tensor(spec.num_categories_list(), dtype=torch.int64)
+            self._place = torch.cat([self._radix.flip(0).cumprod(0).flip(0)[1:], torch.ones(1, dtype=torch.int64)])
+
+        keys, counts = [], []
+        for start in range(0, len(dataset), chunk_size):
+            features, label = dataset[torch.arange(start, min(start + chunk_size, len(dataset)))][:2]
+            rows = torch.cat([label.long().unsqueeze(1), features.long()], dim=1)
+            unique, count = self._unique(self._pack(rows), return_counts=True)
+            keys.append(unique)
+            counts.append(count)
+
+        if len(keys) == 0:
+            rows = torch.zeros(0, len(spec.num_categories_list()), dtype=torch.int64)
+            self.counts = torch.zeros(0)
+        else:
+            keys, inverse = self._unique(torch.cat(keys), return_inverse=True)
+            self.counts = torch.zeros(len(keys)).index_add_(0, inverse, torch.cat(counts).float())
+            rows = self._unpack(keys)
+
+        self.labels = rows[:, 0].float()
+        self.features = rows[:, 1:]
+        self.total = int(self.counts.sum())   # the number of items of the original dataset
+
+    def _pack(self, rows):
+        return (rows * self._place).sum(dim=1) if self._packed else rows
+
+    def _unpack(self, keys):
+        return keys.unsqueeze(1) // self._place % self._radix if self._packed else keys
+
+    def _unique(self, keys, **kwargs):
+        # dim=0 compares whole rows, packed keys take the much faster path without it
+        return torch.unique(keys, **kwargs) if self._packed else torch.unique(keys, dim=0, **kwargs)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return self.features[idx], self.labels[idx], self.counts[idx]
+
+
 def create_dataloaders(dataset_number=1,
                         train_percentage=0.8, 
                        batch_size=62910, #2048*8, 
-                       shuffle=True):
+                       shuffle=True,
+                       cache_dir=None,
+                       deduplicate=False):
     """
     1) Calls your 'vectorize_train_validation_sets' to get raw data.
+       With cache_dir the vectors are read from the memory mapped cache in that folder instead,
+       which is (re)built first if it is missing or its sources changed (see dataset_cache.py).
     2) Wraps them in Dataset objects.
+       With deduplicate the training items are collapsed into a DeduplicatedGameDataset, the train loader then
+       yields (features, labels, counts) batches to train with WeightedBCEWithLogitsLoss.
     3) Creates DataLoaders for training/validation.
 
     Returns:
         train_loader, val_loader
     """
     # Produce the raw data
-    if dataset_number == 1:
+    augmentation = {"train": {}, "validation": {}, "test": {}}
+    if cache_dir is not None:
+        train_vectors, validation_vectors, test_vectors = load_or_build_cache(
+            cache_dir, dataset_number=dataset_number, train_percentage=train_percentage
+        )   # one row per game, augmented by the datasets below
+        augmentation = read_manifest(cache_dir)["augmentation"]
+    elif dataset_number == 1:
         train_vectors, validation_vectors, test_vectors = vectorize_data_1(
             train_percentage=train_percentage
         )   # make suer the function is configured with circular and partial train and partial only validation
@@ -72,20 +209,33 @@ def create_dataloaders(dataset_number=1,
         random.shuffle(test_vectors)
 
     # Build Datasets
-    train_dataset = MyGameDataset(train_vectors)
-    val_dataset   = MyGameDataset(validation_vectors)
-    test_dataset  = MyGameDataset(test_vectors)  # if you need test dataset later
-
-    # Build DataLoaders
-    train_loader = DataLoader(train_dataset, 
-                              batch_size=batch_size, 
-                              shuffle=shuffle)
-    val_loader   = DataLoader(val_dataset, 
-                              batch_size=batch_size, 
-                              shuffle=False)
-    
-    test_loader  = DataLoader(test_dataset,
-                              batch_size=batch_size, 
-                              shuffle=False)  # if you need test dataset later
-
-    return train_loader, val_loader, test_loader
\ No newline at end of file
+    train_dataset = MyGameDataset(train_vectors, **augmentation["train"])
+    val_dataset   = MyGameDataset(validation_vectors, **augmentation["validation"])
+    test_dataset  = MyGameDataset(test_vectors, **augmentation["test"])  # if you need test dataset later
+    if deduplicate:
+        train_dataset = DeduplicatedGameDataset(train_dataset)
+
+    train_loader = make_dataloader(train_dataset, batch_size, shuffle)
+    val_loader   = make_dataloader(val_dataset, batch_size, False)
+    test_loader  = make_dataloader(test_dataset, batch_size, False)  # if you need test dataset later
+
+    return train_loader, val_loader, test_loader
+
+
+def make_dataloader(dataset, batch_size, shuffle):
+    """a DataLoader over a MyGameDataset, the dataset reads a whole batch of indices at once"""
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=False),
+                      batch_size=None)
+
+
+def load_cached_datasets(cache_dir, mmap=True, deduplicate=False):
+    """the train, validation and test MyGameDatasets of an existing cache (see dataset_cache.py),
+    without checking it against the sources. The splits are memory mapped while they are read.
+    With deduplicate the train split is a DeduplicatedGameDataset"""
+    augmentation = read_manifest(cache_dir)["augmentation"]
+    train, validation, test = (MyGameDataset(vectors, **augmentation[split])
+                               for split, vectors in zip(["train", "validation", "test"], load_cache(cache_dir, mmap=mmap)))
+    if deduplicate:
+        train = DeduplicatedGameDataset(train)
+    return train, validation, test
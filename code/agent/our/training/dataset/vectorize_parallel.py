@@ -0,0 +1,163 @@
+"""
+Parallel version of the vectorize_train_validation_test_sets functions of generate_dataset_1 and generate_dataset_2.
+
+Games are read lazily (one file at a time for the avalonlogs folder, and with ijson when it is installed for the
+ProAvalon json file), vectorized on a process pool with the same functions as the serial code, and collected into
+fixed size uint8 numpy batches. The output is identical to the serial functions, in the same order.
+With augment=False the games are kept as they are, MyGameDataset can then apply the augmentation when it is read.
+"""
+
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+try:
+    import ijson
+except ImportError:  # the ProAvalon file is then loaded in one go
+    ijson = None
+
+from .generate_dataset_1 import AVALONLOGS_6P_FOLDER
+from .generate_dataset_1 import read_and_vectorize_game_history
+from .generate_dataset_1 import split_game_files
+from .generate_dataset_2 import FILE as PROAVALON_FILE
+from .generate_dataset_2 import extract_all_data_from_game
+from .generate_dataset_2 import game_split
+from .game_corpus import GameCorpus
+from .game_corpus import is_corpus
+
+
+NUM_COLUMNS = 21  # 6 roles and (party, vote, outcome) for 5 quests
+SPLITS = ["train", "validation", "test"]
+# the serial functions augment the train split with the cyclic player orders and all splits with partial games
+AUGMENTATION = {
+    "train": {"circular": True, "partial": True},
+    "validation": {"circular": False, "partial": True},
+    "test": {"circular": False, "partial": True},
+}
+
+
+def _to_array(vectors):
+    return np.asarray(vectors, dtype=np.uint8).reshape(-1, NUM_COLUMNS)
+
+
+def _augmentation(split, augment):
+    return AUGMENTATION[split] if augment else {"circular": False, "partial": False}
+
+
+def _vectorize_file(task):
+    split, file_path, augment = task
+    return split, _to_array(read_and_vectorize_game_history(file_path, **_augmentation(split, augment)))
+
+
+def _vectorize_game(task):
+    split, game, augment = task
+    return split, _to_array(extract_all_data_from_game(game, **_augmentation(split, augment)))
+
+
+def stream_batches(worker, tasks, batch_size=65536, processes=None, chunksize=32):
+    """maps worker over tasks in order, on a pool of processes (all cores by default, 1 runs in this process).
+    worker returns (split, array of vectors). yields (split, batch) where batch is a (batch_size, 21) uint8 array,
+    only the last batch of every split can be shorter"""
+    buffers = {}
+    filled = {}
+
+    def run(pool):
+        if pool is None:
+            return map(worker, tasks)
+        return pool.imap(worker, tasks, chunksize=chunksize)
+
+    pool = Pool(processes) if processes != 1 else None
+    try:
+        for split, vectors in run(pool):
+            if split not in buffers:
+                buffers[split] = np.empty((batch_size, NUM_COLUMNS), dtype=np.uint8)
+                filled[split] = 0
+
+            start = 0
+            while start < len(vectors):
+                count = min(batch_size - filled[split], len(vectors) - start)
+                buffers[split][filled[split]:filled[split] + count] = vectors[start:start + count]
+                filled[split] += count
+                start += count
+
+                if filled[split] == batch_size:
+                    yield split, buffers[split]
+                    buffers[split] = np.empty((batch_size, NUM_COLUMNS), dtype=np.uint8)
+                    filled[split] = 0
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    for split in buffers:
+        if filled[split] > 0:
+            yield split, buffers[split][:filled[split]]
+
+
+def iter_proavalon_games(file_path=PROAVALON_FILE):
+    """yields the games of the ProAvalon json file, or of a corpus written by game_corpus.py, one by one"""
+    if is_corpus(file_path):
+        yield from GameCorpus(file_path)
+        return
+    with open(file_path, "rb") as fh:
+        if ijson is None:
+            yield from json.load(fh)
+        else:
+            yield from ijson.items(fh, "item")
+
+
+def stream_avalonlogs(folder_path=AVALONLOGS_6P_FOLDER, batch_size=65536, processes=None, augment=True):
+    """streams the batches of generate_dataset_1.vectorize_train_validation_test_sets as (split, batch)"""
+    def tasks():
+        for split, files in zip(SPLITS, split_game_files(folder_path)):
+            for file_name in files:
+                file_path = os.path.join(folder_path, file_name)
+                if os.path.isfile(file_path):
+                    yield split, file_path, augment
+
+    return stream_batches(_vectorize_file, tasks(), batch_size=batch_size, processes=processes)
+
+
+def stream_proavalon(file_path=PROAVALON_FILE, train_percentage=0.7, batch_size=65536, processes=None, augment=True):
+    """streams the batches of generate_dataset_2.vectorize_train_validation_test_sets as (split, batch).
+    the file is read twice, first to count the six player games for the split, a corpus counts them from its index"""
+    if is_corpus(file_path):
+        six_player_games = int((GameCorpus(file_path).num_players() == 6).sum())
+    else:
+        six_player_games = sum(1 for game in iter_proavalon_games(file_path) if game.get("numberOfPlayers") == 6)
+
+    def tasks():
+        index = 0
+        for game in iter_proavalon_games(file_path):
+            if game.get("numberOfPlayers") == 6:
+                yield SPLITS[game_split(index, six_player_games, train_percentage)], game, augment
+                index += 1
+
+    return stream_batches(_vectorize_game, tasks(), batch_size=batch_size, processes=processes)
+
+
+def collect_splits(stream):
+    """concatenates the batches of a stream into one array per split, returns train, validation and test"""
+    batches = {split: [] for split in SPLITS}
+    for split, batch in stream:
+        batches[split].append(batch)
+    return tuple(np.concatenate(batches[split]) if batches[split] else np.empty((0, NUM_COLUMNS), dtype=np.uint8)
+                 for split in SPLITS)
+
+
+def vectorize_train_validation_test_sets(dataset_number=12, train_percentage=0.7,
+                                         avalonlogs_folder=AVALONLOGS_6P_FOLDER, proavalon_file=PROAVALON_FILE,
+                                         batch_size=65536, processes=None, augment=True):
+    """returns the train, validation and test arrays of dataset 1, 2 or both (12), concatenated in that order.
+    without augment every game is a single row, the final state of the game in the order of its players"""
+    sets = []
+    if dataset_number in [1, 12]:
+        sets.append(collect_splits(stream_avalonlogs(avalonlogs_folder, batch_size=batch_size, processes=processes,
+                                                     augment=augment)))
+    if dataset_number in [2, 12]:
+        sets.append(collect_splits(stream_proavalon(proavalon_file, train_percentage=train_percentage,
+                                                    batch_size=batch_size, processes=processes, augment=augment)))
+    if len(sets) == 0:
+        raise ValueError("Unknown dataset number {}".format(dataset_number))
+    return tuple(np.concatenate(arrays) for arrays in zip(*sets))
@@ -0,0 +1,199 @@
+"""
+Hyperparameter sweep for the ego centric belief network, run from this folder:
+
+    python sweep.py --search random --num_configs 20 --processes 4 --output sweep_results.csv
+
+The dataset is vectorized once into the cache of dataset/dataset_cache.py (built first if needed), every worker
+process then memory maps the same cache files and builds its datasets once, and trains one configuration after the
+other on them. The validation and test rows are read from the mapping, so the workers share their pages (each worker
+only holds a small per game index). The training items are deduplicated (DeduplicatedGameDataset), which builds
+the distinct items in memory: every worker holds its own copy of those.
+Each finished configuration is appended to the results csv with its validation loss, ECE, accuracy, f1, number of
+epochs and wall time, so an interrupted sweep keeps what it finished.
+
+The search space is SEARCH_SPACE, or a json file with the same keys mapping to lists of values (--space).
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import time
+import multiprocessing
+
+import torch
+
+from pomegranate.distributions import EgoNeuralDistribution
+from pomegranate.distributions.trainer import train_model, WeightedBCEWithLogitsLoss
+from dataset.load_dataset import load_cached_datasets, make_dataloader
+from dataset.dataset_cache import load_or_build_cache
+from dataset.generate_dataset_1 import AVALONLOGS_6P_FOLDER
+from dataset.generate_dataset_2 import FILE as PROAVALON_FILE
+from temperature_scaling import calibration_metrics
+from train_main import compute_pos_weight
+from game_spec import SIX_PLAYER_GAME
+
+
+# the values train_main uses are the first of every list
+SEARCH_SPACE = {
+    "hidden_dim": [16, 8, 32, 64],
+    "party_dim": [4, 2, 8],
+    "vote_dim": [4, 2, 8],
+    "outcome_dim": [1, 2],
+    "lr": [0.0001, 0.0003, 0.001],
+    "weight_decay": [1e-3, 1e-4, 0.0],
+    "batch_size": [2048, 1024, 4096],
+}
+RESULT_COLUMNS = ["val_loss", "val_ece", "val_mce", "val_brier", "val_accuracy", "val_f1", "epochs", "wall_time"]
+
+# the datasets of a worker process, loaded once by _init_worker
+_datasets = None
+_pos_weight = None
+
+
+def grid_configs(space):
+    """every combination of the values in the search space"""
+    keys = list(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*(space[key] for key in keys))]
+
+
+def random_configs(space, num_configs, seed=0):
+    """num_configs different configurations drawn uniformly from the search space (fewer if the grid is smaller)"""
+    grid = grid_configs(space)
+    return random.Random(seed).sample(grid, min(num_configs, len(grid)))
+
+
+def _init_worker(cache_dir, num_threads):
+    global _datasets, _pos_weight
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    _datasets = load_cached_datasets(cache_dir, mmap=True, deduplicate=True)
+    _pos_weight = compute_pos_weight(make_dataloader(_datasets[0], 65536, False))
+
+
+def run_config(task):
+    """trains one configuration on the datasets of the worker, returns (index, config, results)"""
+    index, config, num_epochs, patience, delta, seed, save_dir = task
+    start = time.time()
+    torch.manual_seed(seed + index)
+
+    spec = SIX_PLAYER_GAME
+    embedding_dim_list = spec.embedding_dim_list(config["party_dim"], config["vote_dim"], config["outcome_dim"])
+    EgoNeuralDistribution.initialize(spec.num_categories_list(), embedding_dim_list, config["hidden_dim"], 1)
+    model = EgoNeuralDistribution.model
+
+    train_dataset, val_dataset, _ = _datasets
+    train_loader = make_dataloader(train_dataset, config["batch_size"], True)
+    val_loader = make_dataloader(val_dataset, config["batch_size"], False)
+
+    criterion = WeightedBCEWithLogitsLoss(pos_weight=_pos_weight)
+    optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"], weight_decay=config["weight_decay"])
+    history = train_model(model, train_loader, val_loader, criterion, optimizer,
+                          num_epochs=num_epochs, patience=patience, delta=delta, log_every=0)
+
+    # train_model has loaded the weights with the best validation loss
+    model.eval()
+    calibration = calibration_metrics(model, val_loader)
+    best_epoch = min(range(len(history["val_losses"])), key=history["val_losses"].__getitem__)
+    if save_dir is not None:
+        torch.save(model.state_dict(), os.path.join(save_dir, "config_{}.pth".format(index)))
+
+    results = {
+        "val_loss": history["val_losses"][best_epoch],
+        "val_ece": calibration["ece"],
+        "val_mce": calibration["mce"],
+        "val_brier": calibration["brier"],
+        "val_accuracy": history["val_accuracies"][best_epoch],
+        "val_f1": history["val_f1_scores"][best_epoch],
+        "epochs": len(history["val_losses"]),
+        "wall_time": time.time() - start,
+    }
+    return index, config, results
+
+
+def run_sweep(configs, cache_dir="dataset_cache", output="sweep_results.csv", processes=None, num_threads=None,
+              dataset_number=12, train_percentage=0.8, num_epochs=500, patience=20, delta=0.01, seed=0,
+              save_dir=None, avalonlogs_folder=AVALONLOGS_6P_FOLDER, proavalon_file=PROAVALON_FILE):
+    """trains every configuration on a pool of processes (all cores by default, 1 runs in this process)
+    and writes one row per configuration to output as they finish. returns the rows sorted by validation loss"""
+    # vectorize once here, the workers only read the cache
+    load_or_build_cache(cache_dir, dataset_number=dataset_number, train_percentage=train_percentage,
+                        avalonlogs_folder=avalonlogs_folder, proavalon_file=proavalon_file)
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if num_threads is None:
+        # one process per core by default, more threads would only compete for the same cores
+        num_threads = max(1, (os.cpu_count() or 1) // processes)
+
+    tasks = [(index, config, num_epochs, patience, delta, seed, save_dir) for index, config in enumerate(configs)]
+    keys = sorted({key for config in configs for key in config})
+    rows = []
+
+    pool = None
+    if processes == 1:
+        _init_worker(cache_dir, num_threads)
+        finished = map(run_config, tasks)
+    else:
+        # spawned rather than forked: the workers load their own datasets anyway, and a forked pool hangs the
+        # interpreter at exit once numba (imported by apricot through pomegranate) is loaded
+        pool = multiprocessing.get_context("spawn").Pool(processes, initializer=_init_worker,
+                                                         initargs=(cache_dir, num_threads))
+        finished = pool.imap_unordered(run_config, tasks)
+
+    try:
+        with open(output, "w", newline="") as fh:
+            writer = csv.DictWriter(fh, fieldnames=["config"] + keys + RESULT_COLUMNS)
+            writer.writeheader()
+            for index, config, results in finished:
+                row = dict(config=index, **config, **results)
+                writer.writerow(row)
+                fh.flush()
+                rows.append(row)
+                print("config {} ({}/{}): val loss {:.4f}, val ECE {:.4f}, {:.0f}s".format(
+                    index, len(rows), len(tasks), results["val_loss"], results["val_ece"], results["wall_time"]))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return sorted(rows, key=lambda row: row["val_loss"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grid or random search over the belief network hyperparameters")
+    parser.add_argument("--search", choices=["grid", "random"], default="random")
+    parser.add_argument("--num_configs", type=int, default=10, help="number of configurations of a random search")
+    parser.add_argument("--space", type=str, default=None, help="json file with the search space")
+    parser.add_argument("--cache_dir", type=str, default="dataset_cache")
+    parser.add_argument("--output", type=str, default="sweep_results.csv")
+    parser.add_argument("--save_dir", type=str, default=None, help="folder for the weights of every configuration")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes, all cores by default")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads per worker")
+    parser.add_argument("--dataset_number", type=int, default=12)
+    parser.add_argument("--train_percentage", type=float, default=0.8)
+    parser.add_argument("--avalonlogs_folder", type=str, default=AVALONLOGS_6P_FOLDER)
+    parser.add_argument("--proavalon_file", type=str, default=PROAVALON_FILE)
+    parser.add_argument("--num_epochs", type=int, default=500)
+    parser.add_argument("--patience", type=int, default=20)
+    parser.add_argument("--delta", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    space = SEARCH_SPACE
+    if args.space is not None:
+        with open(args.space, "r") as fh:
+            space = json.load(fh)
+    configs = grid_configs(space) if args.search == "grid" else random_configs(space, args.num_configs, args.seed)
+
+    rows = run_sweep(configs, cache_dir=args.cache_dir, output=args.output, processes=args.processes,
+                     num_threads=args.threads, dataset_number=args.dataset_number,
+                     train_percentage=args.train_percentage, num_epochs=args.num_epochs, patience=args.patience,
+                     delta=args.delta, seed=args.seed, save_dir=args.save_dir,
+                     avalonlogs_folder=args.avalonlogs_folder, proavalon_file=args.proavalon_file)
+    print("best configurations:")
+    for row in rows[:5]:
+        print(row)
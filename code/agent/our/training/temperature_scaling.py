@@ -108,18 +108,103 @@ class _ECELoss(nn.Module):
         self.bin_uppers = bin_boundaries[1:]
 
     def forward(self, logits, labels):
-        softmaxes = F.sigmoid(logits) #, dim=1)
-        confidences, predictions = torch.max(softmaxes, 1)
-        accuracies = predictions.eq(labels)
-
-        ece = torch.zeros(1, device=logits.device)
-        for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-            # Calculated |confidence - accuracy| in each bin
-            in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-            prop_in_bin = in_bin.float().mean()
-            if prop_in_bin.item() > 0:
-                accuracy_in_bin = accuracies[in_bin].float().mean()
-                avg_confidence_in_bin = confidences[in_bin].mean()
-                ece += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-
-        return ece
+        metrics = CalibrationMetrics(n_bins=len(self.bin_lowers))
+        metrics.update(logits, labels)
+        return torch.tensor([metrics.compute()["ece"]], device=logits.device)
+
+
+def confidences_and_predictions(logits):
+    """the confidence in the predicted class and the prediction for every row of logits.
+    a single column is a binary classifier (sigmoid), more columns are a softmax over the classes"""
+    if logits.dim() == 1 or logits.size(1) == 1:
+        probs = torch.sigmoid(logits.reshape(-1))
+        predictions = (probs >= 0.5).long()
+        confidences = torch.where(predictions == 1, probs, 1 - probs)
+        return confidences, predictions, probs
+    confidences, predictions = torch.max(F.softmax(logits, dim=1), 1)
+    return confidences, predictions, None
+
+
+class CalibrationMetrics(object):
+    """
+    Streaming calibration metrics over equally sized confidence bins.
+
+    update() can be called once per batch, only per-bin sums are kept, so the logits of the whole dataset
+    never have to be in memory at once. Every batch is binned with one torch.bucketize and summed per bin with
+    scatter_add. compute() returns:
+        ece: expected calibration error, sum over bins of |accuracy - confidence| weighted by the bin size
+        mce: maximum calibration error, the largest |accuracy - confidence| of a non empty bin
+        brier: mean squared error of the predicted probability of class 1 (binary classifiers only)
+        accuracy, count
+        reliability: per bin lower/upper bound, count, mean confidence and accuracy (None for empty bins)
+    A confidence falls into the bin (lower, upper], like _ECELoss. With weights every row counts weight times.
+    """
+    def __init__(self, n_bins=15):
+        self.n_bins = n_bins
+        self.boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.reset()
+
+    def reset(self):
+        # per bin: count, sum of confidences, number of correct predictions
+        self.bin_sums = torch.zeros(3, self.n_bins, dtype=torch.float64)
+        self.brier_sum = torch.zeros((), dtype=torch.float64)
+        self.binary = True
+
+    def update(self, logits, labels, weights=None):
+        with torch.no_grad():
+            logits = logits.detach().cpu()
+            labels = labels.detach().cpu().reshape(-1)
+            confidences, predictions, probs = confidences_and_predictions(logits)
+            correct = predictions.eq(labels.long())
+            weights = torch.ones_like(confidences) if weights is None else weights.detach().cpu().reshape(-1).float()
+
+            bins = torch.bucketize(confidences, self.boundaries[1:-1])
+            values = torch.stack([weights, confidences * weights, correct.to(confidences.dtype) * weights])
+            self.bin_sums.scatter_add_(1, bins.expand(3, -1), values.double())
+
+            if probs is None:
+                self.binary = False
+            else:
+                self.brier_sum += ((probs - labels.float()) ** 2 * weights).double().sum()
+
+    def update_from_loader(self, model, loader, temperature=None):
+        """runs the model over the loader batch by batch and adds the results.
+        batches can be (inputs, labels) or (inputs, labels, weights)"""
+        with torch.no_grad():
+            for batch in loader:
+                logits = model(batch[0])
+                if temperature is not None:
+                    logits = logits / temperature
+                self.update(logits, batch[1], batch[2] if len(batch) > 2 else None)
+        return self
+
+    def compute(self):
+        counts, confidence_sums, correct_sums = self.bin_sums
+        non_empty = counts > 0
+        mean_confidence = confidence_sums / counts.clamp(min=1)
+        accuracy = correct_sums / counts.clamp(min=1)
+        gaps = (accuracy - mean_confidence).abs()
+
+        # one sync for all the results
+        (counts, mean_confidence, accuracy, gaps, non_empty, boundaries, correct,
+         brier_sum) = [t.tolist() for t in (counts, mean_confidence, accuracy, gaps, non_empty, self.boundaries,
+                                           correct_sums.sum(), self.brier_sum)]
+        total = max(sum(counts), 1)
+        reliability = [{"lower": boundaries[i], "upper": boundaries[i + 1],
+                        "count": int(round(counts[i])),
+                        "confidence": mean_confidence[i] if non_empty[i] else None,
+                        "accuracy": accuracy[i] if non_empty[i] else None}
+                       for i in range(self.n_bins)]
+        return {
+            "ece": sum(gap * count for gap, count in zip(gaps, counts)) / total,
+            "mce": max([gap for gap, filled in zip(gaps, non_empty) if filled], default=0.0),
+            "brier": brier_sum / total if self.binary else None,
+            "accuracy": correct / total,
+            "count": int(round(sum(counts))),
+            "reliability": reliability,
+        }
+
+
+def calibration_metrics(model, loader, n_bins=15, temperature=None):
+    """ECE, MCE, Brier score and the reliability curve of the model on the loader, see CalibrationMetrics"""
+    return CalibrationMetrics(n_bins=n_bins).update_from_loader(model, loader, temperature=temperature).compute()
@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import torch
 from pomegranate.distributions import EgoNeuralDistribution
+from pomegranate.distributions.trainer import train_model, WeightedBCEWithLogitsLoss
 from torch.utils.data import Dataset, DataLoader
 from torch import nn
 import torch.nn.functional as F
@@ -8,10 +9,12 @@ import tqdm
 import numpy as np
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
 
-from temperature_scaling import ModelWithTemperature
+from temperature_scaling import ModelWithTemperature, calibration_metrics
 
 
 from dataset.load_dataset import create_dataloaders
+from dataset.dataset_cache import read_manifest
+import argparse
 
 
 def get_predictions(model, dataloader, device):
@@ -38,26 +41,10 @@ def get_predictions(model, dataloader, device):
 
     return torch.cat(all_probs), torch.cat(all_preds), torch.cat(all_labels)
 
-def plot_accuracy_vs_confidence(confidences, predictions, labels, num_bins=10):
-    bins = np.linspace(0.0, 1.0, num_bins + 1)
-    bin_indices = np.digitize(confidences.numpy(), bins) - 1
-
-    accuracies = []
-    avg_confidences = []
-    counts = []
-    labels = labels.unsqueeze(1) 
-    for i in range(num_bins):
-        idx = bin_indices == i
-        idx = torch.tensor(idx)
-        if torch.sum(idx) > 0:
-            acc = torch.mean((predictions[idx] == labels[idx]).float()).item()
-            avg_conf = torch.mean(confidences[idx]).item()
-            accuracies.append(acc)
-            avg_confidences.append(avg_conf)
-        else:
-            accuracies.append(np.nan)
-            avg_confidences.append((bins[i] + bins[i+1]) / 2)
-
+def plot_accuracy_vs_confidence(reliability, file_name="accuracy_vs_confidence_with_no_partial.png"):
+    """plots the reliability curve of CalibrationMetrics.compute(), empty bins are left out"""
+    avg_confidences = [b["confidence"] if b["count"] else (b["lower"] + b["upper"]) / 2 for b in reliability]
+    accuracies = [b["accuracy"] if b["count"] else np.nan for b in reliability]
 
     plt.figure(figsize=(6, 6))
     plt.plot([0, 1], [0, 1], linestyle='--', color='gray', label='Perfect Calibration')
@@ -68,7 +55,16 @@ def plot_accuracy_vs_confidence(confidences, predictions, labels, num_bins=10):
     plt.legend()
     plt.grid(True)
     # plt.show()
-    plt.savefig("accuracy_vs_confidence_with_no_partial.png")
+    plt.savefig(file_name)
+
+
+def print_calibration(model, dataloader, num_bins=10):
+    """streams the model over the dataloader, prints ECE, MCE and the Brier score and plots the reliability curve"""
+    model.eval()
+    metrics = calibration_metrics(model, dataloader, n_bins=num_bins)
+    print(f"ECE: {metrics['ece']:.4f}, MCE: {metrics['mce']:.4f}, Brier: {metrics['brier']:.4f}")
+    plot_accuracy_vs_confidence(metrics["reliability"])
+    return metrics
 
 
 def predict_without_temperature(model, temperature_scaler, test_loader, device="cpu", is_multiclass=True):
@@ -122,33 +118,6 @@ def draw_graphs(train_losses, val_losses, train_accuracies, val_accuracies, trai
 
 
 
-class EarlyStopping:
-    def __init__(self, patience=10, delta=0):
-        self.patience = patience
-        self.delta = delta
-        self.best_score = None
-        self.early_stop = False
-        self.counter = 0
-        self.best_model_state = None
-
-    def __call__(self, val_loss, model):
-        score = -val_loss
-        if self.best_score is None:
-            self.best_score = score
-            self.best_model_state = model.state_dict()
-        elif score < self.best_score + self.delta:
-            self.counter += 1
-            if self.counter >= self.patience:
-                self.early_stop = True
-        else:
-            self.best_score = score
-            self.best_model_state = model.state_dict()
-            self.counter = 0
-
-    def load_best_model(self, model):
-        model.load_state_dict(self.best_model_state)
-
-
 class MyGameDataset(Dataset):
     def __init__(self, data_list):
         super().__init__()
@@ -184,10 +153,12 @@ def compute_pos_weight(train_loader):
     total_positives = 0
     total_count = 0
 
-    # Iterate over the entire train dataset to count positives
-    for _, batch_labels in train_loader:
-        total_positives += batch_labels.sum().item()
-        total_count += batch_labels.size(0)
+    # Iterate over the entire train dataset to count positives, deduplicated batches also hold the counts
+    for batch in train_loader:
+        batch_labels = batch[1].reshape(-1)
+        batch_weights = batch[2].reshape(-1) if len(batch) > 2 else torch.ones_like(batch_labels)
+        total_positives += (batch_labels * batch_weights).sum().item()
+        total_count += batch_weights.sum().item()
     
     # number of negatives
     total_negatives = total_count - total_positives
@@ -205,7 +176,10 @@ def compute_pos_weight(train_loader):
 
 
 if __name__ == "__main__":
-
+    parser = argparse.ArgumentParser(description="Train the ego centric belief network")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from ego_centric_model_checkpoint.pth")
+    args = parser.parse_args()
 
     num_categories_list = [2, 16, 23, 3, 21, 23, 3, 16, 23, 3, 21, 23, 3, 16, 23, 3]
     embedding_dim_list = [4, 4, 1, 4, 4, 1, 4, 4, 1, 4, 4, 1, 4, 4, 1]  # Specify embedding dimensions for each variable
@@ -214,12 +188,14 @@ if __name__ == "__main__":
 
     output_dim = 1
     EgoNeuralDistribution.initialize(num_categories_list, embedding_dim_list, hidden_dim, output_dim)
-    model = EgoNeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=0, from_file=True, graph=True)
+    model = EgoNeuralDistribution(num_categories_list, embedding_dim_list, hidden_dim, output_dim, name=0, graph=True)
 
     train_loader, val_loader, test_loader = create_dataloaders(dataset_number=12, 
                                                                 train_percentage=0.8, 
                                                                 batch_size=2048, #*8, #2048*8, #32, 
-                                                                shuffle=True)
+                                                                shuffle=True,
+                                                                cache_dir="dataset_cache",  # vectorized once, see dataset/dataset_cache.py
+                                                                deduplicate=True)  # distinct training items weighted by their counts
     
 
     
@@ -231,157 +207,28 @@ if __name__ == "__main__":
 
     pos_weight = compute_pos_weight(train_loader)
 
-    criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
+    criterion = WeightedBCEWithLogitsLoss(pos_weight=pos_weight)
 
     optimizer = torch.optim.Adam(EgoNeuralDistribution.model.parameters(), lr=0.0001, weight_decay=1e-3) # added weight decay
 
 
     print("set the pos weights for the classes: ", pos_weight)
 
-    train_losses = []
-    val_losses = []
-    val_losses_1 = []
-    train_accuracies = []
-    val_accuracies = []
-    val_accuracies_1 = []
-    train_f1_scores = []
-    val_f1_scores = []
-    val_f1_scores_1 = []
-
-    early_stopping = EarlyStopping(patience=20, delta=0.01)
-    # early_stopping = EarlyStopping(patience=20, delta=0.001)
-
-    num_epochs = 500
-    for epoch in tqdm.tqdm(range(num_epochs)):
-        EgoNeuralDistribution.model.train()
-
-        epoch_train_loss = 0.0
-        epoch_train_correct = 0
-        epoch_train_total = 0
-
-        epoch_tp = 0
-        epoch_fp = 0
-        epoch_fn = 0
-        epoch_tn = 0
-
-        for batch_features, batch_labels in train_loader:
-
-            outputs = EgoNeuralDistribution.model(batch_features)
-            loss = criterion(outputs.squeeze(), batch_labels.float())
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            batch_size = batch_features.size(0)
-            epoch_train_loss += loss.item() * batch_size
-
-            outputs_sigmoid = torch.sigmoid(outputs)
-            predicted_train = (outputs_sigmoid.squeeze() > 0.5).float()
-
-            correct = (predicted_train == batch_labels.float()).sum().item()
-            epoch_train_correct += correct
-            epoch_train_total += batch_size
-            
-            tp = ((predicted_train == 1) & (batch_labels == 1)).sum().item()
-            fp = ((predicted_train == 1) & (batch_labels == 0)).sum().item()
-            fn = ((predicted_train == 0) & (batch_labels == 1)).sum().item()
-            tn = ((predicted_train == 0) & (batch_labels == 0)).sum().item()
-            
-            epoch_tp += tp
-            epoch_fp += fp
-            epoch_fn += fn
-            epoch_tn += tn
-
-        epoch_train_loss /= epoch_train_total
-        train_losses.append(epoch_train_loss)
-        train_accuracy = epoch_train_correct / epoch_train_total
-        train_accuracies.append(train_accuracy)   
-        if epoch_tp == 0:
-            train_f1 = 0.0
-        else:
-            precision = epoch_tp / (epoch_tp + epoch_fp + 1e-8)
-            recall = epoch_tp / (epoch_tp + epoch_fn + 1e-8)
-            train_f1 = 2 * (precision * recall) / (precision + recall + 1e-8)
-        train_f1_scores.append(train_f1)
-
-        #---------------------------------------------------
-        # Validation Loop
-        #---------------------------------------------------
-        EgoNeuralDistribution.model.eval()
-        with torch.no_grad():
-            epoch_val_loss = 0.0
-            epoch_val_correct = 0
-            epoch_val_total = 0
-            
-            # For F1 computation of val_loader
-            val_tp = 0
-            val_fp = 0
-            val_fn = 0
-            val_tn = 0
-            
-            for val_features, val_labels in val_loader:
-                val_outputs = EgoNeuralDistribution.model(val_features)
-                val_loss = criterion(val_outputs.squeeze(), val_labels.float())
-                
-                # Accumulate validation loss
-                batch_size = val_features.size(0)
-                epoch_val_loss += val_loss.item() * batch_size
-                
-                # Predictions
-                val_outputs_sigmoid = torch.sigmoid(val_outputs)
-                predicted_val = (val_outputs_sigmoid.squeeze() > 0.5).float()
-                
-                correct_val = (predicted_val == val_labels.float()).sum().item()
-                epoch_val_correct += correct_val
-                epoch_val_total += batch_size
-                
-                tp = ((predicted_val == 1) & (val_labels == 1)).sum().item()
-                fp = ((predicted_val == 1) & (val_labels == 0)).sum().item()
-                fn = ((predicted_val == 0) & (val_labels == 1)).sum().item()
-                tn = ((predicted_val == 0) & (val_labels == 0)).sum().item()
-                
-                val_tp += tp
-                val_fp += fp
-                val_fn += fn
-                val_tn += tn
-            
-
-            epoch_val_loss /= epoch_val_total
-            val_losses.append(epoch_val_loss)
-            
-
-            val_accuracy = epoch_val_correct / epoch_val_total
-            val_accuracies.append(val_accuracy)
-            
-            if val_tp == 0:
-                val_f1 = 0.0
-            else:
-                precision = val_tp / (val_tp + val_fp + 1e-8)
-                recall = val_tp / (val_tp + val_fn + 1e-8)
-                val_f1 = 2 * (precision * recall) / (precision + recall + 1e-8)
-            val_f1_scores.append(val_f1)
-
-            # Early stopping check
-            val_loss_for_early_stopping = torch.tensor(epoch_val_loss)  # if needed
-            early_stopping(val_loss_for_early_stopping, EgoNeuralDistribution.model)
-            if early_stopping.early_stop:
-                print(f"Early stopping at epoch {epoch}")
-                print(
-                f"Epoch [{epoch+1}/{num_epochs}], "
-                f"Train Loss: {epoch_train_loss:.4f}, Val Loss: {epoch_val_loss:.4f}, "
-                f"Train Acc: {train_accuracy:.4f}, Val Acc: {val_accuracy:.4f}"
-                )
-                break
-
-        if (epoch + 1) % 5 == 0:
-            print(
-                f"Epoch [{epoch+1}/{num_epochs}], "
-                f"Train Loss: {epoch_train_loss:.4f}, Val Loss: {epoch_val_loss:.4f}, "
-                f"Train Acc: {train_accuracy:.4f}, Val Acc: {val_accuracy:.4f}"
-            )
-
-
-    early_stopping.load_best_model(EgoNeuralDistribution.model)
+    # a checkpoint is only resumed by a run on the same cached dataset with the same settings
+    run_identity = {"dataset": read_manifest("dataset_cache"), "deduplicate": True, "hidden_dim": hidden_dim,
+                    "embedding_dim_list": embedding_dim_list, "lr": 0.0001, "weight_decay": 1e-3, "batch_size": 2048}
+
+    # mini-batches come from the loaders, see create_dataloaders for the batch size
+    history = train_model(EgoNeuralDistribution.model, train_loader, val_loader, criterion, optimizer,
+                          num_epochs=500, patience=20, delta=0.01,
+                          num_threads=None,  # all cores
+                          compile=False,  # torch.compile the model, worth it for long runs
+                          checkpoint_path="ego_centric_model_checkpoint.pth",  # deleted when the run finishes
+                          resume=args.resume, run_identity=run_identity,
+                          log_every=5)
+    train_losses, val_losses = history["train_losses"], history["val_losses"]
+    train_accuracies, val_accuracies = history["train_accuracies"], history["val_accuracies"]
+    train_f1_scores, val_f1_scores = history["train_f1_scores"], history["val_f1_scores"]
     print(f"Final train accuracy: {train_accuracies[-1]:.4f}, final val accuracy: {val_accuracies[-1]:.4f}")
     
     draw_graphs(train_losses, val_losses, train_accuracies, val_accuracies, train_f1_scores, val_f1_scores, "ego_centric_model", 0)
@@ -392,7 +239,7 @@ if __name__ == "__main__":
 
 
     confidences, predictions, labels = get_predictions(EgoNeuralDistribution.model, val_loader, device=torch.device("cpu"))
-    plot_accuracy_vs_confidence(confidences, predictions, labels)
+    print_calibration(EgoNeuralDistribution.model, val_loader)
 
     f1 = f1_score(labels.numpy(), predictions.numpy(), average='binary')
     accuracy = accuracy_score(labels.numpy(), predictions.numpy())
@@ -404,7 +251,7 @@ if __name__ == "__main__":
     print(f"Recall: {recall:.4f}")
 
     confidences, predictions, labels = get_predictions(scaled_model, val_loader, device=torch.device("cpu"))
-    plot_accuracy_vs_confidence(confidences, predictions, labels)
+    print_calibration(scaled_model, val_loader)
 
 
     print("--------------------------")
@@ -16,6 +16,7 @@ from Avalon.utils import (
     extract_speak_id,
     extract_think_speak,
     extract_think_speak_in_revision,
+    fan_out,
     judge_contents_valid,
     mark_memory_position,
 )
@@ -126,6 +127,10 @@ class Player:
             )
         return temp_config
 
+    def _max_parallel_calls(self):
+        # the number of independent LLM calls (tree of thought branches) that run at the same time, 1 runs them in order
+        return self.config.get("max_parallel_calls", 4)
+
     def set_game_belong_to(self, game: Game):
         self.game_belong_to = game
 
@@ -358,26 +363,32 @@ class Player:
         all_llm_message_data = []
         plans_list = []
         speaking_contents_list = []
-        # Generate plans
+        # Generate plans, the branches are independent and run concurrently
+        plan_prompt = self._prompt_hint.tot_plan_prompt
+        retrieved_history_with_select_plan_prompt = copy.deepcopy(retrieved_history)
+        plan_calls = []
         for i in range(self.config["breadth"]):
-            plan_prompt = self._prompt_hint.tot_plan_prompt
             retrieved_history_with_plan_prompt = copy.deepcopy(retrieved_history)
-            retrieved_history_with_select_plan_prompt = copy.deepcopy(retrieved_history)
             retrieved_history_with_plan_prompt.append(
                 {
                     "role": "user",
                     "content": plan_prompt,
                 }
             )
-            cur_plan, full_data = self.player_call_api(
-                input_messages=retrieved_history_with_plan_prompt,
-                config=self.config,
-                **(
-                    {"schema": api_config.typechat_schema_talk}
-                    if self.use_modified_prompts
-                    else {}
-                ),
+            plan_calls.append(
+                dict(
+                    input_messages=retrieved_history_with_plan_prompt,
+                    config=self.config,
+                    **(
+                        {"schema": api_config.typechat_schema_talk}
+                        if self.use_modified_prompts
+                        else {}
+                    ),
+                )
             )
+        for i, (cur_plan, full_data) in enumerate(
+            fan_out(self.player_call_api, plan_calls, self._max_parallel_calls())
+        ):
             all_llm_message_data.append(full_data)
             plans_list.append(f"Plan {i+1}: {cur_plan}")
         # choose one plan
@@ -410,6 +421,7 @@ class Player:
                 else:
                     raise ValueError("Too much try num for selecting plans.")
             break
+        speak_calls = []
         for i in range(self.config["breadth"]):
             speak_prompt = self._prompt_hint.tot_speak_prompt
             speak_prompt = speak_prompt + selected_plan
@@ -420,15 +432,24 @@ class Player:
                     "content": speak_prompt,
                 }
             )
-            cur_speak, full_data = self.player_call_api(
-                input_messages=retrieved_history_with_speak_prompt,
-                config=self.config,
-                **(
-                    {"schema": api_config.typechat_schema_talk}
-                    if self.use_modified_prompts
-                    else {}
-                ),
+            speak_calls.append(
+                dict(
+                    input_messages=retrieved_history_with_speak_prompt,
+                    config=self.config,
+                    **(
+                        {"schema": api_config.typechat_schema_talk}
+                        if self.use_modified_prompts
+                        else {}
+                    ),
+                )
             )
+        # the speak selection continues the history of the last branch
+        retrieved_history_with_speak_prompt = copy.deepcopy(
+            speak_calls[-1]["input_messages"]
+        )
+        for i, (cur_speak, full_data) in enumerate(
+            fan_out(self.player_call_api, speak_calls, self._max_parallel_calls())
+        ):
             all_llm_message_data.append(full_data)
             speaking_contents_list.append(f"Speak {i+1}: {cur_speak}")
         try_num = 0
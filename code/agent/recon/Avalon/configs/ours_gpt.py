@@ -25,6 +25,7 @@ config = dict(
     breadth = None,
     seed = None, 
     tot=False,
+    max_parallel_calls = 4,  # tot branches that call the LLM at the same time
     
     # for without cot
     without_cot = False,
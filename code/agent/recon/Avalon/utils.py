@@ -1,13 +1,16 @@
 import json
 import re
+import threading
 import time
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 
 import openai
 import requests
 import tiktoken
 
 from TypeChat.typechat.typechat import TypeChat, TypeChatResult
+from TypeChat.typechat.llm_client import get_llm_client, backend_name, LLMRequestError
 import api_config
 
 
@@ -140,6 +143,19 @@ def extract_speak_id(select_plans_prompt) -> int:
     else:
         return None
 
+def fan_out(fn: Callable, calls: List[Dict], max_workers: int = 4) -> List:
+    """
+    Runs fn(**kwargs) for the kwargs of every call, at most max_workers at a time, and returns the results in the
+    order of the calls. Used for LLM calls that do not depend on each other (e.g. the branches of the tree of thought),
+    so they take about as long as the slowest of them instead of their sum.
+    """
+    if max_workers is None or max_workers <= 1 or len(calls) <= 1:
+        return [fn(**kwargs) for kwargs in calls]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as executor:
+        futures = [executor.submit(fn, **kwargs) for kwargs in calls]
+        return [future.result() for future in futures]
+
+
 def _tshelper_mergeMessages(input_messages):
     merged_input_messages = []
     is_system_prompt_now = True
@@ -416,6 +432,7 @@ def call_gpt_api(
 
 
 global_counter = 0
+global_counter_lock = threading.Lock()
 
 
 def get_forward_response(
@@ -467,29 +484,19 @@ def get_forward_response(
             if message["role"] == "system":
                 message["role"] = "user"
 
-    # Attempt to send the request, retrying up to 5 times on failure
-    try_num = 0
-    while True:
-        try_num += 1
-        if try_num > 5:
-            raise ValueError("Too many failed attempts to call the API!")
-
-        try:
-            response = requests.post(url, headers=headers, json=data)
-            if response.status_code != 200:
-                print(response.content.decode())
-                print(f"{response.status_code=}")
-                time.sleep(5)  # Wait before retrying
-                continue
-            else:
-                break
-        except Exception as e:
-            print(f"Error during API call: {e}")
-            time.sleep(5)
-            continue
+    # Send the request through the LLM client of the process, which retries it up to 5 times with backoff
+    try:
+        response_json = get_llm_client().post_json_sync(
+            "anthropic" if model_type == "claude" else backend_name(url),
+            url,
+            data,
+            headers=headers,
+            max_attempts=5,
+        )
+    except LLMRequestError as error:
+        raise ValueError("Too many failed attempts to call the API!") from error
 
     # Parse the response and extract the content
-    response_json = response.json()
     agent_response = response_json["choices"][0]["message"]["content"]
 
     result = TypeChatResult()
@@ -497,7 +504,7 @@ def get_forward_response(
     ## converting to TypeChat response format here to make it easier to deal with the data after
     result.success = True
     result.data = agent_response
-    response.message = ""
+    result.message = ""
     result.prompt = data["messages"]
     result.raw_response = response_json["choices"][0]["message"]["content"]
     result.usage = {"prompt_tokens": response_json["usage"]["prompt_tokens"], "completion_tokens": response_json["usage"]["completion_tokens"]}
@@ -506,9 +513,11 @@ def get_forward_response(
     # Let's pretty-print the data payload for debugging
     # Save it to a file for debugging
     global global_counter
-    global_counter += 1
+    with global_counter_lock:  # the calls may run concurrently (see fan_out)
+        global_counter += 1
+        payload_number = global_counter
     data["messages"].append({"role": "assistant", "content": agent_response})
-    with open(f"data_payload_{global_counter}.json", "w") as f:
+    with open(f"data_payload_{payload_number}.json", "w") as f:
         f.write(json.dumps(data, indent=2))
 
     return result